@@ -6,13 +6,19 @@
 
 import configparser
 import subprocess
-import multiprocessing
 import time
 import os
+import sys
+import socket
+import struct
+import fcntl
 from collections import deque
 import flask_login
-from flask import Flask, render_template, redirect, url_for, request
+from flask import Flask, render_template, redirect, url_for, request, jsonify, Response
 from forms import UsernamePasswordForm, ScannerConfigForm, DataInfoForm
+from collector import StatusCollector
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lms'))
+from control import call
 
 """
     VARIABLES GLOBALES
@@ -33,6 +39,11 @@ status_info = {'connexion_status': '',\
                 'storage': '',
                 'recording': False}
 events = deque(maxlen=12)
+# periode d'interrogation du daemon pour l'apercu en direct (s)
+PREVIEW_PERIOD = 0.25
+# etat du stockage, de l'enregistrement et du telemetre, mis a jour en tache de fond
+collector = StatusCollector('/media/usb/')
+collector.start()
 
 # pour les chemins relatifs quand on lance le script depuis un autre dossier
 #PATH = os.path.dirname(__file__)
@@ -99,11 +110,60 @@ def logout():
 @app.route('/dash')
 @flask_login.login_required
 def dash():
-    check_storage()
-    status_info['recording'] = isRecording()
-    return render_template('dash.html', connexion_status=status_info['connexion_status'],\
-        status_code=status_info['status_code'], ip=ip, events=events,\
-        storage=status_info['storage'], rec=status_info['recording'])
+    state = dashState()
+    return render_template('dash.html', connexion_status=state['connexion_status'],\
+        status_code=state['status_code'], ip=ip, events=events,\
+        storage=state['storage'], rec=state['recording'])
+
+@app.route('/api/status')
+@flask_login.login_required
+def api_status():
+    """
+        Etat du tableau de bord en JSON (interroge periodiquement par dash.html)
+    """
+    state = dashState()
+    state['events'] = list(events)
+    return jsonify(state)
+
+@app.route('/api/preview')
+@flask_login.login_required
+def api_preview():
+    """
+        Apercu en direct des mesures (Server-Sent Events)
+        Chaque evenement contient une trame d'apercu binaire encodee en base64
+        (format dans lms/preview.py). Le daemon ne copie des trames que tant que
+        ce flux est ouvert
+    """
+    device = request.args.get('device', 0, type=int)
+    step = request.args.get('step', 4, type=int)
+
+    def stream():
+        seq = 0
+        while True:
+            rep = call('preview', timeout=1, device=device, step=step, after=seq)
+            if rep['ok'] and rep['data'] is not None:
+                seq = rep['seq']
+                yield 'data: ' + rep['data'] + '\n\n'
+            else:
+                yield ': \n\n' # commentaire SSE, detecte la fermeture du client
+            time.sleep(PREVIEW_PERIOD)
+    return Response(stream(), mimetype='text/event-stream',\
+        headers={'Cache-Control': 'no-cache'})
+
+def dashState():
+    """
+        Met a jour status_info depuis l'etat en cache et retourne les infos du
+        tableau de bord, sans commande shell ni requete au telemetre
+    """
+    state = collector.get()
+    status_info['storage'] = '' if state['storage'] is None else str(state['storage'])
+    status_info['recording'] = state['recording']
+    if state['codes']: # code d'etat lu par le collecteur, plus recent que le dernier clic
+        status_info['status_code'] = ' '.join(str(code) for code in state['codes'])
+    return {'connexion_status': status_info['connexion_status'],\
+        'status_code': status_info['status_code'], 'storage': status_info['storage'],\
+        'recording': state['recording'], 'path': state['path'], 'ip': ip,\
+        'daemon': state['daemon'], 'updated': state['updated'], 'stats': state['stats']}
 
 @app.route('/config', methods=['GET', 'POST'])
 @flask_login.login_required
@@ -124,7 +184,12 @@ def config():
             'timestamp': 1,\
             'outputinterval': form.interval.data,\
             'echoFilter': form.echo.data,\
-            'event': 1 if form.event.data else 0}
+            'event': 1 if form.event.data else 0,\
+            'beamStep': form.beamStep.data,\
+            'windowStart': form.windowStart.data * 10000,\
+            'windowStop': form.windowStop.data * 10000,\
+            'echoCount': form.echoCount.data,\
+            'keepRemission': 1 if form.keepRemission.data else 0}
 
         # enregistre la config dans un fichier, elle sera chargee au demarrage du telemetre
         with open(PATH+'/lms/config.ini', 'w') as cfgfile:
@@ -152,61 +217,58 @@ def info():
 @app.route('/test', methods=['GET', 'POST'])
 @flask_login.login_required
 def test():
-    # lance l'outil scanner et pipe sa sortie sur rep
-    rep = subprocess.Popen(['python3', PATH+'/lms/scanner.py', '-i', ip, '-p', port, 'test'],\
-        stdout=subprocess.PIPE)
-    msg = rep.communicate()[0].decode() # lis le stdout de l'outil scanner dans msg
+    # le daemon d'acquisition garde la connexion au telemetre ouverte
+    rep = call('test', ip=ip, port=int(port))
+    msg = rep['message'] if rep['ok'] else rep['error']
     status_info['connexion_status'] = msg # met a jour les infos de connexion
     events.append(time.strftime('%d/%m/%Y %H:%M:%S', time.localtime()) + ' - TEST: ' +\
         msg)
+    collector.invalidate()
     return redirect(url_for('dash'))
 
 @app.route('/status', methods=['GET', 'POST'])
 @flask_login.login_required
 def status():
-    # lance l'outil scanner et pipe sa sortie sur rep
-    rep = subprocess.Popen(['python3', PATH+'/lms/scanner.py', '-i', ip, '-p', port, 'status'],\
-        stdout=subprocess.PIPE)
-    msg = rep.communicate()[0].decode() # lis le stdout de l'outil scanner dans msg
+    rep = call('status')
+    msg = ' '.join(str(code) for code in rep['codes']) if rep['ok'] else rep['error']
     status_info['status_code'] = msg # met a jour les infos de connexion
     events.append(time.strftime('%d/%m/%Y %H:%M:%S', time.localtime()) + ' - STATUS: ' +\
         msg)
+    collector.invalidate()
     return redirect(url_for('dash'))
 
 @app.route('/start', methods=['GET', 'POST'])
 @flask_login.login_required
 def start():
+    dashState()
     if not scanner_isavailable():
         events.append(time.strftime('%d/%m/%Y %H:%M:%S', time.localtime()) +\
         ' - START: Telemetre pas encore pret pour acquisition')
     else:
-        # lance l'outil scanner sur un procesus separe (start est bloquant)
-        multiprocessing.Process(target=pstart).start()
-        events.append(time.strftime('%d/%m/%Y %H:%M:%S', time.localtime()) + ' - START: ')
+        # la configuration et l'attente du telemetre pret peuvent prendre quelques secondes
+        rep = call('start', timeout=60, load='config.ini')
+        events.append(time.strftime('%d/%m/%Y %H:%M:%S', time.localtime()) + ' - START: ' +\
+            (rep['path'] if rep['ok'] else rep['error']))
+        collector.invalidate()
     return redirect(url_for('dash'))
 
-def pstart():
-    subprocess.Popen(['python3', PATH+'/lms/scanner.py', '-i', ip, '-p', port, '-l', 'config.ini', 'start'],\
-        stdout=subprocess.PIPE)
-
 @app.route('/stop', methods=['GET', 'POST'])
 @flask_login.login_required
 def stop():
-    # lance l'outil scanner et pipe sa sortie sur rep
-    rep = subprocess.Popen(['python3', PATH+'/lms/scanner.py', '-i', ip, '-p', port, 'stop'],\
-        stdout=subprocess.PIPE)
+    # le daemon termine les blocs en cours en tache de fond
+    rep = call('stop', wait=False)
     events.append(time.strftime('%d/%m/%Y %H:%M:%S', time.localtime()) + ' - STOP: ' +\
-        rep.communicate()[0].decode()) # lis le stdout de l'outil scan et l'ajoute a la file d'evenements
+        (rep['path'] if rep['ok'] else rep['error']))
+    collector.invalidate()
     return redirect(url_for('dash'))
 
 @app.route('/crash', methods=['GET', 'POST'])
 @flask_login.login_required
 def crash():
-    # lance l'outil scanner et pipe sa sortie sur rep
-    rep = subprocess.Popen(['python3', PATH+'/lms/scanner.py', '-i', ip, '-p', port, 'crash'],\
-        stdout=subprocess.PIPE)
+    rep = call('crash', timeout=30)
     events.append(time.strftime('%d/%m/%Y %H:%M:%S', time.localtime()) + ' - CRASH: ' +\
-        rep.communicate()[0].decode()) # lis le stdout de l'outil scan et l'ajoute a la file d'evenements
+        (rep['path'] if rep['ok'] else rep['error']))
+    collector.invalidate()
     return redirect(url_for('dash'))
 
 @app.route('/ping', methods=['GET', 'POST'])
@@ -217,13 +279,11 @@ def ping():
         reponse a la variable globale ip
     """
     # recupere l'adresse de broadcast d'eth0
-    rep = subprocess.Popen('ip addr|grep eth0|grep brd', shell=True, stdout=subprocess.PIPE)
-    brd = rep.communicate()[0].decode()
-    if brd == '':
+    brd = broadcastAddress('eth0')
+    if brd is None:
         events.append(time.strftime('%d/%m/%Y %H:%M:%S', time.localtime()) +\
             " - PING: Interface eth0 non connectée")
         return redirect(url_for('dash'))
-    brd = brd.split(' ')[7]
 
     # ping l'adresse de broadcast
     rep = subprocess.Popen(['ping', '-b', brd, '-I', 'eth0', '-c', '1'],\
@@ -268,28 +328,17 @@ def scanner_isavailable():
 
     return True
 
-def check_storage():
-    """
-        Verifie l'etat du stockage de /dev/sda1 et affiche le pourcentage utilise
+def broadcastAddress(ifname):
     """
-    rep = subprocess.Popen('df -kh /dev/sda1', shell=True, stdout=subprocess.PIPE)
-    rep = rep.communicate()[0].decode().split(' ')
-    for elt in reversed(rep):
-        if elt.endswith('%'):
-            global status_info
-            status_info['storage'] = elt[0:-1]
-            break
-
-def isRecording():
+        Retourne l'adresse de broadcast de l'interface ifname (ioctl SIOCGIFBRDADDR)
+        @return: adresse ou None si l'interface n'est pas configuree
     """
-        Verifie si un enregistrement est en cours
-    """
-    rep = subprocess.Popen('ps -ef|grep scanner.py', shell=True, stdout=subprocess.PIPE)
-    rep = rep.communicate()[0].decode()
-    if 'python3' in rep.split():
-        return 'yes'
-    else:
-        return None
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        try:
+            req = fcntl.ioctl(sock.fileno(), 0x8919, struct.pack('256s', ifname.encode()[:15]))
+        except OSError:
+            return None
+    return socket.inet_ntoa(req[20:24])
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0')
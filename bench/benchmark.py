@@ -0,0 +1,226 @@
+"""
+    Banc de mesure du debit de l'acquisition (scanner.py start)
+    Pour chaque combinaison de reglages, un simulateur de LMS 5xx (fakelms.py) est
+    demarre puis scanner.py enregistre ses trames pendant une duree fixe. Le banc
+    mesure le debit soutenu, la charge CPU et la memoire de l'enregistreur (processus
+    de compression compris), la profondeur max des files de compression et les
+    trames perdues (trous dans les compteurs de scan des blocs enregistres) et le
+    taux de compression des blocs
+    Exemple : python3 benchmark.py -f 25 50 100 -r 0.5 0.25 -e 1 5 --rssi 0 1
+"""
+
+import argparse
+import itertools
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lms'))
+from framer import TelegramFramer
+from compression import openBlock, CODECS, EXTENSIONS, isDelta
+try:
+    from delta import RecordReader
+except ImportError: # numpy absent, format delta indisponible
+    RecordReader = None
+from fakelms import FakeLMS
+
+SCANNER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lms', 'scanner.py')
+TICKS = os.sysconf('SC_CLK_TCK')
+PAGE = os.sysconf('SC_PAGE_SIZE')
+
+def procStat(pid):
+    """
+        Retourne le PID du pere, le temps CPU (ticks) et la memoire residente (octets)
+        du processus pid, None si le processus n'existe plus
+    """
+    try:
+        with open('/proc/%d/stat' % pid, 'r') as fic:
+            fields = fic.read().rsplit(')', 1)[1].split()
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+    # champs a partir de l'etat (3e champ de /proc/<pid>/stat)
+    return int(fields[1]), int(fields[11]) + int(fields[12]), int(fields[21]) * PAGE
+
+def processTree(pid):
+    """
+        Retourne le temps CPU (ticks) et la memoire residente (octets) cumules
+        du processus pid et de ses descendants
+    """
+    stats = {}
+    for name in os.listdir('/proc'):
+        if name.isdigit():
+            stat = procStat(int(name))
+            if stat is not None:
+                stats[int(name)] = stat
+    tree = {pid}
+    changed = True
+    while changed:
+        children = {p for p, stat in stats.items() if stat[0] in tree} - tree
+        tree |= children
+        changed = bool(children)
+    cpu = sum(stats[p][1] for p in tree if p in stats)
+    rss = sum(stats[p][2] for p in tree if p in stats)
+    return cpu, rss
+
+def countFrames(session):
+    """
+        Compte les trames enregistrees dans les blocs du dossier session
+        @return: nb de trames, nb de scans entre la premiere et la derniere trame,
+            taille des blocs (octets)
+    """
+    count, span, last, size = 0, 0, None, 0
+    for name in sorted(os.listdir(session)):
+        if os.path.splitext(name)[1] not in EXTENSIONS:
+            continue
+        path = os.path.join(session, name)
+        size += os.path.getsize(path)
+        framer = TelegramFramer()
+        reader = None
+        if isDelta(path): # blocs au format delta
+            if RecordReader is None:
+                raise RuntimeError("numpy n'est pas installe, lecture de "+path+" impossible")
+            reader = RecordReader()
+        with openBlock(path) as fil:
+            for chunk in iter(lambda: fil.read(1 << 20), b''):
+                if reader is not None:
+                    chunk = b''.join(reader.feed(chunk))
+                for frame in framer.feed(chunk):
+                    scan = int(bytes(frame).split(b' ', 9)[8], 16)
+                    if last is not None:
+                        span += (scan - last) % (1 << 16) # compteur sur 16 bits
+                    last = scan
+                    count += 1
+    return count, span + 1 if count else 0, size
+
+def run(params, args):
+    """
+        Mesure une combinaison de reglages
+        @param params: dict frequency, resolution, echoes, rssi
+        @return: resultats de la mesure (totaux de tous les telemetres simules)
+        @rtype: dict
+    """
+    dest = tempfile.mkdtemp(prefix='lmsbench', dir=args.dest)
+    servers = [FakeLMS(params['frequency'], params['resolution'], echoes=params['echoes'],\
+        rssi=params['rssi']) for _ in range(args.scanners)]
+    hosts = []
+    for lms in servers:
+        hosts += ['-i', '127.0.0.1:'+str(lms.start())]
+    proc = subprocess.Popen([sys.executable, SCANNER] + hosts + ['-d', dest,\
+        '-s', str(args.size), '-w', str(args.workers), '-q', str(args.queue),\
+        '-z', args.codec] + (['--delta'] if args.delta else []) + ['start'],\
+        stdout=subprocess.DEVNULL)
+
+    # attend le debut de l'envoi continu (configuration des telemetres simules)
+    deadline = time.monotonic() + 30
+    while not all([lms.streaming for lms in servers]) and proc.poll() is None\
+        and time.monotonic() < deadline:
+        time.sleep(0.05)
+    if not all([lms.streaming for lms in servers]):
+        proc.kill()
+        for lms in servers:
+            lms.shutdown()
+        raise RuntimeError("L'enregistreur n'a pas demarre l'acquisition")
+
+    start = time.monotonic()
+    cpu0, peak = processTree(proc.pid)
+    cpu = cpu0
+    while time.monotonic() - start < args.duration and proc.poll() is None:
+        time.sleep(args.interval)
+        cpu, rss = processTree(proc.pid)
+        peak = max(peak, rss)
+    elapsed = time.monotonic() - start
+
+    proc.send_signal(signal.SIGUSR1) # arret propre de l'enregistreur
+    proc.wait()
+    for lms in servers:
+        lms.shutdown()
+
+    session = os.path.join(dest, os.listdir(dest)[0])
+    with open(os.path.join(session, 'stats.json'), 'r') as fic:
+        stats = json.load(fic)
+    count, expected, size = 0, 0, 0
+    for dev in stats['devices']:
+        # un sous-dossier par telemetre s'il y en a plusieurs
+        n, span, blocks = countFrames(os.path.join(session, dev['name']) if args.scanners > 1\
+            else session)
+        count += n
+        expected += span
+        size += blocks
+    raw = sum([dev['bytes'] for dev in stats['devices']])
+
+    res = dict(params)
+    res.update({'scanners': args.scanners, 'frameSize': len(servers[0].telegram()),\
+        'recorded': count,\
+        'fps': round(count / stats['duration'], 1) if stats['duration'] else 0,\
+        'cpu': round(100 * (cpu - cpu0) / TICKS / elapsed, 1),\
+        'peakRss': round(peak / (1 << 20), 1), 'maxDepth': stats['compression']['maxDepth'],\
+        'blocked': stats['compression']['blocked'],\
+        'blockedTime': stats['compression']['blockedTime'], 'lost': expected - count,\
+        'ratio': round(raw / size, 2) if size else 0,\
+        'ringHighWater': stats['ring']['highWater'], 'ringOverflows': stats['ring']['overflows'],\
+        'recorderLost': sum([dev['gaps']['lost'] for dev in stats['devices']]),\
+        'serverDropped': sum([lms.stats()['dropped'] for lms in servers]),\
+        'resyncs': sum([dev['framer']['resyncs'] for dev in stats['devices']]),\
+        'devices': [{k: dev[k] for k in ('name', 'frames', 'fps', 'throughput')}\
+            for dev in stats['devices']]})
+    if args.keep:
+        print('Donnees conservees dans', dest)
+    else:
+        shutil.rmtree(dest)
+    return res
+
+COLUMNS = ('frequency', 'resolution', 'echoes', 'rssi', 'frameSize', 'fps', 'cpu', 'peakRss',\
+    'maxDepth', 'blocked', 'lost', 'ratio')
+
+def main():
+    parser = argparse.ArgumentParser(description="Banc de mesure du debit d'acquisition")
+    parser.add_argument('-f', '--frequency', nargs='+', default=[50], type=float,\
+        help='Frequences de scan a tester (Hz)')
+    parser.add_argument('-r', '--resolution', nargs='+', default=[0.5], type=float,\
+        help='Resolutions angulaires a tester (degres)')
+    parser.add_argument('-e', '--echoes', nargs='+', default=[1], type=int,\
+        help="Nombres d'echos a tester")
+    parser.add_argument('--rssi', nargs='+', default=[1], type=int, choices=[0, 1],\
+        help='Canaux de remission (0 : sans, 1 : avec)')
+    parser.add_argument('-n', '--scanners', default=1, type=int,\
+        help='Nombre de telemetres simules enregistres en meme temps')
+    parser.add_argument('-t', '--duration', default=20, type=float,\
+        help='Duree de chaque mesure (s)')
+    parser.add_argument('--interval', default=0.5, type=float,\
+        help="Periode d'echantillonnage CPU et memoire (s)")
+    parser.add_argument('-s', '--size', default=500000, type=int, help='Nombre de trames par bloc')
+    parser.add_argument('-w', '--workers', default=2, type=int,\
+        help='Nombre de processus de compression')
+    parser.add_argument('-q', '--queue', default=2000, type=int,\
+        help="Nombre max de trames en attente de compression par processus")
+    parser.add_argument('-z', '--codec', default='xz', choices=list(CODECS),\
+        help='Codec de compression des blocs')
+    parser.add_argument('--delta', action='store_true',\
+        help='Blocs au format delta (mesures en colonnes, differences entre scans)')
+    parser.add_argument('-d', '--dest', default=None,\
+        help="Dossier temporaire d'enregistrement (support a tester)")
+    parser.add_argument('-k', '--keep', action='store_true', help='Conserve les blocs enregistres')
+    parser.add_argument('-o', '--output', default=None, help='Enregistre les resultats en JSON')
+    args = parser.parse_args()
+
+    print(' '.join('%11s' % col for col in COLUMNS))
+    results = []
+    for frequency, resolution, echoes, rssi in itertools.product(args.frequency,\
+        args.resolution, args.echoes, args.rssi):
+        res = run({'frequency': frequency, 'resolution': resolution, 'echoes': echoes,\
+            'rssi': bool(rssi)}, args)
+        results.append(res)
+        print(' '.join('%11s' % res[col] for col in COLUMNS))
+
+    if args.output is not None:
+        with open(args.output, 'w') as fic:
+            json.dump({'codec': args.codec, 'delta': args.delta, 'workers': args.workers, 'queue': args.queue,\
+                'scanners': args.scanners, 'results': results}, fic, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""
+    Simulateur de LMS 5xx (protocole CoLa-A) pour tester l'acquisition sans telemetre
+    Le serveur repond aux commandes utilisees par la classe LMS5xx et envoie des
+    trames LMDscandata synthetiques a la frequence demandee apres 'sEN LMDscandata 1'
+    Comme le vrai telemetre, une trame est perdue (mais ses compteurs avancent)
+    si la precedente n'a pas pu etre envoyee faute de place dans le socket
+"""
+
+import argparse
+import os
+import sys
+import time
+import random
+import select
+import socket
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lms'))
+from framer import TelegramFramer
+
+def hexa(value, bits=32):
+    """
+        Retourne value en hexadecimal majuscule (complement a deux sur bits bits)
+        @rtype: str
+    """
+    return format(value & ((1 << bits) - 1), 'X')
+
+class FakeLMS:
+    """
+        Serveur TCP simulant un LMS 5xx
+        Un seul client est servi a la fois, dans un thread (start()) ou dans
+        le thread appelant (serve())
+    """
+    def __init__(self, frequency=50, resolution=0.5, start=-5, stop=185, echoes=1,\
+        rssi=True, variants=8):
+        """
+            @param frequency: frequence de scan (Hz)
+            @param resolution: resolution angulaire (degres)
+            @param start: angle de depart (degres)
+            @param stop: angle d'arret (degres)
+            @param echoes: nombre d'echos par mesure (canaux DIST1 a DIST5)
+            @param rssi: envoie les canaux de remission RSSIn
+            @param variants: nombre de jeux de mesures differents envoyes a tour de role
+        """
+        self.frequency = frequency
+        self.resolution = resolution
+        self.startAngle = start
+        self.stopAngle = stop
+        self.amount = int(round((stop - start) / resolution)) + 1 # mesures par canal
+        self.status = 7 # code d'etat renvoye par STlms (7 : en mesure)
+        self.streaming = False # envoi continu des trames
+        self.running = False
+        self.sock = None
+        self.thread = None
+        self.counter = 0 # compteur de trames et de scans
+        self.sent = 0 # trames envoyees
+        self.dropped = 0 # trames perdues (socket plein)
+        self.commands = 0 # commandes recues
+        self.bodies = [self.__body(echoes, rssi) for _ in range(variants)]
+
+    def __body(self, echoes, rssi):
+        """
+            Construit la partie mesures d'une trame (canaux DISTn puis RSSIn)
+            @rtype: bytes
+        """
+        names = ['DIST'+str(i+1) for i in range(echoes)]
+        if rssi:
+            names += ['RSSI'+str(i+1) for i in range(echoes)]
+        tokens = [hexa(0), hexa(len(names), 16)] # encodeurs, canaux 16 bits
+        for name in names:
+            tokens += [name, '3F800000', '00000000', hexa(int(self.startAngle*10000)),\
+                hexa(int(self.resolution*10000), 16), hexa(self.amount, 16)]
+            tokens += [hexa(random.randint(0, 65535), 16) for _ in range(self.amount)]
+        tokens += ['0', '0', '0', '0', '1'] # canaux 8 bits, position, nom, commentaire, date
+        return ' '.join(tokens).encode()
+
+    def telegram(self):
+        """
+            Construit la trame LMDscandata suivante
+            @rtype: bytes
+        """
+        now = time.time()
+        tps = time.localtime(now)
+        counter = hexa(self.counter, 16)
+        usec = int(now * 1000000) & 0xFFFFFFFF
+        head = ['sSN', 'LMDscandata', '1', '1', '10ABCD', '0', '0', counter, counter,\
+            hexa(usec), hexa(usec), '0', '0', '0', '0', '0', hexa(int(self.frequency*100)),\
+            hexa(int(self.frequency*self.amount/100))]
+        date = [hexa(tps.tm_year), hexa(tps.tm_mon), hexa(tps.tm_mday), hexa(tps.tm_hour),\
+            hexa(tps.tm_min), hexa(tps.tm_sec), hexa(int((now % 1) * 1000000)), '0']
+        body = self.bodies[self.counter % len(self.bodies)]
+        self.counter += 1
+        return b'\x02'+' '.join(head).encode()+b' '+body+b' '+' '.join(date).encode()+b'\x03'
+
+    def reply(self, command):
+        """
+            Retourne la reponse a une commande CoLa-A (sans STX/ETX)
+            @param command: commande recue (sans STX/ETX)
+            @rtype: bytes
+        """
+        tokens = command.split()
+        name = b' '.join(tokens[:2])
+        scancfg = [hexa(int(self.frequency*100)), '1', hexa(int(self.resolution*10000)),\
+            hexa(int(self.startAngle*10000)), hexa(int(self.stopAngle*10000))]
+        if name == b'sEN LMDscandata':
+            self.streaming = len(tokens) > 2 and tokens[2] == b'1'
+            return b'sEA LMDscandata '+(b'1' if self.streaming else b'0')
+        if name == b'sMN LMCstartmeas':
+            self.status = 7
+            return b'sAN LMCstartmeas 0'
+        if name == b'sMN LMCstopmeas':
+            self.status = 6
+            return b'sAN LMCstopmeas 0'
+        if name == b'sRN STlms':
+            return b'sRA STlms '+hexa(self.status).encode()+b' 0 8 00:00:00 8 01.01.1970 0 0 0'
+        if name == b'sRN LMPscancfg':
+            return b'sRA LMPscancfg '+' '.join(scancfg).encode()
+        if name == b'sMN mLMPsetscancfg':
+            return b'sAN mLMPsetscancfg 0 '+' '.join(scancfg).encode()
+        if name == b'sMN Run': # fin de la configuration, le telemetre remesure
+            self.status = 7
+            return b'sAN Run 1'
+        if name in (b'sMN SetAccessMode', b'sMN LSPsetdatetime', b'sMN mEEwriteall'):
+            return b'sAN '+tokens[1]+b' 1'
+        if tokens[:1] == [b'sWN']:
+            return b'sWA '+tokens[1]
+        return b'sFA 0' # commande inconnue
+
+    def serve(self, host='', port=2111):
+        """
+            Ecoute sur host:port et sert les clients jusqu'a l'appel de shutdown()
+        """
+        self.bind(host, port)
+        self.__loop()
+
+    def bind(self, host='', port=2111):
+        """
+            Ouvre le socket d'ecoute
+            @return: port d'ecoute (utile si port=0)
+        """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(1)
+        self.running = True
+        return self.sock.getsockname()[1]
+
+    def start(self, host='127.0.0.1', port=0):
+        """
+            Demarre le serveur dans un thread
+            @return: port d'ecoute
+        """
+        port = self.bind(host, port)
+        self.thread = threading.Thread(target=self.__loop, daemon=True)
+        self.thread.start()
+        return port
+
+    def shutdown(self):
+        """
+            Arrete le serveur
+        """
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        self.sock.close()
+
+    def __loop(self):
+        while self.running:
+            read, _, _ = select.select((self.sock,), (), (), 0.2)
+            if read:
+                conn, _ = self.sock.accept()
+                self.__client(conn)
+                conn.close()
+
+    def __client(self, conn):
+        """
+            Sert un client : commandes et envoi des trames dans une seule boucle
+            Les reponses et les trames sont envoyees dans l'ordre par le tampon out
+        """
+        conn.setblocking(False)
+        self.streaming = False
+        framer = TelegramFramer(1 << 12)
+        out = bytearray()
+        period = 1 / self.frequency
+        tick = time.monotonic()
+        while self.running:
+            wait = max(0, tick - time.monotonic()) if self.streaming else 0.2
+            read, write, _ = select.select((conn,), (conn,) if out else (), (), wait)
+            if read:
+                try:
+                    n = conn.recv_into(framer.writable())
+                except ConnectionError:
+                    return
+                if n == 0:
+                    return # deconnexion du client
+                framer.commit(n)
+                for command in iter(framer.next, None):
+                    self.commands += 1
+                    streaming = self.streaming
+                    out += b'\x02'+self.reply(bytes(command[1:-1]))+b'\x03'
+                    if self.streaming and not streaming: # debut de l'envoi continu
+                        tick = time.monotonic()
+            if write:
+                try:
+                    del out[:conn.send(out)]
+                except ConnectionError:
+                    return
+            if self.streaming and time.monotonic() >= tick:
+                tick += period
+                frame = self.telegram()
+                if len(out) > len(frame): # la trame precedente n'est pas partie
+                    self.dropped += 1
+                else:
+                    out += frame
+                    self.sent += 1
+
+    def stats(self):
+        """
+            Retourne les statistiques d'envoi
+            @rtype: dict
+        """
+        return {'sent': self.sent, 'dropped': self.dropped, 'counter': self.counter,\
+            'commands': self.commands}
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulateur de LMS 5xx (CoLa-A)')
+    parser.add_argument('-p', '--port', default=2111, type=int, help="Port d'ecoute")
+    parser.add_argument('-f', '--frequency', default=50, type=float, help='Frequence de scan (Hz)')
+    parser.add_argument('-r', '--resolution', default=0.5, type=float,\
+        help='Resolution angulaire (degres)')
+    parser.add_argument('-e', '--echoes', default=1, type=int, choices=range(1, 6),\
+        help="Nombre d'echos par mesure")
+    parser.add_argument('--rssi', action='store_true', help='Envoie les canaux de remission')
+    args = parser.parse_args()
+
+    lms = FakeLMS(args.frequency, args.resolution, echoes=args.echoes, rssi=args.rssi)
+    print('Ecoute sur le port', args.port)
+    try:
+        lms.serve('', args.port)
+    except KeyboardInterrupt:
+        pass
+    print(lms.stats())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+    Collecte de l'etat du systeme en tache de fond pour l'interface web
+    Les pages et /api/status lisent l'etat en cache, sans lancer de commande shell
+    ni attendre le telemetre, meme quand le Raspberry Pi est occupe a compresser
+"""
+
+import os
+import sys
+import time
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lms'))
+from control import call
+
+# fichier pid ecrit par scanner.py start (enregistrement lance sans le daemon)
+PIDFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lms', 'pid')
+
+def storageUsage(path):
+    """
+        Retourne le pourcentage utilise du systeme de fichiers contenant path
+        (meme calcul que df : place reservee a root exclue)
+        @return: pourcentage arrondi ou None si path n'est pas monte
+    """
+    try:
+        st = os.statvfs(path)
+    except OSError:
+        return None
+    used = st.f_blocks - st.f_bfree
+    total = used + st.f_bavail
+    return round(100 * used / total) if total else None
+
+def pidAlive(path=PIDFILE):
+    """
+        Retourne True si le processus dont le pid est dans le fichier path existe
+    """
+    try:
+        with open(path, 'r') as pidfile:
+            os.kill(int(pidfile.read()), 0)
+    except (OSError, ValueError):
+        return False
+    return True
+
+class StatusCollector(threading.Thread):
+    """
+        Met a jour periodiquement l'etat du stockage, de l'enregistrement et du
+        telemetre. Le code d'etat du telemetre est garde ttl secondes pour ne pas
+        l'interroger a chaque cycle
+    """
+    def __init__(self, storage='/media/usb/', interval=2, ttl=10):
+        """
+            @param storage: point de montage du stockage des mesures
+            @param interval: periode de mise a jour (s)
+            @param ttl: duree de validite du code d'etat du telemetre (s)
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.storage = storage
+        self.interval = interval
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.state = {'storage': None, 'recording': False, 'path': None, 'codes': [],\
+            'codesAge': None, 'stats': None, 'daemon': False, 'updated': None}
+        self.codesTime = None # date de la derniere lecture du code d'etat
+        self.refresh = threading.Event() # force une mise a jour immediate
+
+    def run(self):
+        while True:
+            self.update()
+            self.refresh.wait(self.interval)
+            self.refresh.clear()
+
+    def update(self):
+        """
+            Met a jour l'etat en cache
+        """
+        state = {'storage': storageUsage(self.storage)}
+        rep = call('stats', timeout=1)
+        state['daemon'] = rep['ok']
+        if rep['ok']:
+            state['recording'] = rep['recording']
+            state['path'] = rep['path']
+            state['stats'] = rep['stats']
+        else:
+            state['recording'] = False
+        # enregistrement lance par scanner.py en ligne de commande
+        state['recording'] = state['recording'] or pidAlive()
+
+        now = time.monotonic()
+        if rep['ok'] and (self.codesTime is None or now - self.codesTime > self.ttl):
+            rep = call('status', timeout=3)
+            state['codes'] = rep['codes'] if rep['ok'] else []
+            self.codesTime = now
+        state['codesAge'] = None if self.codesTime is None else round(now - self.codesTime, 1)
+        state['updated'] = time.strftime('%d/%m/%Y %H:%M:%S', time.localtime())
+        with self.lock:
+            self.state.update(state)
+
+    def invalidate(self):
+        """
+            Demande une mise a jour immediate (apres une commande de l'utilisateur)
+        """
+        self.codesTime = None
+        self.refresh.set()
+
+    def get(self):
+        """
+            Retourne une copie de l'etat en cache
+            @rtype: dict
+        """
+        with self.lock:
+            return dict(self.state)
@@ -1,8 +1,23 @@
 import argparse
 import os
+import sys
 import lzma
 import configparser
-from collections import deque
+import json
+
+# modules partages avec l'outil d'acquisition
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lms'))
+from framer import TelegramFramer, BinaryFramer
+from cola import decodeScanData
+from archive import ArchiveWriter
+from compression import openBlock, EXTENSIONS, PART, DELTA, isDelta
+from delta import RecordReader
+from recover import makeDecompressor
+from gaps import GapTracker, frameCounters
+from summary import BlockSummary, ScanRange, loadIndex, selectBlocks, selectChunks,\
+    writeIndex, INDEX
+import numpy as np
+import decoder
 
 def fileList(path):
     """
@@ -15,64 +30,298 @@ def fileList(path):
         """
         if filename.startswith('.'):
             return False
-        if not filename.endswith('.txt.xz'):
+        # trames ASCII (.txt) ou CoLa-B (.bin) compressees avec un codec connu
+        base, ext = os.path.splitext(filename)
+        if ext not in EXTENSIONS:
+            return False
+        if base.endswith(DELTA): # blocs au format delta
+            base = base[:-len(DELTA)]
+        if not base.endswith('.txt') and not base.endswith('.bin'):
             return False
         # TODO rajouter d'autres tests
         return True
 
     # liste des fichiers dans path
     files = os.listdir(os.path.join(os.path.dirname(__file__), path))
+    # blocs interrompus (crash, coupure de courant) a recuperer avant lecture
+    parts = [fil for fil in files if fil.endswith(PART)]
+    if parts:
+        print(len(parts), 'bloc(s) interrompu(s) ignore(s) dans', path,\
+            ': lancer lms/recover.py pour les recuperer')
     # filtre les fichiers non valides
     valid = list(filter(isValid, files))
     return sorted(valid)
 
-def parseDatagrams(buff, echo, RSSI, minsize=1000,):
+def checkDatagram(dat, dist, rssi, minsize=1000):
     """
-        retourne la liste des trames valides lues dans buff
+        Verifie l'integrite d'une trame ASCII (sans STX ni ETX)
         {stx}___minsize bytes__{etx}
         verifie la presence des balises DISTn et RSSIn selon les parametres
+        @param dat: trame
+        @param dist: balise DISTn attendue (bytes)
+        @param rssi: balise RSSIn attendue (bytes) ou None
     """
-    dist = 'DIST'+str(echo)
-
-    res = deque() # liste des trames valides
-    init = buff.split(b'\x03') # decoupe le buffer autours des ETX
-
-    # donnees avec RSSI
-    if RSSI is True:
-        rssi = 'RSSI'+str(echo)
-        for i in init:
-            dat = i.split(b'\x02')[-1].decode() # trame commencant par un STX le plus pres de l'ETX
-            # verifications d'integrite
-            if len(dat) < minsize:
-                continue
-            if not rssi in dat:
-                continue
-            if not dist in dat:
-                continue
-            if not 'LMDscandata' in dat:
-                continue
-            res.append(dat)
-        mini = min([len(x.split()) for x in res])
-        maxi = max([len(x.split()) for x in res])
-        if mini != maxi:
-            print('Erreur détectée dans le fichier de sortie suivant')
-        return res
-    # donnees sans RSSI
-    for i in init:
-        dat = i.split(b'\x02')[-1].decode()
-        if len(dat) < minsize:
-            continue
-        if not dist in dat:
-            continue
-        if not 'LMDscandata' in dat:
-            continue
-        res.append(dat)
+    if len(dat) < minsize:
+        return False
+    if rssi is not None and not rssi in dat:
+        return False
+    if not dist in dat:
+        return False
+    if not b'LMDscandata' in dat:
+        return False
+    return True
+
+# en-tete d'un fichier xz
+XZ_MAGIC = b'\xfd7zXZ\x00'
+
+def readBlock(path, chunk=1 << 20, ranges=None, onChunk=None):
+    """
+        Lis le fichier compresse path par morceaux d'au plus chunk octets decompresses
+        Le codec (xz, gzip, zstd, lz4) est deduit de l'extension du fichier
+        Les anciens enregistrements sont compresses deux fois (flux xz dans un
+        fichier xz), la deuxieme couche est detectee et decompressee au fil de l'eau
+        Les trames des blocs au format delta sont reconstruites (readDelta())
+        @param ranges: (position, taille) des morceaux du bloc a lire (index des
+            morceaux, voir summary.selectChunks()), None pour lire tout le bloc
+        @param onChunk: fonction appelee avec (position, taille) de chaque morceau
+            lu, apres ses donnees
+        @return: generateur de bytes
+    """
+    if (ranges is None and onChunk is None) or doubled(path):
+        data = readStream(path, chunk)
+    else:
+        data = readChunks(path, ranges, chunk, onChunk)
+    if isDelta(path):
+        data = readDelta(data, path)
+    yield from data
+
+def doubled(path):
+    """
+        Retourne True si le bloc est compresse deux fois (anciens enregistrements)
+    """
+    if not path.endswith('.xz'):
+        return False
+    with openBlock(path) as fic:
+        return fic.read(len(XZ_MAGIC)) == XZ_MAGIC
+
+def readStream(path, chunk=1 << 20):
+    """
+        Lis tout le fichier compresse path comme un seul flux (morceaux concatenes)
+        @return: generateur de bytes
+    """
+    with openBlock(path) as fic:
+        raw = fic.read(chunk)
+        if not raw.startswith(XZ_MAGIC):
+            while raw:
+                yield raw
+                raw = fic.read(chunk)
+            return
 
-    mini = min([len(x.split()) for x in res])
-    maxi = max([len(x.split()) for x in res])
-    if mini != maxi:
-        print('Erreur détectée dans le fichier de sortie suivant')
-    return res
+        inner = lzma.LZMADecompressor()
+        while raw:
+            yield inner.decompress(raw, chunk)
+            while not inner.needs_input and not inner.eof:
+                yield inner.decompress(b'', chunk)
+            raw = fic.read(chunk)
+
+def readChunks(path, ranges=None, chunk=1 << 20, onChunk=None):
+    """
+        Lis les morceaux independants d'un bloc (voir compression.BlockWriter)
+        Avec ranges, seuls les morceaux indiques sont lus : le fichier est lu a
+        partir de la position de chaque morceau, le debut du bloc n'est pas
+        decompresse. Sans ranges, les morceaux sont lus l'un apres l'autre et leurs
+        positions sont retrouvees a la fin de chaque flux du codec
+        @param ranges: (position, taille) des morceaux a lire, None pour tout le bloc
+        @param chunk: taille des lectures dans le fichier compresse
+        @param onChunk: fonction appelee avec (position, taille) de chaque morceau lu
+        @return: generateur de bytes
+    """
+    with open(path, 'rb') as fic:
+        if ranges is not None:
+            for offset, size in ranges:
+                fic.seek(offset)
+                dec = makeDecompressor(path)
+                remaining = size
+                while remaining > 0:
+                    raw = fic.read(min(chunk, remaining))
+                    if not raw:
+                        break
+                    remaining -= len(raw)
+                    data = dec.decompress(raw)
+                    if data:
+                        yield data
+                if remaining > 0 or not dec.eof:
+                    print('Morceau tronque dans', path, 'a la position', offset)
+                elif onChunk is not None:
+                    onChunk((offset, size))
+            return
+
+        dec = makeDecompressor(path)
+        start = 0 # position du morceau en cours
+        pos = 0 # octets donnes au decompresseur
+        raw = fic.read(chunk)
+        while raw:
+            pos += len(raw)
+            data = dec.decompress(raw)
+            if data:
+                yield data
+            if dec.eof: # fin d'un morceau, la suite commence un nouveau morceau
+                raw = dec.unused_data
+                pos -= len(raw)
+                if onChunk is not None:
+                    onChunk((start, pos - start))
+                start = pos
+                dec = makeDecompressor(path)
+                if raw:
+                    continue
+            raw = fic.read(chunk)
+        if pos > start:
+            print('Dernier morceau tronque dans', path, ':', pos - start, 'octets')
+
+def readDelta(raw, path):
+    """
+        Reconstruit les trames d'un bloc au format delta (module delta) a l'octet
+        pres (colonnes de mesures cumulees scan par scan)
+        @param raw: enregistrements decompresses (generateur de bytes)
+        @param path: chemin du bloc
+        @return: generateur de bytes (trames completes)
+    """
+    reader = RecordReader()
+    for data in raw:
+        frames = reader.feed(data)
+        if frames:
+            yield b''.join(frames)
+    if reader.pending():
+        print('Dernier groupe de trames tronque dans', path, ':', reader.pending(), 'octets')
+
+def binaryGeometry(frame):
+    """
+        Retourne la geometrie d'une trame CoLa-B : noms des canaux et nombres de mesures
+    """
+    channels = decodeScanData(frame)['channels']
+    return tuple((name, ch['amount']) for name, ch in channels.items())
+
+class OutputFiles:
+    """
+        Ecriture des trames dans des fichiers out0, out1... de taille limitee
+        Un nouveau fichier est commence des que la taille max est atteinte ou que
+        la geometrie des trames change (split())
+    """
+    def __init__(self, dstdir, ext, size):
+        """
+            @param dstdir: dossier de destination
+            @param ext: extension des fichiers ('.txt' ou '.bin')
+            @param size: taille max d'un fichier en octets
+        """
+        self.dstdir = dstdir
+        self.ext = ext
+        self.size = size
+        self.n = 0 # compteur de fichiers
+        self.out = None # fichier courant
+        self.written = 0 # octets ecrits dans le fichier courant
+
+    def write(self, data):
+        """
+            Ecris data dans le fichier courant, change de fichier si necessaire
+        """
+        if self.out is not None and self.written + len(data) > self.size:
+            self.close()
+            self.n += 1
+        if self.out is None:
+            filename = os.path.join(self.dstdir, 'out'+str(self.n)+self.ext)
+            print(filename)
+            self.out = open(filename, 'wb')
+            self.written = 0
+        self.out.write(data)
+        self.written += len(data)
+
+    def split(self):
+        """
+            Les trames suivantes sont ecrites dans un nouveau fichier
+            @return: True
+        """
+        if self.out is not None:
+            self.close()
+            self.n += 1
+        return True
+
+    def close(self):
+        """
+            Ferme le fichier courant
+        """
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+
+class ArchiveOutput:
+    """
+        Ecriture des trames dans l'archive binaire a acces direct 'archive' (module archive)
+        Les trames sont decodees par lots d'environ chunk octets
+    """
+    def __init__(self, dstdir, binary, chunk=1 << 23):
+        """
+            @param dstdir: dossier de destination
+            @param binary: trames CoLa-B
+            @param chunk: taille des lots de trames decodes
+        """
+        self.path = os.path.join(dstdir, 'archive')
+        self.binary = binary
+        self.chunk = chunk
+        self.frames = [] # trames en attente de decodage
+        self.size = 0 # taille des trames en attente
+        self.writer = None # cree avec la premiere trame (liste des canaux)
+        self.layout = None # position des elements des trames ASCII
+
+    def write(self, data):
+        """
+            Ajoute une trame (ASCII terminee par un retour a la ligne ou CoLa-B)
+        """
+        if self.writer is None:
+            if self.binary:
+                channels = list(decodeScanData(data)['channels'])
+            else:
+                self.layout = decoder.Layout(data)
+                channels = list(self.layout.channels)
+            print(self.path)
+            self.writer = ArchiveWriter(self.path, channels)
+        self.frames.append(data)
+        self.size += len(data)
+        if self.size >= self.chunk:
+            self.__flush()
+
+    def split(self):
+        """
+            Les enregistrements de l'archive ont une taille fixe, une autre geometrie
+            de trames ne peut pas y etre ajoutee
+            @return: False
+        """
+        return False
+
+    def __flush(self):
+        if self.binary:
+            batch = decoder.decodeBinaryBatch(self.frames, self.writer.channels)
+        else:
+            batch = decoder.decodeBatch(b''.join(self.frames), self.layout, self.writer.channels)
+        self.writer.append(batch)
+        self.frames = []
+        self.size = 0
+
+    def close(self):
+        if self.frames:
+            self.__flush()
+        if self.writer is not None:
+            self.writer.close()
+
+def scanRange(text):
+    """
+        Lis un intervalle de compteurs de scans DEBUT:FIN (decimal ou 0x hexadecimal)
+        @rtype: ScanRange
+    """
+    try:
+        first, last = text.split(':')
+        return ScanRange(int(first, 0), int(last, 0))
+    except ValueError:
+        raise argparse.ArgumentTypeError('intervalle invalide : '+text+' (attendu DEBUT:FIN)')
 
 def main():
     parser = argparse.ArgumentParser(description="Outil de decompression des donnees")
@@ -86,12 +335,31 @@ def main():
         help="Nombre d'echos dans les donnees")
     parser.add_argument('--RSSI', default='False', action='store_true',\
         help='Verifier la presence des donnees de remission ?')
+    parser.add_argument('-f', '--format', default='txt', choices=['txt', 'archive'],\
+        help='Format en sortie : fichiers de trames ou archive a acces direct (numpy.memmap)')
+    parser.add_argument('--from', dest='start', default=None,\
+        help="Ne decompresse que les blocs mesures apres cette date (ex: 2018-06-01T10:00), "\
+        "selon l'index des blocs")
+    parser.add_argument('--to', dest='end', default=None,\
+        help="Ne decompresse que les blocs mesures avant cette date, selon l'index des blocs")
+    parser.add_argument('--reindex', action='store_true',\
+        help="Reconstruit l'index des blocs (blocks.jsonl) du dossier source, les lignes "\
+        "des blocs non decompresses sont gardees")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--seek', dest='scans', default=None, type=lambda s: ScanRange(int(s, 0)),\
+        help="Decompresse a partir de la trame de ce compteur de scans, seuls les morceaux "\
+        "utiles des blocs sont lus (index des morceaux)")
+    group.add_argument('--range', dest='scans', default=None, type=scanRange,\
+        help="Ne decompresse que les trames des compteurs de scans DEBUT:FIN, seuls les "\
+        "morceaux utiles des blocs sont lus (index des morceaux)")
     parser.add_argument('srcdir', nargs=1,\
         help='Dossier contenant les fichiers compresses')
     parser.add_argument('dstdir', nargs=1,\
         help='Dossier dans lequel stocker les fichiers decompresses')
 
     args = parser.parse_args()
+    if args.reindex and args.scans is not None:
+        parser.error("--reindex lit les blocs entiers, incompatible avec --seek/--range")
     srcdir = args.srcdir[0]
     dstdir = args.dstdir[0]
     size = args.size
@@ -105,44 +373,139 @@ def main():
     if args.offset + args.count > len(files):
         print('Mauvaise combinaison offset/nb de fichiers! Abandon...')
         return
-    if args.count is not 0:
+    if args.count != 0:
         files = files[args.offset:min(args.offset+args.count, len(files))]
+    start = None if args.start is None else np.datetime64(args.start)
+    end = None if args.end is None else np.datetime64(args.end)
+    dates = start is not None or end is not None
+    scans = args.scans
+    index = {}
+    if dates or scans is not None:
+        index = loadIndex(srcdir)
+        if not index:
+            print("Pas d'index des blocs ("+INDEX+"), tous les blocs sont decompresses")
+    if dates:
+        # les blocs hors de l'intervalle ne sont pas decompresses
+        selected = selectBlocks(files, index, start, end)
+        print(len(files) - len(selected), 'blocs hors intervalle ignores')
+        files = selected
+        if not files:
+            print('Aucun bloc dans cet intervalle')
+            return
+    rebuilt = {} # lignes de l'index reconstruites (--reindex) : nom du fichier -> ligne
 
     with open(os.path.join(srcdir, 'config.ini'), 'r') as srcconf:
         with open(os.path.join(dstdir, 'config.ini'), 'w') as dstconf:
             dstconf.write(srcconf.read())
 
-    buff = [] # buffer contenant la liste des trames valides lues
-    n = 0 # compteur de fichiers
-    ind = -1 # dans le cas ou on fait un seul fichier plus petit que size
+    binary = '.bin.' in files[0] # enregistrement au format CoLa-B
+    dist = bytes('DIST'+str(args.echo), encoding='utf8')
+    rssi = bytes('RSSI'+str(args.echo), encoding='utf8') if args.RSSI is True else None
+    if args.format == 'archive':
+        output = ArchiveOutput(dstdir, binary)
+    else:
+        output = OutputFiles(dstdir, '.bin' if binary else '.txt', size*10**6)
+    # nombre d'elements des trames ASCII, geometrie des trames CoLa-B : identiques
+    # dans un bloc, un changement entre deux blocs (mode degrade ou filtre de
+    # l'enregistreur) commence un nouveau fichier de sortie
+    ntok = None
+    geometry = None
+    errors = 0 # nombre de trames rejetees
+    gaps = GapTracker() # trames perdues pendant l'acquisition (compteurs de telegrammes)
+    blocks = [] # statistiques des trames perdues de chaque bloc
     for fil in files:
         path = os.path.join(srcdir, fil) # chemin complet du fichier courant
-        with lzma.open(path) as fic:
-            print(path)
-            raw = lzma.LZMADecompressor().decompress(fic.read()) # fichier decompresse
-            buff.extend(parseDatagrams(raw, args.echo, args.RSSI))
-            del raw
-            del path
-
-            ## creation des fichiers de taille fixe
-            w = len(buff[0]) # longeur en octet d'une trame
-            while w*len(buff) > size*10**6: # si la taille du buffer depasse la taille max
-                ind = int((size*10**6)/w) # nombre max de lignes pour respecter la taille max
-                filename = os.path.join(dstdir, 'out'+str(n)+'.txt')
-                print(filename)
-                with open(filename, 'w') as out:
-                    out.write('\n'.join(buff[:ind]))
-                    #out.flush()
-                n = n+1
-                buff = buff[ind:]
-                del out
-        del fic
-
-    # enregistre les donnees restantes
-    filename = os.path.join(dstdir, 'out'+str(n)+'.txt')
-    print(filename)
-    with open(filename, 'w') as out:
-        out.write('\n'.join(buff[:ind]))
+        # morceaux du bloc a lire (index des morceaux), None pour tout le bloc
+        if scans is not None:
+            ranges = scans.chunks(index.get(fil))
+        elif dates:
+            ranges = selectChunks(index.get(fil), start, end)
+        else:
+            ranges = None
+        if args.reindex: # l'index est reconstruit avec les blocs entiers
+            ranges = None
+        if ranges == []: # aucun morceau utile dans ce bloc
+            continue
+        print(path)
+        # les trames sont reconstituees au fil de la decompression, la memoire
+        # utilisee ne depend pas de la taille des blocs
+        framer = BinaryFramer() if binary else TelegramFramer()
+        summary = None
+        chunks = [] # (position, taille) des morceaux lus pour l'index
+        if args.reindex:
+            summary = BlockSummary()
+            def onChunk(chunk):
+                summary.endChunk()
+                chunks.append(chunk)
+        else:
+            onChunk = None
+        first = True # premiere trame du bloc
+        rejected = False # trames du bloc rejetees (geometrie differente)
+        for raw in readBlock(path, ranges=ranges, onChunk=onChunk):
+            if scans is not None and scans.finished:
+                break
+            for frame in framer.feed(raw):
+                if scans is not None and not scans.keep(frameCounters(frame)):
+                    continue
+                if summary is not None:
+                    summary.update(frame)
+                if binary:
+                    if first:
+                        first = False
+                        current = binaryGeometry(frame)
+                        if geometry is None:
+                            geometry = current
+                        elif current != geometry:
+                            rejected = not output.split()
+                            if not rejected:
+                                print('Nouvelle geometrie des trames a partir de', fil)
+                                geometry = current
+                    if rejected:
+                        errors += 1
+                        continue
+                    gaps.update(frame)
+                    output.write(frame)
+                    continue
+                dat = frame[1:-1] # trame sans STX ni ETX
+                if not checkDatagram(dat, dist, rssi):
+                    errors += 1
+                    continue
+                count = dat.count(b' ')
+                if ntok is None:
+                    ntok = count
+                elif count != ntok:
+                    if not first or not output.split():
+                        errors += 1
+                        continue
+                    print('Nouvelle geometrie des trames a partir de', fil)
+                    ntok = count
+                first = False
+                gaps.update(dat)
+                output.write(dat+b'\n')
+        if summary is not None:
+            rebuilt[fil] = summary.result(fil, os.path.getsize(path), chunks or None)
+        stats = framer.stats()
+        if stats['dropped'] > 0:
+            print('Donnees invalides :', stats)
+        block = gaps.mark()
+        blocks.append(dict(block, file=fil))
+        if block['lost'] > 0:
+            print(block['lost'], 'trames perdues :', block)
+        if scans is not None and scans.finished:
+            break
+    output.close()
+    if args.reindex:
+        # les lignes des blocs non decompresses (--count, --offset, --from, --to) sont gardees
+        entries = loadIndex(srcdir)
+        entries.update(rebuilt)
+        writeIndex(srcdir, [entries[fil] for fil in sorted(entries)])
+        print(len(rebuilt), 'blocs reindexes dans', INDEX)
+    if errors > 0:
+        print(errors, 'trames rejetees')
+    if gaps.lost > 0:
+        print(gaps.lost, 'trames perdues pendant l\'acquisition ({:.3%})'.format(gaps.lossRate()))
+    with open(os.path.join(dstdir, 'gaps.json'), 'w') as fic:
+        json.dump(gaps.report(blocks), fic, indent=1)
     return
 
 if __name__ == '__main__':
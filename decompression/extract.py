@@ -1,13 +1,23 @@
 import argparse
 import os
+import sys
 import re
-import csv
 import cProfile
-#import multiprocessing
-#import sys
-#from itertools import repeat
-from collections import deque
+import multiprocessing
+import numpy as np
 import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: # export Parquet/Feather indisponible
+    pa = None
+
+# modules partages avec l'outil d'acquisition
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lms'))
+from framer import BinaryFramer
+from cola import decodeScanData, signed
+import decoder
+from archive import ArchiveWriter
 
 def fileList(path):
     """
@@ -22,7 +32,7 @@ def fileList(path):
             return False
         if filename.startswith('_'):
             return False
-        if not filename.endswith('.txt'):
+        if not filename.endswith('.txt') and not filename.endswith('.bin'):
             return False
         # TODO rajouter d'autres tests
         return True
@@ -54,31 +64,16 @@ def convert(element):
     except ValueError:
         return element
 
-def convertIter(elements):
+def isoDates(stamps):
     """
-        Convertis une liste d'element d'une trame depuis sa representation hexa
-        vers sa representation decimale. Les string ne sont pas modifiees
+        Convertit des dates datetime64 en chaines ISO 8601 en une seule operation
+        Les dates invalides (NaT) donnent une chaine vide
+        @rtype: tableau de chaines
     """
-    res = deque()
-    for elem in elements:
-        try:
-            res.append(int(elem, 16))
-        except ValueError:
-            res.append(elem)
+    res = np.datetime_as_string(stamps, unit='us')
+    res[np.isnat(stamps)] = ''
     return res
 
-def makeDate(year, month, day, hour, minute, second=0, usec=0):
-    """
-        Retourne une chaine formattee correspondant aux elements en argument
-        (annee, mois, jour, heure, minute, seconde, microseconde)
-    """
-    try:
-        date = pd.Timestamp(year, month, day, hour, minute, second, usec)
-    except ValueError:
-        print(year, month, day, hour, minute)
-        return ''
-    return date.strftime('%Y-%m-%d %H:%M:%S.%f')
-
 def getIndices(trame, echo, rssi):
     """
         Retourne un dict contenant les positions de chaque balise DIST et RSSI
@@ -97,60 +92,398 @@ def getIndices(trame, echo, rssi):
         res[key] = trame.index(key)
     return res
 
-def convertFile(filename, srcdir, dstdir, used, flag_date):
+def readBinary(path):
     """
-        Converti le fichier filename present dans srcdir contenant les trames brutes
-        en fichier csv stocke dans dstdir
-    """
-    with open(os.path.join(srcdir, filename), 'r') as fil:
-        data = [x.split() for x in fil.read().split('\n')] # liste de trames lues
-        if flag_date is True: # si on veut la date
-            dates = [[convert(y) for y in x[-8:-1]] for x in data] # conversion en int
-            dates = [makeDate(*x) for x in dates] # representation de la date
-            data = [[convert(element) for element in [line[i] for i in used]] for line in data] # filtrage + conversion en int
-            with open(os.path.join(dstdir, filename.split('.txt')[0]+'.csv'), 'w') as outfile:
-                csvwriter = csv.writer(outfile, delimiter=',')
-                csvwriter.writerows([[dates[i]]+data[i] for i in range(len(dates))]) # concat de la date et des donnes + ecriture
-                # force le ramasse-miettes pour eco de la memoire
-                del data
-                del dates
-        else: # si on veut pas la date
-            data = [[convert(element) for element in [line[i] for i in used]] for line in data] # filtrage + conversion en int
-            with open(os.path.join(dstdir, filename.split('.txt')[0]+'.csv'), 'w') as outfile:
-                csvwriter = csv.writer(outfile, delimiter=',')
-                csvwriter.writerows(data)
-                del data
-        print(filename)
-    return
-
-def convertFile2(filename, srcdir, dstdir, used, flag_date):
+        Retourne un generateur des trames CoLa-B contenues dans le fichier path
+    """
+    framer = BinaryFramer()
+    with open(path, 'rb') as fil:
+        for chunk in iter(lambda: fil.read(1 << 20), b''):
+            yield from framer.feed(chunk)
+
+def textBatches(path, layout, channels, chunk, measures=None, window=None):
+    """
+        Retourne un generateur des lots de trames ASCII decodees du fichier path
+        Chaque lot correspond a environ chunk octets de trames
+        @param measures: mesures gardees dans chaque canal (slice), None pour toutes
+        @param window: intervalle de dates garde (voir decoder.decodeBatch)
+    """
+    with open(path, 'rb') as fil:
+        for buff in decoder.iterChunks(fil, chunk):
+            yield decoder.decodeBatch(buff, layout, channels, measures, window)
+
+def binaryBatches(path, channels, chunk, measures=None, window=None):
+    """
+        Retourne un generateur des lots de trames CoLa-B decodees du fichier path
+        Les valeurs sont deja des entiers, aucune conversion hexa n'est necessaire
+    """
+    frames = []
+    size = 0
+    for frame in readBinary(path):
+        frames.append(frame)
+        size += len(frame)
+        if size >= chunk:
+            yield decoder.decodeBinaryBatch(frames, channels, measures, window)
+            frames = []
+            size = 0
+    if frames:
+        yield decoder.decodeBinaryBatch(frames, channels, measures, window)
+
+def parseAngles(spec, start, step, amount):
+    """
+        Convertit un secteur angulaire 'debut:fin[:pas]' (degres) en selection des mesures
+        @param start: angle de la premiere mesure (1/10000 deg)
+        @param step: ecart entre deux mesures (1/10000 deg)
+        @param amount: nombre de mesures par canal
+        @return: slice des mesures du secteur, None si le secteur est vide
+    """
+    parts = [float(x) for x in spec.split(':')]
+    if len(parts) not in (2, 3):
+        raise ValueError('Secteur angulaire invalide : '+spec)
+    first = max(0, int(np.ceil((parts[0]*10000 - start) / step - 1e-9)))
+    last = min(amount - 1, int(np.floor((parts[1]*10000 - start) / step + 1e-9)))
+    if last < first:
+        return None
+    every = max(1, int(round(parts[2]*10000 / step))) if len(parts) == 3 else 1
+    return slice(first, last + 1, every)
+
+def fileRange(path, layout):
+    """
+        Retourne les dates de la premiere et de la derniere trame du fichier path
+        (seules ces deux trames sont decodees)
+        @param layout: structure Layout des trames ASCII (None pour les trames CoLa-B,
+            seule la premiere date est lue)
+        @return: (debut, fin) en numpy.datetime64, NaT si inconnue
+    """
+    nat = np.datetime64('NaT')
+    if layout is None:
+        for frame in readBinary(path):
+            date = decoder.decodeBinaryBatch([frame], [])['date']
+            return decoder.timestamps(date)[0], nat
+        return nat, nat
+    with open(path, 'rb') as fil:
+        first = fil.readline()
+        size = fil.seek(0, os.SEEK_END)
+        fil.seek(max(0, size - (1 << 20)))
+        lines = fil.read().rstrip(b'\n').rsplit(b'\n', 1)
+    last = lines[-1] + b'\n'
+    date = decoder.decodeBatch(first + last, layout, [])['date']
+    if len(date) != 2: # une des deux trames est invalide
+        return nat, nat
+    stamps = decoder.timestamps(date)
+    return stamps[0], stamps[1]
+
+def outsideWindow(path, layout, window):
+    """
+        Retourne True si toutes les trames du fichier path sont hors de l'intervalle window
+    """
+    if window is None:
+        return False
+    first, last = fileRange(path, layout)
+    if window[1] is not None and not np.isnat(first) and first > window[1]:
+        return True
+    if window[0] is not None and not np.isnat(last) and last < window[0]:
+        return True
+    return False
+
+class CsvOutput:
+    """
+        Ecriture des lots de trames au format CSV (une ligne par trame)
+    """
+    def __init__(self, path, channels, flag_date, metadata):
+        self.fil = open(path, 'w')
+        self.channels = channels
+        self.flag_date = flag_date
+
+    def write(self, batch):
+        frame = pd.DataFrame(np.hstack([batch['channels'][name] for name in self.channels]))
+        if self.flag_date is True: # si on veut la date (ISO 8601, vide si invalide)
+            frame.insert(0, 'date', isoDates(batch['timestamp']))
+        frame.to_csv(self.fil, header=False, index=False)
+
+    def close(self):
+        self.fil.close()
+
+class ArrowOutput:
+    """
+        Ecriture des lots de trames au format colonne Parquet ou Feather (Arrow IPC)
+        Schema fixe : timestamp, telegramCounter, scanCounter puis une colonne par
+        canal (liste de taille fixe d'uint16). Chaque lot est ecrit dans un row group
+        (Parquet) ou un record batch (Feather), compresse en zstd
+        Les metadonnees du schema sont celles ecrites dans _metadata.txt
+    """
+    def __init__(self, path, channels, flag_date, metadata, fmt='parquet'):
+        self.path = path
+        self.channels = channels
+        self.metadata = metadata
+        self.fmt = fmt
+        self.schema = None # cree avec le premier lot (nb de mesures par canal)
+        self.writer = None
+
+    def __open(self, batch):
+        fields = [pa.field('timestamp', pa.timestamp('us')),\
+            pa.field('telegramCounter', pa.uint32()), pa.field('scanCounter', pa.uint32())]
+        for name in self.channels:
+            amount = batch['channels'][name].shape[1]
+            fields.append(pa.field(name, pa.list_(pa.uint16(), amount)))
+        self.schema = pa.schema(fields, metadata=self.metadata)
+        if self.fmt == 'parquet':
+            self.writer = pq.ParquetWriter(self.path, self.schema, compression='zstd')
+        else:
+            self.writer = pa.ipc.new_file(self.path, self.schema,\
+                options=pa.ipc.IpcWriteOptions(compression='zstd'))
+
+    def write(self, batch):
+        if self.writer is None:
+            self.__open(batch)
+        # from_pandas : les dates invalides (NaT) deviennent des valeurs nulles
+        arrays = [pa.array(batch['timestamp'], type=pa.timestamp('us'), from_pandas=True),\
+            pa.array(batch['header']['telegramCounter']), pa.array(batch['header']['scanCounter'])]
+        for name in self.channels:
+            values = batch['channels'][name]
+            arrays.append(pa.FixedSizeListArray.from_arrays(pa.array(values.ravel()), values.shape[1]))
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+class ArchiveOutput:
+    """
+        Ajout des lots de trames a l'archive binaire a acces direct (module archive)
+        Tous les fichiers sont ajoutes a la meme archive 'archive' du dossier destination
+    """
+    def __init__(self, path, channels, flag_date, metadata):
+        self.writer = ArchiveWriter(os.path.join(os.path.dirname(path), 'archive'),\
+            channels, metadata)
+
+    def write(self, batch):
+        self.writer.append(batch)
+
+    def close(self):
+        self.writer.close()
+
+# format de sortie -> (extension, classe d'ecriture, arguments supplementaires)
+OUTPUTS = {'csv': ('.csv', CsvOutput, {}),\
+    'parquet': ('.parquet', ArrowOutput, {'fmt': 'parquet'}),\
+    'feather': ('.feather', ArrowOutput, {'fmt': 'feather'}),\
+    'archive': ('', ArchiveOutput, {})}
+
+def convertFile2(filename, srcdir, dstdir, layout, channels, flag_date, chunk=1 << 23,\
+    fmt='csv', metadata=None, measures=None, window=None):
     """
         Converti le fichier filename present dans srcdir contenant les trames brutes
-        en fichier csv stocke dans dstdir
-    """
-    with open(os.path.join(srcdir, filename), 'r') as fil:
-        print('convert entree')
-        data = deque()
-        if flag_date is True: # si on veut la date
-            for line in fil:
-                tok = line.split()
-                del line
-                date = convertIter(tok[-8:-1])
-                data.append(date+convertIter([tok[i] for i in used]))
-
-        else: # si on veut pas la date
-            for line in fil:
-                tok = line.split()
-                del line
-                data.append(convertIter([tok[i] for i in used]))
-
-        print('convert fin boucle')
-        with open(os.path.join(dstdir, filename.split('.txt')[0]+'.csv'), 'w') as outfile:
-            csvwriter = csv.writer(outfile, delimiter=',')
-            csvwriter.writerows(data)
-            del data
-        print(filename)
-    return
+        (ASCII ou CoLa-B) en fichier csv, parquet ou feather stocke dans dstdir
+        Les trames sont decodees par lots d'environ chunk octets (module decoder),
+        chaque lot est ecrit avant de lire le suivant. Les dates de toutes les
+        trames d'un lot sont converties en datetime64[us] en une seule operation
+        Seules les mesures du secteur measures et les trames de l'intervalle window
+        sont decodees, un fichier entierement hors de l'intervalle n'est pas lu
+        @param layout: structure Layout des trames ASCII (None pour les trames CoLa-B)
+        @param measures: mesures gardees dans chaque canal (slice), None pour toutes
+        @param window: intervalle (debut, fin) de dates garde, None pour toutes les trames
+        @return: nom du fichier, nombre de trames converties, nombre de trames invalides,
+            nombre de trames hors intervalle (None si le fichier n'a pas ete lu),
+            nombre de dates invalides
+    """
+    path = os.path.join(srcdir, filename)
+    if outsideWindow(path, layout, window):
+        return filename, 0, 0, None, 0
+    if filename.endswith('.bin'):
+        batches = binaryBatches(path, channels, chunk, measures, window)
+    else:
+        batches = textBatches(path, layout, channels, chunk, measures, window)
+
+    ext, output, kwargs = OUTPUTS[fmt]
+    output = output(os.path.join(dstdir, os.path.splitext(filename)[0]+ext),\
+        channels, flag_date, metadata, **kwargs)
+    rows = 0 # nombre de trames converties
+    invalid = 0 # nombre de trames invalides
+    outside = 0 # nombre de trames hors intervalle
+    badDates = 0 # nombre de dates invalides
+    try:
+        for batch in batches:
+            rows += len(batch['header'])
+            invalid += batch['invalid']
+            outside += batch['outside']
+            if len(batch['header']):
+                batch['timestamp'] = decoder.timestamps(batch['date'])
+                badDates += int(np.isnat(batch['timestamp']).sum())
+                output.write(batch)
+    finally:
+        output.close()
+    return filename, rows, invalid, outside, badDates
+
+def availableMemory():
+    """
+        Retourne la memoire disponible en octets (MemAvailable), None si inconnue
+    """
+    try:
+        with open('/proc/meminfo', 'r') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return None
+
+# memoire utilisee par un worker pour chaque octet de trames en cours de decodage
+# (tableaux de positions des elements et valeurs decodees)
+MEMORY_FACTOR = 24
+
+def callJob(job):
+    """
+        Appelle job[0] avec les arguments job[1:] (pour Pool.imap)
+    """
+    return job[0](*job[1:])
+
+def runJobs(func, argslist, jobs, chunk):
+    """
+        Execute func sur chaque element de argslist avec au plus jobs processus
+        Le nombre de processus est limite par la memoire disponible, chaque processus
+        decode au plus chunk octets a la fois et ecrit le resultat sur le disque
+        avant de lire la suite. La progression est affichee dans l'ordre des fichiers
+        @param func: fonction de conversion d'un fichier
+        @param argslist: liste des tuples d'arguments de func
+        @param jobs: nombre max de processus
+        @param chunk: taille max des donnees decodees a la fois par un processus
+    """
+    jobs = min(jobs, len(argslist), multiprocessing.cpu_count())
+    mem = availableMemory()
+    if mem is not None:
+        jobs = min(jobs, mem // (chunk*MEMORY_FACTOR))
+    jobs = max(jobs, 1)
+    print('Conversion de', len(argslist), 'fichiers avec', jobs, 'processus')
+
+    jobslist = [(func,)+tuple(x) for x in argslist]
+    if jobs == 1:
+        results = map(callJob, jobslist)
+        pool = None
+    else:
+        # un processus par fichier pour rendre la memoire au systeme entre deux fichiers
+        pool = multiprocessing.Pool(jobs, maxtasksperchild=1)
+        results = pool.imap(callJob, jobslist)
+    try:
+        for i, (filename, rows, invalid, outside, badDates) in enumerate(results):
+            msg = '['+str(i+1)+'/'+str(len(jobslist))+'] '+filename+' : '
+            if outside is None:
+                print(msg+'hors intervalle, ignore')
+                continue
+            msg += str(rows)+' trames'
+            if invalid > 0:
+                msg += ', '+str(invalid)+' trames invalides'
+            if outside > 0:
+                msg += ', '+str(outside)+' trames hors intervalle'
+            if badDates > 0:
+                msg += ', '+str(badDates)+' dates invalides'
+            print(msg)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+def writeMetadata(srcdir, metadata):
+    """
+        Ecriture du fichier de metadonnees _metadata.txt
+        @param metadata: dict libelle -> valeur
+    """
+    with open(os.path.join(srcdir, '_metadata.txt'), 'w') as settings:
+        for key, value in metadata.items():
+            settings.write(key+' : '+value+'\n')
+
+def binaryMetadata(files, srcdir, channels, args):
+    """
+        Retourne les metadonnees des fichiers enregistres avec le protocole CoLa-B
+        ou None si les canaux demandes sont absents
+    """
+    first = decodeScanData(next(readBinary(os.path.join(srcdir, files[0]))))
+    for name in channels:
+        if name not in first['channels']:
+            print('Canal '+name+' absent des donnees, abandon')
+            return None
+
+    dist = first['channels']['DIST1']
+    return {"Nb. d'echo": str(args.echo),\
+        "Mesure par echo": str(dist['amount']),\
+        "RSSI": 'Oui' if args.RSSI is True else 'Non',\
+        "Scan freq.": str(first['scanFrequency']/100)+' Hz',\
+        "Measure freq.": str(first['measFrequency']*100)+' Hz',\
+        "Scale factor": str(dist['scale']),\
+        "Scale offset": str(dist['offset']),\
+        "Start angle": str(dist['start']),\
+        "Step size": str(dist['step']),\
+        "Serial num.": str(first['serial'])}
+
+def fileGeometry(path, binary):
+    """
+        Lis la premiere trame d'un fichier
+        @return: Layout des trames ASCII (None en CoLa-B), noms des canaux, geometrie
+            (angle de depart, pas, nb de mesures) du canal DIST1 (None si absent)
+    """
+    if binary:
+        try:
+            scan = decodeScanData(next(readBinary(path)))
+        except StopIteration: # fichier vide
+            return None, [], None
+        dist = scan['channels'].get('DIST1')
+        return None, list(scan['channels']),\
+            None if dist is None else (dist['start'], dist['step'], dist['amount'])
+    with open(path, 'r') as fil:
+        first = fil.readline()
+    layout = decoder.Layout(first)
+    if 'DIST1' not in layout.channels:
+        return layout, list(layout.channels), None
+    tokens = first.split()
+    ind = layout.channels['DIST1']
+    return layout, list(layout.channels), (signed(tokens[ind+decoder.START_ANGLE]),\
+        int(tokens[ind+decoder.STEP], 16), int(tokens[ind+decoder.AMOUNT], 16))
+
+def fileJobs(files, srcdir, binary, channels, angles, fixed):
+    """
+        Retourne (fichier, layout, mesures gardees) pour chaque fichier a convertir
+        Les fichiers ecrits apres un changement de geometrie des trames (mode degrade
+        ou filtre de l'enregistreur, voir decompress.py) ont leur propre layout et
+        leur propre selection du secteur angulaire, les metadonnees sont celles du
+        premier fichier
+        @param angles: secteur angulaire garde (voir parseAngles) ou None
+        @param fixed: les fichiers de geometrie differente du premier sont ignores
+            (format archive, enregistrements de taille fixe)
+    """
+    res = []
+    reference = None
+    for fil in files:
+        layout, names, geometry = fileGeometry(os.path.join(srcdir, fil), binary)
+        missing = [name for name in channels if name not in names]
+        if missing:
+            print(fil, ': canaux', ', '.join(missing), 'absents, ignore')
+            continue
+        if reference is None:
+            reference = geometry
+        elif geometry != reference and fixed:
+            print(fil, ': geometrie des trames differente, ignore (format archive)')
+            continue
+        measures = None
+        if angles is not None:
+            measures = parseAngles(angles, *geometry)
+            if measures is None:
+                print(fil, ': secteur angulaire hors des mesures, ignore')
+                continue
+        res.append((fil, layout, measures))
+    return res
+
+def sectorMetadata(metadata, measures, geometry, hexa):
+    """
+        Met a jour les metadonnees apres selection d'un secteur angulaire
+        @param measures: slice des mesures gardees
+        @param geometry: (angle de depart, pas, nb de mesures) des trames
+        @param hexa: valeurs ecrites en hexadecimal (trames ASCII)
+    """
+    start, step, amount = geometry
+    first, _, every = measures.indices(amount)
+    values = {'Start angle': start + step * first, 'Step size': step * every}
+    for key, value in values.items():
+        metadata[key] = format(value & 0xFFFFFFFF, 'X')+'(h)' if hexa else str(value)
+    metadata['Mesure par echo'] = str(len(range(*measures.indices(amount))))
 
 def main():
     parser = argparse.ArgumentParser(description="Outil d'extraction des donnees")
@@ -164,6 +497,19 @@ def main():
         help='Inclure les donnees de remission')
     parser.add_argument('--date', default='False', action='store_true',\
         help='Inclure la date de la mesure')
+    parser.add_argument('-j', '--jobs', default='1', type=int,\
+        help='Nombre de fichiers convertis en parallele')
+    parser.add_argument('--chunk', default='8', type=int,\
+        help='Taille max des donnees decodees a la fois par processus (en Mo)')
+    parser.add_argument('-f', '--format', default='csv', choices=list(OUTPUTS),\
+        help='Format des fichiers en sortie (parquet et feather necessitent pyarrow, '+\
+            'archive : enregistrements de taille fixe lisibles par numpy.memmap)')
+    parser.add_argument('--from', dest='start', default=None,\
+        help='Ne garde que les trames mesurees a partir de cette date (ex: 2018-06-01T10:00)')
+    parser.add_argument('--to', dest='end', default=None,\
+        help="Ne garde que les trames mesurees jusqu'a cette date")
+    parser.add_argument('--angles', default=None,\
+        help='Secteur angulaire garde, debut:fin[:pas] en degres (ex: 80:100 ou 0:180:1)')
     parser.add_argument('srcdir', nargs=1,\
         help='Dossier source')
     parser.add_argument('dstdir', nargs=1,\
@@ -183,9 +529,48 @@ def main():
     if args.offset > min(len(files), args.count):
         print('Mauvais offset! Abandon...')
         return
-    if args.count is not 0:
+    if args.count != 0:
         files = files[args.offset:min(args.offset+args.count, len(files))]
 
+    if args.format in ('parquet', 'feather') and pa is None:
+        print('Le module pyarrow est necessaire pour le format '+args.format+', abandon')
+        return
+    if args.format == 'archive' and args.jobs > 1:
+        # tous les fichiers sont ajoutes dans l'ordre a la meme archive
+        print('Format archive : conversion sequentielle')
+        args.jobs = 1
+
+    ## cree la liste des canaux a garder
+    channels = ['DIST'+str(i+1) for i in range(args.echo)]
+    if args.RSSI is True:
+        channels.extend(['RSSI'+str(i+1) for i in range(args.echo)])
+
+    # intervalle de dates garde, les trames en dehors ne sont pas decodees
+    window = None
+    if args.start is not None or args.end is not None:
+        window = (None if args.start is None else np.datetime64(args.start, 'us'),\
+            None if args.end is None else np.datetime64(args.end, 'us'))
+
+    # donnees enregistrees avec le protocole binaire
+    if files[0].endswith('.bin'):
+        metadata = binaryMetadata(files, srcdir, channels, args)
+        if metadata is None:
+            return
+        if args.angles is not None:
+            dist = decodeScanData(next(readBinary(os.path.join(srcdir, files[0]))))['channels']['DIST1']
+            geometry = (dist['start'], dist['step'], dist['amount'])
+            measures = parseAngles(args.angles, *geometry)
+            if measures is None:
+                print('Secteur angulaire hors des mesures, abandon')
+                return
+            sectorMetadata(metadata, measures, geometry, False)
+        writeMetadata(srcdir, metadata)
+        jobs = fileJobs(files, srcdir, True, channels, args.angles, args.format == 'archive')
+        runJobs(convertFile2, [(fil, srcdir, dstdir, layout, channels, args.date,\
+            args.chunk*10**6, args.format, metadata, measures, window)\
+            for fil, layout, measures in jobs], args.jobs, args.chunk*10**6)
+        return
+
     ## recupere le header de la premiere ligne et les indices des colonnes a garder
     with open(os.path.join(srcdir, files[0]), 'r') as fil:
         first = fil.readline() # premiere ligne du fichier
@@ -200,50 +585,39 @@ def main():
 
         first = first.split()
         indices = getIndices(first, args.echo, args.RSSI) # indices des flags DIST et RSSI
-        nbmeas = int(first[indices['DIST1']+5], 16) # nb de mesure par echo
         header = first[0:indices['DIST1']] # en-tete de trame
         header.extend(first[indices['DIST1']+1:indices['DIST1']+6]) # rajoute les infos de mesure
         del first
-
-        # ecriture du fichier de metadonnees
-        with open(os.path.join(srcdir, '_metadata.txt'), 'w') as settings:
-            settings.write("Nb. d'echo : "+str(args.echo)+'\n')
-            settings.write("Mesure par echo : "+str(convert(header[24]))+'\n')
-            if args.RSSI is True:
-                settings.write("RSSI : Oui\n")
-            else:
-                settings.write("RSSI : Non\n")
-            settings.write("Scan freq. : "+str(convert(header[16])/100)+' Hz\n')
-            settings.write("Measure freq. : "+str(convert(header[17])*100)+' Hz\n')
-            settings.write("Scale factor : "+str(header[20])+'(h)\n')
-            settings.write("Scale offset : "+str(header[21])+'(h)\n')
-            settings.write("Start angle : "+str(header[22])+'(h)\n')
-            settings.write("Step size : "+str(header[23])+'(h)\n')
-            settings.write("Serial num. : "+str(convert(header[4]))+'\n')
-            del header
-
-        ## cree une liste des index des colonnes a garder
-        used = [] # indice des mesures a garder
-        for i in range(args.echo):
-            ind = indices['DIST'+str(i+1)] # position de l'element DISTn dans la trame
-            used.extend(range(ind+6, ind+6+nbmeas)) # ajoute les nbmeas indices des mesures de DISTn
-        if args.RSSI is True:
-            for i in range(args.echo):
-                ind = indices['RSSI'+str(i+1)] # position de l'element RSSIn dans la trame
-                used.extend(range(ind+6, ind+6+nbmeas)) # ajoute les nbmeas indices des mesures de RSSIn
         del indices
-        del nbmeas
 
-    """     Pool de workers qui fait planter mon PC :(
-    # liste d'iterables contenant les arguments de convertFile() pour la pool
-    pool_args = [[x,] + y for x, y in zip(files, repeat([srcdir, dstdir, used, args.date]))]
-    with multiprocessing.Pool(multiprocessing.cpu_count()) as pool:
-        pool.starmap(convertFile, pool_args)
-    """
+        # metadonnees, ecrites dans _metadata.txt et dans le schema Parquet/Feather
+        metadata = {"Nb. d'echo": str(args.echo),\
+            "Mesure par echo": str(convert(header[24])),\
+            "RSSI": 'Oui' if args.RSSI is True else 'Non',\
+            "Scan freq.": str(convert(header[16])/100)+' Hz',\
+            "Measure freq.": str(convert(header[17])*100)+' Hz',\
+            "Scale factor": str(header[20])+'(h)',\
+            "Scale offset": str(header[21])+'(h)',\
+            "Start angle": str(header[22])+'(h)',\
+            "Step size": str(header[23])+'(h)',\
+            "Serial num.": str(convert(header[4]))}
+        # selection des mesures du secteur angulaire (metadonnees du premier fichier,
+        # les mesures gardees dans chaque fichier sont choisies par fileJobs())
+        if args.angles is not None:
+            geometry = (signed(header[22]), convert(header[23]), convert(header[24]))
+            measures = parseAngles(args.angles, *geometry)
+            if measures is None:
+                print('Secteur angulaire hors des mesures, abandon')
+                return
+            sectorMetadata(metadata, measures, geometry, True)
+        writeMetadata(srcdir, metadata)
+        del header
+
+    jobs = fileJobs(files, srcdir, False, channels, args.angles, args.format == 'archive')
+    runJobs(convertFile2, [(fil, srcdir, dstdir, layout, channels, args.date, args.chunk*10**6,\
+        args.format, metadata, measures, window) for fil, layout, measures in jobs],\
+        args.jobs, args.chunk*10**6)
 
-    for file in files:
-        convertFile2(file, srcdir, dstdir, used, args.date)
-    
 if __name__ == '__main__':
     #main()
     cProfile.run('main()')
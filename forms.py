@@ -1,6 +1,6 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SelectField, BooleanField, IntegerField, TextAreaField, DateTimeField
-from wtforms.validators import DataRequired, NumberRange
+from wtforms.validators import DataRequired, InputRequired, NumberRange
 
 class UsernamePasswordForm(FlaskForm):
     username = StringField('username', validators=[DataRequired()])
@@ -17,6 +17,16 @@ class ScannerConfigForm(FlaskForm):
     remission = BooleanField('Remission', default='checked')
     interval = IntegerField('Output Interval', validators=[DataRequired(),\
         NumberRange(min=1, max=50000)])
+    # reduction des trames par l'enregistreur, avant compression
+    beamStep = IntegerField('Beam Step', default=1, validators=[DataRequired(),\
+        NumberRange(min=1, max=100)])
+    windowStart = IntegerField('Window Start', default=-5, validators=[InputRequired(),\
+        NumberRange(min=-5, max=185)])
+    windowStop = IntegerField('Window Stop', default=185, validators=[InputRequired(),\
+        NumberRange(min=-5, max=185)])
+    echoCount = SelectField('Echo Count', choices=[(0, 'Tous les echo'), (1, 'Premier echo'),\
+        (2, 'Deux premiers echo')], coerce=int)
+    keepRemission = BooleanField('Keep Remission', default='checked')
 
 class DataInfoForm(FlaskForm):
     project = StringField('project', validators=None)
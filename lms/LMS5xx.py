@@ -2,31 +2,72 @@ import socket
 import select
 import time
 import logging
+from collections import deque
 from structs import scanCfg
+from framer import TelegramFramer, BinaryFramer
+import cola
+from cola import ERROR, SCAN_KEY, replyKey, frameKey
+
+# temps d'attente max de la reponse a l'enregistrement en EEPROM (s)
+SAVE_TIMEOUT = 10
+# temps d'attente max de la reponse a une commande (s)
+TIMEOUT = 1
+# nombre max de trames de donnees gardees pendant l'attente d'une reponse
+MAX_SCANS = 10000
 
 class LMS5xx:
     """
         Classe permettant de communiquer avec le LMS 5xx
+        Le protocole CoLa-A (ASCII, port 2111) est utilise par defaut,
+        le protocole CoLa-B (binaire, port 2112) est active avec binary=True
+        Les reponses aux commandes et les trames de donnees passent par le meme
+        framer : les trames LMDscandata recues avant une reponse sont gardees
+        pour getScanData() et readFrames()
     """
-    def __init__(self):
+    def __init__(self, binary=False):
+        """
+            @param binary: utilise le protocole binaire CoLa-B
+        """
         self.sock = None # tcp socket
         self.__connected = False # active connection flag
+        self.binary = binary # protocole CoLa-B
+        self.framer = self.__makeFramer() # reassemblage des trames recues
+        self.scans = deque(maxlen=MAX_SCANS) # trames de donnees recues avant une reponse
+        self.__closed = False # connexion fermee ou en erreur, signalee au prochain readFrames()
+
+    def __makeFramer(self):
+        """
+            Retourne un framer adapte au protocole utilise
+        """
+        if self.binary:
+            return BinaryFramer()
+        return TelegramFramer()
 
-    def connect(self, host, port):
+    def connect(self, host, port, rcvbuf=None):
         """
             Connection au LMS 5xx
             @param host: adresse IP du telemetre
-            @param port: port d'écoute du LMS (2111)
+            @param port: port d'écoute du LMS (2111 en ASCII, 2112 en binaire)
+            @param rcvbuf: taille du buffer de reception du socket (SO_RCVBUF) en octets,
+                None pour la valeur du systeme (limitee par net.core.rmem_max)
         """
         if not self.__connected:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.settimeout(1)
+            if rcvbuf is not None:
+                # doit etre regle avant connect() pour la fenetre TCP
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+                logging.info('Buffer de reception du socket : %d octets',\
+                    self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+            self.sock.settimeout(TIMEOUT)
+            self.framer = self.__makeFramer()
+            self.scans.clear()
+            self.__closed = False
             try:
                 self.sock.connect((host, port))
                 self.__connected = True
                 logging.info('LMS connecte avec succes')
-            except socket.timeout:
-                logging.error('Impossible de se connecter au LMS')
+            except OSError: # timeout ou connexion refusee
+                logging.error('Impossible de se connecter au LMS %s:%s', host, port)
                 self.__connected = False
 
     def disconnect(self):
@@ -45,32 +86,82 @@ class LMS5xx:
         """
         return self.__connected
 
-    def setTime(self):
+    def __receive(self, key, timeout=TIMEOUT):
         """
-            Synchronise l'horloge du telemetre sur celle de l'hote
+            Lis la reponse a une commande
+            Les octets recus sont reassembles par le framer, la premiere trame de cle
+            key est la reponse. Les trames LMDscandata recues avant sont gardees
+            (self.scans), les autres trames sont ignorees
+            @param key: cle de la reponse attendue (cola.replyKey())
+            @param timeout: temps d'attente max de la reponse (s)
+            @return: trame ASCII complete ou donnees de la trame binaire, None si
+                pas de reponse ou erreur du telemetre (sFA)
+            @rtype: bytes ou None
         """
-        tps = time.localtime()
-        # conversion de l'heure en hexa
-        year = bytes(hex(tps.tm_year)[2:].upper(), encoding='utf8')
-        month = bytes(hex(tps.tm_mon)[2:].upper(), encoding='utf8')
-        day = bytes(hex(tps.tm_mday)[2:].upper(), encoding='utf8')
-        hour = bytes(hex(tps.tm_hour)[2:].upper(), encoding='utf8')
-        minute = bytes(hex(tps.tm_min)[2:].upper(), encoding='utf8')
-        seconde = bytes(hex(tps.tm_sec)[2:].upper(), encoding='utf8')
+        deadline = time.monotonic() + timeout
+        while True:
+            for frame in self.framer:
+                data = bytes(cola.payload(frame)) if self.binary else frame[1:-1]
+                rec = frameKey(data)
+                if rec == SCAN_KEY:
+                    self.scans.append(frame)
+                elif rec == key:
+                    return data if self.binary else frame
+                elif rec[0] == ERROR:
+                    logging.warning('Erreur du telemetre : %s', data[:64])
+                    return None
+                else:
+                    logging.debug('Trame recue sans commande en attente : %s', data[:64])
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self.sock.settimeout(remaining)
+            try:
+                n = self.sock.recv_into(self.framer.writable())
+            except (socket.timeout, InterruptedError):
+                continue
+            finally:
+                self.sock.settimeout(TIMEOUT)
+            if n == 0:
+                logging.error('Connexion fermee par le telemetre')
+                return None
+            self.framer.commit(n)
 
-        buf = b'\x02sMN LSPsetdatetime '+year+b' '+month+b' '+day+\
-            b' '+hour+b' '+minute+b' '+seconde+b' 0000\x03'
+    def __request(self, name, cmd, params=(), timeout=TIMEOUT):
+        """
+            Envoie une commande au telemetre et retourne sa reponse
+            @param name: nom de la methode appelante (pour les logs)
+            @param cmd: commande (ex: b'sMN LMCstartmeas')
+            @param params: liste de tuples (format struct, valeur)
+            @param timeout: temps d'attente max de la reponse (s)
+            @return: reponse du telemetre ou None si non valide
+            @rtype: bytes ou None
+        """
+        if self.binary:
+            buf = cola.encodeBinary(cmd, params)
+        else:
+            buf = cola.encodeAscii(cmd, params)
 
         sent = self.sock.send(buf)
         if sent < len(buf):
-            logging.error("setTime(): Tous les octets n'ont pas ete envoyes")
+            logging.error("%s(): Tous les octets n'ont pas ete envoyes", name)
+
+        rec = self.__receive(replyKey(cmd), timeout)
+        if rec is None:
+            logging.warning('%s(): Trame recue non valide', name)
 
-        rec = self.sock.recv(128)
-        if bytes([rec[0]]) != b'\x02':
-            logging.warning('setTime(): Trame recue non valide')
+        logging.debug('%s() envoye: %s', name, buf)
+        logging.debug('%s() recu: %s', name, rec)
+        return rec
 
-        logging.debug('setTime() envoye: %s', buf)
-        logging.debug('setTime() recu: %s', rec)
+    def setTime(self):
+        """
+            Synchronise l'horloge du telemetre sur celle de l'hote
+        """
+        tps = time.localtime()
+        self.__request('setTime', b'sMN LSPsetdatetime', [('H', tps.tm_year),\
+            ('B', tps.tm_mon), ('B', tps.tm_mday), ('B', tps.tm_hour),\
+            ('B', tps.tm_min), ('B', tps.tm_sec), ('I', 0)])
 
     def setEchoFilter(self, code):
         """
@@ -80,53 +171,21 @@ class LMS5xx:
                 1 : tous les echos
                 2 : dernier echo
         """
-        code = bytes(hex(code)[2:].upper(), encoding='utf8')
-        buf = b'\x02sWN FREchoFilter '+code+b'\x03'
-
-        sent = self.sock.send(buf)
-        if sent < len(buf):
-            logging.error("setEchoFilter(): Tous les octets n'ont pas ete envoyes")
-
-        rec = self.sock.recv(128)
-        if bytes([rec[0]]) != b'\x02':
-            logging.warning('setTime(): Trame recue non valide')
-
-        logging.debug('setEchoFilter() envoye: %s', buf)
-        logging.debug('setEchoFilter() recu: %s', rec)
+        self.__request('setEchoFilter', b'sWN FREchoFilter', [('B', code)])
 
     def startMeas(self):
         """
             Apres avoir recu cette commande, le telemetre fait tourner le laser
             et commence a mesurer
         """
-        buf = b'\x02sMN LMCstartmeas\x03'
-        sent = self.sock.send(buf)
-        if sent < len(buf):
-            logging.error("startMeas(): Tous les octets n'ont pas ete envoyes")
-
-        rec = self.sock.recv(128)
-        if bytes([rec[0]]) != b'\x02':
-            logging.warning('startMeas(): Trame recue non valide')
-
-        logging.debug('startMeas() envoye: %s', buf)
-        logging.debug('startMeas() recu: %s', rec)
+        self.__request('startMeas', b'sMN LMCstartmeas')
 
     def stopMeas(self):
         """
             Apres avoir recu cette commande, le telemetre arrete de faire tourner
             le laser et arrete de mesurer
         """
-        buf = b'\x02sMN LMCstopmeas\x03'
-        sent = self.sock.send(buf)
-        if sent < len(buf):
-            logging.error("stopMeas(): Tous les octets n'ont pas ete envoyes")
-
-        rec = self.sock.recv(128)
-        if bytes([rec[0]]) != b'\x02':
-            logging.warning('stopMeas(): Trame recue non valide')
-
-        logging.debug('stopMeas() envoye: %s', buf)
-        logging.debug('stopMeas() recu: %s', rec)
+        self.__request('stopMeas', b'sMN LMCstopmeas')
 
     def queryStatus(self):
         """
@@ -141,63 +200,48 @@ class LMS5xx:
                 6: pret
                 7: en mesure
         """
-        buf = b'\x02sRN STlms\x03'
-        sent = self.sock.send(buf)
-        if sent < len(buf):
-            logging.error("queryStatus(): Tous les octets n'ont pas ete envoyes")
-
-        rec = self.sock.recv(128)
-        if bytes([rec[0]]) != b'\x02':
-            logging.warning('queryStatus(): Trame recue non valide')
+        rec = self.__request('queryStatus', b'sRN STlms')
+        if rec is None:
+            return 0
+        return cola.decodeStatus(rec, self.binary)
 
-        logging.debug('queryStatus() envoye: %s', buf)
-        logging.debug('queryStatus() recu: %s', rec)
-
-        return int(rec.split(b'\x20')[2].decode())
+    def waitReady(self, timeout=30, interval=0.1):
+        """
+            Attend que le telemetre soit en mesure (code d'etat 7)
+            @param timeout: temps d'attente max (s)
+            @param interval: periode d'interrogation (s)
+            @return: True si le telemetre est pret avant le timeout
+        """
+        deadline = time.monotonic() + timeout
+        while self.queryStatus() < 7:
+            if time.monotonic() > deadline:
+                logging.error("waitReady(): Le telemetre n'est pas pret apres %s s", timeout)
+                return False
+            time.sleep(interval)
+        return True
 
     def login(self):
         """
             Authentification. Augmente le niveau d'acces, permet de changer la configuration
         """
-        buf = b'\x02sMN SetAccessMode 03 F4724744\x03'
-        sent = self.sock.send(buf)
-        if sent < len(buf):
-            logging.error("login(): Tous les octets n'ont pas ete envoyes")
-
-        rec = self.sock.recv(128)
-        if bytes([rec[0]]) != b'\x02':
-            logging.warning('login(): Trame recue non valide')
-
-        logging.debug('login() envoye: %s', buf)
-        logging.debug('login() recu: %s', rec)
+        self.__request('login', b'sMN SetAccessMode', [('b', 3), ('I', 0xF4724744)])
 
     def getScanCfg(self):
         """
             Retourne la configuration actuelle du scanner
-            @rtype: structure scanCfg
+            @rtype: structure scanCfg ou None
             @return: frequence de scan
             @return: resolution du scan
             @return: angle de depart
             @return: angle d'arret
+            @return: None si le telemetre ne repond pas
         """
-        buf = b'\x02sRN LMPscancfg\x03'
-        sent = self.sock.send(buf)
-        if sent < len(buf):
-            logging.error("getScanCfg(): Tous les octets n'ont pas ete envoyes")
-
-        rec = self.sock.recv(128)
-        if bytes([rec[0]]) != b'\x02':
-            logging.warning('getScanCfg(): Trame recue non valide')
-
-        logging.debug('getScanCfg() envoye: %s', buf)
-        logging.debug('getScanCfg() recu: %s', rec)
-
-        data = rec.split(b'\x20')
+        rec = self.__request('getScanCfg', b'sRN LMPscancfg')
+        if rec is None:
+            return None
         cfg = scanCfg()
-        cfg.scaningFrequency = int.from_bytes(data[2], 'big', signed=True)
-        cfg.angleResolution = int.from_bytes(data[4], 'big', signed=True)
-        cfg.startAngle = int.from_bytes(data[5], 'big', signed=True)
-        cfg.stopAngle = int.from_bytes(data[6][0:-1], 'big', signed=True)
+        cfg.scaningFrequency, cfg.angleResolution, cfg.startAngle, cfg.stopAngle =\
+            cola.decodeScanCfg(rec, self.binary)
         return cfg
 
     def setScanCfg(self, cfg):
@@ -205,50 +249,18 @@ class LMS5xx:
             Change la configuration du scan
             @param cfg: structure scanCfg contenant les parametres
         """
-        scaningFrequency = bytes(hex(cfg.scaningFrequency & 0xFFFFFFFF)[2:].upper(), encoding='utf8')
-        angleResolution = bytes(hex(cfg.angleResolution & 0xFFFFFFFF)[2:].upper(), encoding='utf8')
-        startAngle = bytes(hex(cfg.startAngle & 0xFFFFFFFF)[2:].upper(), encoding='utf8')
-        stopAngle = bytes(hex(cfg.stopAngle & 0xFFFFFFFF)[2:].upper(), encoding='utf8')
-
-        buf = b'\x02sMN mLMPsetscancfg '+scaningFrequency+b' 1 '+\
-                        angleResolution+b' '+startAngle+b' '+stopAngle+b'\x03'
+        self.__request('setScanCfg', b'sMN mLMPsetscancfg', [('I', cfg.scaningFrequency),\
+            ('h', 1), ('I', cfg.angleResolution), ('i', cfg.startAngle), ('i', cfg.stopAngle)])
 
-        sent = self.sock.send(buf)
-        if sent < len(buf):
-            logging.error("setScanCfg(): Tous les octets n'ont pas ete envoyes")
-
-        rec = self.sock.recv(128)
-        if bytes([rec[0]]) != b'\x02':
-            logging.warning('setScanCfg(): Trame recue non valide')
-
-        logging.debug('setScanCfg() envoye: %s', buf)
-        logging.debug('setScanCfg() recu: %s', rec)
-        
     def setScanDataCfg(self, cfg):
         """
             Change la configuration d'acquisition des donnees
             @param cfg: structure scanDataCfg contenant les parametres
         """
-        remission = bytes(hex(cfg.remission & 0xFF)[2:].upper(), encoding='utf8')
-        resolution = bytes(hex(cfg.resolution & 0xFF)[2:].upper(), encoding='utf8')
-        encoder = bytes(hex(cfg.encoder & 0xFFFF)[2:].upper(), encoding='utf8')
-        position = bytes(hex(cfg.position & 0xFF)[2:].upper(), encoding='utf8')
-        deviceName = bytes(hex(cfg.deviceName & 0xFF)[2:].upper(), encoding='utf8')
-        timestamp = bytes(hex(cfg.timestamp & 0xFF)[2:].upper(), encoding='utf8')
-        outputinterval = bytes(hex(cfg.outputinterval & 0xFFFF)[2:].upper(), encoding='utf8')
-
-        buf = b'\x02sWN LMDscandatacfg 0 0 '+remission+b' '+resolution+b' 0 '+b'0 0 '+\
-            position+b' '+deviceName+b' 0 '+timestamp+b' '+outputinterval+b'\x03'
-
-        sent = self.sock.send(buf)
-        if sent < len(buf):
-            logging.error("setScanDataCfg(): Tous les octets n'ont pas ete envoyes")
-
-        rec = self.sock.recv(128)
-        if bytes([rec[0]]) != b'\x02':
-            logging.warning('setScanDataCfg(): Trame recue non valide')
-
-        logging.info('setScanDataCfg() envoye: %s', buf)
+        rec = self.__request('setScanDataCfg', b'sWN LMDscandatacfg', [('B', 0), ('B', 0),\
+            ('B', cfg.remission), ('B', cfg.resolution), ('B', 0), ('B', 0), ('B', 0),\
+            ('B', cfg.position), ('B', cfg.deviceName), ('B', 0), ('B', cfg.timestamp),\
+            ('H', cfg.outputinterval)])
         logging.info('setScanDataCfg() recu: %s', rec)
 
     def scanContinous(self, start):
@@ -257,66 +269,87 @@ class LMS5xx:
             (le telemetre envoie des donnees en continu)
             @param start: 1 pour demarrer, 0 pour arreter
         """
-        start = bytes(hex(start)[2:].upper(), encoding='utf8')
-        buf = b'\x02sEN LMDscandata '+start+b'\x03'
-        sent = self.sock.send(buf)
-        if sent < len(buf):
-            logging.error("scanContinous(): Tous les octets n'ont pas ete envoyes")
-
-        rec = self.sock.recv(128)
-        if bytes([rec[0]]) != b'\x02':
-            logging.warning('scanContinous(): Trame recue non valide')
-
-        logging.debug('scanContinous() envoye: %s', buf)
-        logging.debug('scanContinous() recu: %s', rec)
+        self.__request('scanContinous', b'sEN LMDscandata', [('B', start)])
 
     def getScanData(self, timeout):
         """
-            Retourne une trame de donnees
+            Retourne une trame de donnees complete ({stx}...{etx} en ASCII,
+            trame CoLa-B verifiee en binaire)
+            Les octets recus sont reassembles par le framer, une trame coupee
+            entre plusieurs recv() est retournee en une seule fois
             @param timeout: temps d'attente max d'une trame
             @return: Trame recue ou None si rien recu avant le timeout
             @rtype: bytes ou None
         """
-        try:
-            read, _, _ = select.select((self.sock,), (), (), timeout)
-            if read:
-                rec = self.sock.recv(2048)
-                return rec
-            else:
+        if self.scans:
+            return self.scans.popleft()
+        frame = self.framer.next()
+        if frame is not None:
+            return frame
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                read, _, _ = select.select((self.sock,), (), (), remaining)
+                if not read:
+                    return None
+                n = self.sock.recv_into(self.framer.writable())
+            except InterruptedError:
+                return None
+            if n == 0:
+                logging.error('getScanData(): Connexion fermee par le telemetre')
                 return None
-        except InterruptedError:
+            self.framer.commit(n)
+            frame = self.framer.next()
+            if frame is not None:
+                return frame
+
+    def fileno(self):
+        """
+            Retourne le descripteur du socket (pour select/selectors)
+        """
+        return self.sock.fileno()
+
+    def readFrames(self):
+        """
+            Lis les octets disponibles sur le socket (a appeler quand il est pret
+            en lecture) et retourne les trames de donnees completes
+            Les trames deja recues sont retournees avant de signaler la fermeture
+            de la connexion, qui est signalee a l'appel suivant
+            @return: liste de trames, None si la connexion est fermee ou en erreur
+        """
+        if self.__closed:
             return None
+        frames = list(self.scans)
+        self.scans.clear()
+        try:
+            n = self.sock.recv_into(self.framer.writable())
+        except (BlockingIOError, InterruptedError, socket.timeout):
+            return frames
+        except OSError as exc: # connexion reinitialisee, reseau coupe...
+            logging.error('readFrames(): Erreur de lecture : %s', exc)
+            self.__closed = True
+            return frames or None
+        if n == 0:
+            logging.error('readFrames(): Connexion fermee par le telemetre')
+            self.__closed = True
+            return frames or None
+        self.framer.commit(n)
+        frames.extend(self.framer)
+        return frames
 
     def saveConfig(self):
         """
             Enregistre les parametres dans la memeoire du telemetre
             Les reglages seront gardes apres un redemarrage
         """
-        buf = b'\x02sMN mEEwriteall\x03'
-        sent = self.sock.send(buf)
-        if sent < len(buf):
-            logging.error("saveConfig(): Tous les octets n'ont pas ete envoyes")
-
-        time.sleep(1)   #writing to EEPROM takes some time
-        rec = self.sock.recv(128)
-        if bytes([rec[0]]) != b'\x02':
-            logging.warning('saveConfig(): Trame recue non valide')
-
-        logging.debug('saveConfig() envoye: %s', buf)
-        logging.debug('saveConfig() recu: %s', rec)
+        # l'ecriture en EEPROM prend du temps, la reponse est envoyee a la fin
+        self.__request('saveConfig', b'sMN mEEwriteall', timeout=SAVE_TIMEOUT)
 
     def startDevice(self):
         """
             Remet l'appareil en mode mesure apres la configuration
         """
-        buf = b'\x02sMN Run\x03'
-        sent = self.sock.send(buf)
-        if sent < len(buf):
-            logging.error("startDevice(): Tous les octets n'ont pas ete envoyes")
-
-        rec = self.sock.recv(128)
-        if bytes([rec[0]]) != b'\x02':
-            logging.warning('startDevice(): Trame recue non valide')
-
-        logging.debug('startDevice() envoye: %s', buf)
-        logging.debug('startDevice() recu: %s', rec)
+        self.__request('startDevice', b'sMN Run')
@@ -0,0 +1,317 @@
+"""
+    Client asyncio pour le LMS 5xx (CoLa-A ou CoLa-B)
+    Une tache lit le flux en continu et le decoupe en trames (framer). Chaque
+    reponse est associee a la commande en attente de meme nom (sAN X pour sMN X,
+    sRA X pour sRN X...), plusieurs commandes peuvent donc etre envoyees sans
+    attendre les reponses. Les trames LMDscandata sont placees dans une file.
+    Un meme processus peut piloter plusieurs telemetres dans une seule boucle asyncio
+"""
+
+import time
+import asyncio
+import logging
+import socket
+from structs import scanCfg
+from framer import TelegramFramer, BinaryFramer
+import cola
+from cola import ERROR, SCAN_KEY, replyKey, frameKey
+
+# temps d'attente par defaut d'une reponse (s)
+TIMEOUT = 2
+# temps d'attente max de la reponse a l'enregistrement en EEPROM (s)
+SAVE_TIMEOUT = 10
+
+class AsyncLMS5xx:
+    """
+        Classe permettant de communiquer avec le LMS 5xx depuis une boucle asyncio
+        Memes commandes que la classe LMS5xx, sous forme de coroutines
+    """
+    def __init__(self, binary=False, maxscans=10000):
+        """
+            @param binary: utilise le protocole binaire CoLa-B
+            @param maxscans: nombre max de trames de donnees en attente de lecture
+        """
+        self.binary = binary
+        self.reader = None
+        self.writer = None
+        self.task = None # tache de lecture du flux
+        self.framer = BinaryFramer() if binary else TelegramFramer()
+        self.pending = [] # commandes en attente de reponse : (cle, future), dans l'ordre
+        self.scans = asyncio.Queue(maxscans) # trames LMDscandata recues
+        self.overflows = 0 # trames de donnees jetees (file pleine)
+        self.unexpected = 0 # reponses sans commande en attente
+
+    async def connect(self, host, port, timeout=5, rcvbuf=None):
+        """
+            Connection au LMS 5xx
+            @param host: adresse IP du telemetre
+            @param port: port d'ecoute du LMS (2111 en ASCII, 2112 en binaire)
+            @param timeout: temps d'attente max de la connexion (s)
+            @param rcvbuf: taille du buffer de reception du socket (SO_RCVBUF)
+            @return: True si la connexion a reussi
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if rcvbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        sock.setblocking(False)
+        try:
+            await asyncio.wait_for(asyncio.get_running_loop().sock_connect(sock, (host, port)),\
+                timeout)
+        except (asyncio.TimeoutError, OSError):
+            sock.close()
+            logging.error('Impossible de se connecter au LMS %s:%s', host, port)
+            return False
+        self.reader, self.writer = await asyncio.open_connection(sock=sock)
+        self.task = asyncio.ensure_future(self.__readLoop())
+        logging.info('LMS %s:%s connecte avec succes', host, port)
+        return True
+
+    def isConnected(self):
+        """
+            Retourne l'etat de la connection
+        """
+        return self.task is not None and not self.task.done()
+
+    async def disconnect(self):
+        """
+            Deconnection du telemetre
+        """
+        if self.writer is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.writer.close()
+        await self.writer.wait_closed()
+        self.writer = None
+        self.__failAll(ConnectionError('Deconnecte du LMS'))
+        logging.info('Deconnecte du LMS')
+
+    async def __readLoop(self):
+        """
+            Lis le flux, decoupe les trames et les distribue
+        """
+        try:
+            while True:
+                data = await self.reader.read(1 << 16)
+                if not data:
+                    logging.error('Connexion fermee par le telemetre')
+                    break
+                for frame in self.framer.feed(data):
+                    self.__dispatch(frame)
+        finally:
+            self.__failAll(ConnectionError('Connexion au LMS perdue'))
+
+    def __dispatch(self, frame):
+        """
+            Transmet une trame a la commande en attente correspondante ou a la file
+            des trames de donnees
+        """
+        data = bytes(cola.payload(frame)) if self.binary else frame[1:-1]
+        key = frameKey(data)
+        if key == SCAN_KEY:
+            try:
+                self.scans.put_nowait(frame)
+            except asyncio.QueueFull:
+                self.overflows += 1
+            return
+        reply = frame if not self.binary else data
+        for i, (wanted, fut) in enumerate(self.pending):
+            if key[0] == ERROR or wanted == key:
+                del self.pending[i]
+                if fut.done():
+                    break
+                if key[0] == ERROR:
+                    fut.set_exception(RuntimeError('Erreur du telemetre : '+\
+                        data.decode(errors='replace')))
+                else:
+                    fut.set_result(reply)
+                return
+        self.unexpected += 1
+        logging.debug('Trame recue sans commande en attente : %s', data[:64])
+
+    def __failAll(self, exc):
+        for _, fut in self.pending:
+            if not fut.done():
+                fut.set_exception(exc)
+        self.pending = []
+
+    async def request(self, name, cmd, params=(), timeout=TIMEOUT):
+        """
+            Envoie une commande et attend sa reponse
+            La commande est ecrite avant la premiere attente : des appels lances
+            ensemble (asyncio.gather) sont envoyes dans l'ordre et traites en parallele
+            @param name: nom de la methode appelante (pour les logs)
+            @param cmd: commande (ex: b'sMN LMCstartmeas')
+            @param params: liste de tuples (format struct, valeur)
+            @param timeout: temps d'attente max de la reponse (s)
+            @return: reponse (trame CoLa-A ou donnees CoLa-B) ou None si erreur
+            @rtype: bytes ou None
+        """
+        if not self.isConnected():
+            logging.error('%s(): LMS non connecte', name)
+            return None
+        buf = cola.encodeBinary(cmd, params) if self.binary else cola.encodeAscii(cmd, params)
+        fut = asyncio.get_running_loop().create_future()
+        self.pending.append((replyKey(cmd), fut))
+        self.writer.write(buf)
+        logging.debug('%s() envoye: %s', name, buf)
+        try:
+            await self.writer.drain()
+            rec = await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            logging.warning('%s(): Pas de reponse apres %s s', name, timeout)
+            return None
+        except (RuntimeError, ConnectionError) as exc:
+            logging.warning('%s(): %s', name, exc)
+            return None
+        finally:
+            self.pending = [x for x in self.pending if x[1] is not fut]
+        logging.debug('%s() recu: %s', name, rec)
+        return rec
+
+    async def setTime(self):
+        """
+            Synchronise l'horloge du telemetre sur celle de l'hote
+        """
+        tps = time.localtime()
+        return await self.request('setTime', b'sMN LSPsetdatetime', [('H', tps.tm_year),\
+            ('B', tps.tm_mon), ('B', tps.tm_mday), ('B', tps.tm_hour),\
+            ('B', tps.tm_min), ('B', tps.tm_sec), ('I', 0)])
+
+    async def setEchoFilter(self, code):
+        """
+            Change le parametre du filtre d'echo du telemetre
+            @param code: 0 premier echo, 1 tous les echos, 2 dernier echo
+        """
+        return await self.request('setEchoFilter', b'sWN FREchoFilter', [('B', code)])
+
+    async def startMeas(self):
+        return await self.request('startMeas', b'sMN LMCstartmeas')
+
+    async def stopMeas(self):
+        return await self.request('stopMeas', b'sMN LMCstopmeas')
+
+    async def queryStatus(self):
+        """
+            Retourne le code d'etat actuel tu telemetre (7 : en mesure), 0 si pas de reponse
+        """
+        rec = await self.request('queryStatus', b'sRN STlms')
+        if rec is None:
+            return 0
+        return cola.decodeStatus(rec, self.binary)
+
+    async def waitReady(self, timeout=30, interval=0.1):
+        """
+            Attend que le telemetre soit en mesure (code d'etat 7)
+            @param timeout: temps d'attente max (s)
+            @param interval: periode d'interrogation (s)
+            @return: True si le telemetre est pret avant le timeout
+        """
+        deadline = time.monotonic() + timeout
+        while await self.queryStatus() < 7:
+            if time.monotonic() > deadline:
+                logging.error("waitReady(): Le telemetre n'est pas pret apres %s s", timeout)
+                return False
+            await asyncio.sleep(interval)
+        return True
+
+    async def login(self):
+        """
+            Authentification. Augmente le niveau d'acces, permet de changer la configuration
+        """
+        return await self.request('login', b'sMN SetAccessMode', [('b', 3), ('I', 0xF4724744)])
+
+    async def getScanCfg(self):
+        """
+            Retourne la configuration actuelle du scanner
+            @rtype: structure scanCfg ou None
+        """
+        rec = await self.request('getScanCfg', b'sRN LMPscancfg')
+        if rec is None:
+            return None
+        cfg = scanCfg()
+        cfg.scaningFrequency, cfg.angleResolution, cfg.startAngle, cfg.stopAngle =\
+            cola.decodeScanCfg(rec, self.binary)
+        return cfg
+
+    async def setScanCfg(self, cfg):
+        """
+            Change la configuration du scan
+            @param cfg: structure scanCfg contenant les parametres
+        """
+        return await self.request('setScanCfg', b'sMN mLMPsetscancfg',\
+            [('I', cfg.scaningFrequency), ('h', 1), ('I', cfg.angleResolution),\
+            ('i', cfg.startAngle), ('i', cfg.stopAngle)])
+
+    async def setScanDataCfg(self, cfg):
+        """
+            Change la configuration d'acquisition des donnees
+            @param cfg: structure scanDataCfg contenant les parametres
+        """
+        return await self.request('setScanDataCfg', b'sWN LMDscandatacfg', [('B', 0), ('B', 0),\
+            ('B', cfg.remission), ('B', cfg.resolution), ('B', 0), ('B', 0), ('B', 0),\
+            ('B', cfg.position), ('B', cfg.deviceName), ('B', 0), ('B', cfg.timestamp),\
+            ('H', cfg.outputinterval)])
+
+    async def scanContinous(self, start):
+        """
+            Demarre (1) ou arrete (0) l'envoi continu des trames de donnees
+        """
+        return await self.request('scanContinous', b'sEN LMDscandata', [('B', start)])
+
+    async def saveConfig(self):
+        """
+            Enregistre les parametres dans la memoire du telemetre
+            La reponse est envoyee a la fin de l'ecriture en EEPROM, pas d'attente fixe
+        """
+        return await self.request('saveConfig', b'sMN mEEwriteall', timeout=SAVE_TIMEOUT)
+
+    async def startDevice(self):
+        """
+            Remet l'appareil en mode mesure apres la configuration
+        """
+        return await self.request('startDevice', b'sMN Run')
+
+    async def configure(self, cfg, datacfg, echo, timeout=30):
+        """
+            Charge la configuration dans le telemetre, l'enregistre en EEPROM,
+            redemarre la mesure et attend que le telemetre soit pret
+            Les reglages sont envoyes en une fois, sans attendre chaque reponse
+            @param cfg: structure scanCfg
+            @param datacfg: structure scanDataCfg
+            @param echo: code du filtre d'echo
+            @param timeout: temps d'attente max du telemetre pret (s)
+            @return: True si le telemetre est pret
+        """
+        replies = await asyncio.gather(self.login(), self.setTime(), self.setScanCfg(cfg),\
+            self.setScanDataCfg(datacfg), self.setEchoFilter(echo))
+        if None in replies:
+            logging.warning('configure(): reglages sans reponse : %s', replies)
+        await self.saveConfig()
+        await self.startDevice()
+        return await self.waitReady(timeout)
+
+    async def getScanData(self, timeout):
+        """
+            Retourne une trame de donnees complete
+            @param timeout: temps d'attente max d'une trame
+            @return: Trame recue ou None si rien recu avant le timeout
+            @rtype: bytes ou None
+        """
+        try:
+            return await asyncio.wait_for(self.scans.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def stats(self):
+        """
+            Retourne les statistiques de reception
+            @rtype: dict
+        """
+        res = self.framer.stats()
+        res.update({'overflows': self.overflows, 'unexpected': self.unexpected,\
+            'backlog': self.scans.qsize()})
+        return res
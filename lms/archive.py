@@ -0,0 +1,201 @@
+"""
+    Archive binaire a enregistrements de taille fixe, lisible avec numpy.memmap
+    Une archive est composee de trois fichiers :
+        <nom>.scan : enregistrements (en-tete + N distances + N remissions par canal)
+        <nom>.idx : index (compteur de scan deroule, date, position dans <nom>.scan)
+        <nom>.json : description des enregistrements (canaux, nb de mesures, metadonnees)
+    Les enregistrements sont ajoutes a la fin des fichiers, une archive peut donc
+    etre lue pendant qu'elle est ecrite. Les archives sont ecrites a partir des
+    blocs compresses (decompress.py -f archive), l'enregistreur n'en ecrit pas
+    Le compteur de scan du telemetre est sur 16 bits et revient a zero tous les
+    65536 scans : l'index garde un compteur deroule, croissant sur toute l'archive
+"""
+
+import os
+import json
+import numpy as np
+import decoder
+from gaps import MODULO
+
+# champs de l'en-tete de chaque enregistrement
+HEADER_FIELDS = [('timestamp', '<i8'), ('telegramCounter', '<u4'), ('scanCounter', '<u4'),\
+    ('timeSinceStartup', '<u4')]
+# enregistrements de l'index (scanCounter : compteur deroule)
+INDEX_DTYPE = np.dtype([('scanCounter', '<u4'), ('timestamp', '<i8'), ('offset', '<u8')])
+
+def recordDtype(amounts):
+    """
+        Retourne le type d'un enregistrement
+        @param amounts: liste de tuples (nom du canal, nb de mesures)
+        @rtype: numpy.dtype
+    """
+    return np.dtype(HEADER_FIELDS + [(name, '<u2', (amount,)) for name, amount in amounts])
+
+class ArchiveWriter:
+    """
+        Ajout de lots de trames decodees (module decoder) a une archive
+    """
+    def __init__(self, path, channels, metadata=None):
+        """
+            @param path: chemin de l'archive sans extension
+            @param channels: liste des canaux a enregistrer (ex: ['DIST1', 'RSSI1'])
+            @param metadata: dict de metadonnees enregistre dans <path>.json
+        """
+        self.path = path
+        self.channels = channels
+        self.metadata = metadata or {}
+        self.dtype = None # cree avec le premier lot (nb de mesures par canal)
+        self.data = None
+        self.index = None
+        self.offset = 0 # position du prochain enregistrement
+        self.scan = None # compteur de scan du dernier enregistrement
+        self.unwrapped = None # compteur deroule du dernier enregistrement
+
+    def __open(self, batch):
+        amounts = [(name, batch['channels'][name].shape[1]) for name in self.channels]
+        desc = {'channels': amounts, 'metadata': self.metadata}
+        if os.path.exists(self.path+'.json'):
+            # ajout a une archive existante : les enregistrements doivent etre identiques
+            with open(self.path+'.json', 'r') as fic:
+                old = json.load(fic)
+            if [tuple(x) for x in old['channels']] != amounts:
+                raise ValueError('Archive '+self.path+' incompatible avec les donnees')
+        else:
+            with open(self.path+'.json', 'w') as fic:
+                json.dump(desc, fic)
+        self.dtype = recordDtype(amounts)
+        self.data = open(self.path+'.scan', 'ab')
+        self.index = open(self.path+'.idx', 'ab')
+        # un enregistrement incomplet ou absent de l'index (arret brutal) est ecrase
+        n = min(self.data.tell() // self.dtype.itemsize, self.index.tell() // INDEX_DTYPE.itemsize)
+        self.offset = n * self.dtype.itemsize
+        self.data.truncate(self.offset)
+        self.index.truncate(n * INDEX_DTYPE.itemsize)
+        if n:
+            # le compteur deroule continue celui de l'archive existante
+            self.scan = int(np.fromfile(self.path+'.scan', dtype=self.dtype, count=1,\
+                offset=self.offset - self.dtype.itemsize)['scanCounter'][0])
+            self.unwrapped = int(np.fromfile(self.path+'.idx', dtype=INDEX_DTYPE, count=1,\
+                offset=(n - 1) * INDEX_DTYPE.itemsize)['scanCounter'][0])
+
+    def append(self, batch):
+        """
+            Ajoute un lot de trames a l'archive
+            @param batch: lot retourne par decoder.decodeBatch() ou decodeBinaryBatch()
+        """
+        if self.dtype is None:
+            self.__open(batch)
+        n = len(batch['header'])
+        records = np.zeros(n, dtype=self.dtype)
+        stamps = batch['timestamp'] if 'timestamp' in batch else decoder.timestamps(batch['date'])
+        records['timestamp'] = stamps.astype(np.int64)
+        for name in ('telegramCounter', 'scanCounter', 'timeSinceStartup'):
+            records[name] = batch['header'][name]
+        for name in self.channels:
+            records[name] = batch['channels'][name]
+
+        index = np.zeros(n, dtype=INDEX_DTYPE)
+        index['scanCounter'] = self.__unwrap(records['scanCounter'])
+        index['timestamp'] = records['timestamp']
+        index['offset'] = self.offset + np.arange(n, dtype=np.uint64)*self.dtype.itemsize
+
+        records.tofile(self.data)
+        index.tofile(self.index)
+        self.offset += n*self.dtype.itemsize
+
+    def __unwrap(self, scans):
+        """
+            Retourne le compteur deroule des compteurs de scan scans : les ecarts
+            entre compteurs successifs (modulo 65536) sont cumules
+        """
+        if not len(scans):
+            return scans
+        scans = scans.astype(np.int64)
+        prev = scans[0] if self.scan is None else self.scan
+        base = scans[0] if self.unwrapped is None else self.unwrapped
+        steps = np.diff(scans, prepend=prev) % MODULO
+        unwrapped = base + np.cumsum(steps)
+        self.scan = int(scans[-1])
+        self.unwrapped = int(unwrapped[-1])
+        return unwrapped
+
+    def flush(self):
+        """
+            Rend les enregistrements ajoutes visibles pour les lecteurs
+        """
+        if self.data is not None:
+            self.data.flush()
+            self.index.flush()
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.index.close()
+
+class ArchiveReader:
+    """
+        Lecture d'une archive par numpy.memmap, sans lire les donnees inutiles
+    """
+    def __init__(self, path):
+        """
+            @param path: chemin de l'archive sans extension
+        """
+        with open(path+'.json', 'r') as fic:
+            desc = json.load(fic)
+        self.channels = [x[0] for x in desc['channels']]
+        self.metadata = desc['metadata']
+        self.dtype = recordDtype([tuple(x) for x in desc['channels']])
+        # seuls les enregistrements complets sont lus (archive en cours d'ecriture)
+        nrec = os.path.getsize(path+'.scan') // self.dtype.itemsize
+        nidx = os.path.getsize(path+'.idx') // INDEX_DTYPE.itemsize
+        n = min(nrec, nidx)
+        self.records = np.memmap(path+'.scan', dtype=self.dtype, mode='r', shape=(n,))\
+            if n else np.zeros(0, dtype=self.dtype)
+        self.index = np.memmap(path+'.idx', dtype=INDEX_DTYPE, mode='r', shape=(n,))\
+            if n else np.zeros(0, dtype=INDEX_DTYPE)
+
+    def __len__(self):
+        return len(self.records)
+
+    def timeRange(self, start, stop):
+        """
+            Retourne les enregistrements dont la date est comprise entre start et stop
+            Les dates de l'index doivent etre croissantes (une seule session)
+            @param start: date de debut (numpy.datetime64 ou chaine ISO)
+            @param stop: date de fin (incluse)
+            @rtype: tableau structure (vue sur le fichier)
+        """
+        start = np.datetime64(start, 'us').astype(np.int64)
+        stop = np.datetime64(stop, 'us').astype(np.int64)
+        times = self.index['timestamp']
+        first = np.searchsorted(times, start, side='left')
+        last = np.searchsorted(times, stop, side='right')
+        return self.records[first:last]
+
+    def scanRange(self, first, last):
+        """
+            Retourne les enregistrements dont le compteur de scan est compris
+            entre first et last (inclus)
+            Le compteur revient a zero tous les 65536 scans : l'intervalle est la
+            premiere occurrence de first a partir du debut de l'archive, last peut
+            etre apres un retour a zero (ex: 65500 a 100)
+            @param first: compteur de scan du telemetre (16 bits)
+            @param last: compteur de scan du telemetre (16 bits)
+            @rtype: tableau structure (vue sur le fichier)
+        """
+        scans = self.index['scanCounter']
+        if not len(scans):
+            return self.records[0:0]
+        # traduction en compteur deroule
+        origin = int(scans[0])
+        first = origin + (first - origin) % MODULO
+        last = first + (last - first) % MODULO
+        begin = np.searchsorted(scans, first, side='left')
+        end = np.searchsorted(scans, last, side='right')
+        return self.records[begin:end]
+
+    def timestamps(self, records):
+        """
+            Retourne les dates des enregistrements en datetime64[us]
+        """
+        return records['timestamp'].astype('datetime64[us]')
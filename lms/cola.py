@@ -0,0 +1,163 @@
+"""
+    Encodage des commandes et decodage des trames du protocole SOPAS CoLa
+    CoLa-A : trames ASCII, valeurs en hexadecimal separees par des espaces (port 2111)
+    CoLa-B : trames binaires big-endian avec longueur et checksum (port 2112)
+"""
+
+import struct
+from framer import BINARY_STX, checksum
+
+# type de la reponse a chaque type de commande
+REPLIES = {b'sRN': b'sRA', b'sWN': b'sWA', b'sMN': b'sAN', b'sEN': b'sEA'}
+# reponse d'erreur du telemetre
+ERROR = b'sFA'
+# cle des trames de donnees envoyees en continu
+SCAN_KEY = (b'sSN', b'LMDscandata')
+
+def replyKey(cmd):
+    """
+        Retourne la cle (type, nom) de la reponse attendue a la commande cmd
+        @param cmd: commande (ex: b'sMN LMCstartmeas')
+    """
+    kind, name = cmd.split(b' ', 2)[:2]
+    return REPLIES.get(kind, kind), name
+
+def frameKey(data):
+    """
+        Retourne la cle (type, nom) d'une trame recue
+        @param data: trame CoLa-A sans STX/ETX ou donnees d'une trame CoLa-B (payload())
+    """
+    return tuple(data.split(b' ', 2)[:2])
+
+def encodeAscii(cmd, params=()):
+    """
+        Construit une trame CoLa-A
+        @param cmd: commande (ex: b'sMN LMCstartmeas')
+        @param params: liste de tuples (format struct, valeur)
+        @rtype: bytes
+    """
+    tokens = [cmd]
+    for fmt, value in params:
+        mask = (1 << (8*struct.calcsize('>'+fmt))) - 1
+        tokens.append(bytes(hex(value & mask)[2:].upper(), encoding='utf8'))
+    return b'\x02'+b' '.join(tokens)+b'\x03'
+
+def encodeBinary(cmd, params=()):
+    """
+        Construit une trame CoLa-B
+        @param cmd: commande (ex: b'sMN LMCstartmeas')
+        @param params: liste de tuples (format struct, valeur)
+        @rtype: bytes
+    """
+    payload = cmd
+    if params:
+        fmt = '>'+''.join([x[0] for x in params])
+        payload += b' '+struct.pack(fmt, *[x[1] for x in params])
+    return BINARY_STX+struct.pack('>I', len(payload))+payload+bytes([checksum(payload)])
+
+def payload(telegram):
+    """
+        Retourne les donnees d'une trame CoLa-B complete (sans en-tete ni checksum)
+        @rtype: memoryview
+    """
+    return memoryview(telegram)[8:-1]
+
+# en-tete fixe d'une trame LMDscandata, apres b'sSN LMDscandata '
+HEADER = struct.Struct('>HHIBBHHIIBBBBHII')
+HEADER_FIELDS = ('version', 'device', 'serial', 'status1', 'status2', 'telegramCounter',\
+    'scanCounter', 'timeSinceStartup', 'timeOfTransmission', 'input1', 'input2',\
+    'output1', 'output2', 'reserved', 'scanFrequency', 'measFrequency')
+# description d'un canal de donnees : nom, facteur d'echelle, offset, angle de depart, pas, nb
+CHANNEL = struct.Struct('>5sffiHH')
+# date de la mesure : annee, mois, jour, heure, minute, seconde, microseconde
+DATE = struct.Struct('>HBBBBBI')
+
+def decodeScanData(telegram):
+    """
+        Decode une trame CoLa-B LMDscandata
+        @param telegram: trame complete (en-tete et checksum compris)
+        @return: dict contenant les champs de l'en-tete, les canaux de mesure
+            (cle 'channels', dict nom -> dict) et la date (cle 'date', tuple ou None)
+        @rtype: dict
+    """
+    data = payload(telegram)
+    pos = bytes(data[:32]).index(b'LMDscandata ') + len(b'LMDscandata ')
+    res = dict(zip(HEADER_FIELDS, HEADER.unpack_from(data, pos)))
+    pos += HEADER.size
+
+    # encodeurs
+    nbenc, = struct.unpack_from('>H', data, pos)
+    pos += 2 + 6*nbenc
+
+    # canaux 16 bits (DISTn et RSSIn en resolution 16 bits) puis canaux 8 bits
+    channels = {}
+    for width in ('H', 'B'):
+        nbchan, = struct.unpack_from('>H', data, pos)
+        pos += 2
+        for _ in range(nbchan):
+            name, scale, offset, start, step, amount = CHANNEL.unpack_from(data, pos)
+            pos += CHANNEL.size
+            fmt = '>'+str(amount)+width
+            channels[name.decode()] = {'scale': scale, 'offset': offset, 'start': start,\
+                'step': step, 'amount': amount, 'values': struct.unpack_from(fmt, data, pos)}
+            pos += struct.calcsize(fmt)
+    res['channels'] = channels
+
+    # position, nom de l'appareil et commentaire optionnels
+    flag, = struct.unpack_from('>H', data, pos)
+    pos += 2
+    if flag:
+        pos += 4*6 + 1 # coordonnees X Y Z, rotations X Y Z (Real), type de rotation
+    flag, = struct.unpack_from('>H', data, pos)
+    pos += 2
+    if flag:
+        pos += 1 + data[pos]
+    flag, = struct.unpack_from('>H', data, pos)
+    pos += 2
+    if flag:
+        pos += 1 + data[pos]
+
+    # date de la mesure
+    flag, = struct.unpack_from('>H', data, pos)
+    pos += 2
+    res['date'] = DATE.unpack_from(data, pos) if flag else None
+    return res
+
+def asciiTokens(telegram):
+    """
+        Retourne les elements d'une trame CoLa-A (sans STX/ETX)
+        @rtype: liste de bytes
+    """
+    return bytes(telegram).strip(b'\x02\x03').split()
+
+def signed(token, bits=32):
+    """
+        Convertit un element hexadecimal CoLa-A en entier signe sur bits bits
+    """
+    value = int(token, 16)
+    return value - (1 << bits) if value >= 1 << (bits - 1) else value
+
+def decodeStatus(reply, binary):
+    """
+        Retourne le code d'etat contenu dans la reponse a 'sRN STlms'
+        @param reply: trame CoLa-A ou donnees de la trame CoLa-B
+        @param binary: reponse CoLa-B
+        @rtype: int
+    """
+    if binary:
+        return struct.unpack_from('>H', reply, len(b'sRA STlms '))[0]
+    return int(asciiTokens(reply)[2], 16)
+
+def decodeScanCfg(reply, binary):
+    """
+        Retourne la configuration contenue dans la reponse a 'sRN LMPscancfg'
+        @param reply: trame CoLa-A ou donnees de la trame CoLa-B
+        @param binary: reponse CoLa-B
+        @return: frequence de scan, resolution, angle de depart, angle d'arret
+        @rtype: tuple
+    """
+    if binary:
+        freq, _, res, start, stop = struct.unpack_from('>IhIii', reply, len(b'sRA LMPscancfg '))
+        return freq, res, start, stop
+    tokens = asciiTokens(reply)
+    return int(tokens[2], 16), int(tokens[4], 16), signed(tokens[5]), signed(tokens[6])
@@ -0,0 +1,582 @@
+"""
+    Pool de processus de compression persistants
+    Les processus sont crees une seule fois au debut de l'acquisition. Chaque bloc
+    de trames est confie a un processus qui compresse les trames au fil de l'eau et
+    ecrit le resultat dans un fichier temporaire (extension PART), renomme a la fin
+    du bloc. Le bloc est ecrit en morceaux independants (flux xz, membres gzip ou
+    trames zstd/lz4 concatenes) synchronises sur le disque : apres un crash ou une
+    coupure de courant, recover.py recupere tous les morceaux complets
+    Au format delta (module delta), les mesures sont mises en colonnes et
+    differenciees entre scans avant la compression
+    Codecs disponibles : xz, gzip, zstd (module zstandard) et lz4 (module lz4)
+"""
+
+import os
+import time
+import errno
+import lzma
+import gzip
+import zlib
+import queue
+import logging
+import multiprocessing
+try:
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    fallocate = libc.fallocate
+    fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong)
+except (ImportError, OSError, AttributeError): # pas de fallocate (systeme autre que Linux)
+    fallocate = None
+try:
+    import zstandard
+except ImportError: # codec zstd indisponible
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError: # codec lz4 indisponible
+    lz4 = None
+try:
+    from summary import BlockSummary, appendIndex
+except ImportError: # numpy absent, pas d'index des blocs
+    BlockSummary = None
+try:
+    from delta import DeltaEncoder
+except ImportError: # numpy absent, format delta indisponible
+    DeltaEncoder = None
+
+class LZ4Compressor:
+    """
+        Adapte lz4.frame.LZ4FrameCompressor a l'interface compress()/flush()
+    """
+    def __init__(self, level):
+        self.lzc = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self.head = self.lzc.begin() # en-tete de la trame lz4
+
+    def compress(self, data):
+        res = self.head + self.lzc.compress(data)
+        self.head = b''
+        return res
+
+    def flush(self):
+        return self.head + self.lzc.flush()
+
+def makeCompressor(codec, level=None):
+    """
+        Retourne un compresseur de flux (methodes compress() et flush())
+        @param codec: nom du codec (voir CODECS)
+        @param level: niveau de compression, None pour le niveau par defaut du codec
+    """
+    if level is None:
+        level = CODECS[codec][1]
+    if codec == 'xz':
+        return lzma.LZMACompressor(preset=level)
+    if codec == 'gzip':
+        return zlib.compressobj(level, zlib.DEFLATED, 31) # 31 : en-tete gzip
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    return LZ4Compressor(level)
+
+# extension des blocs en cours d'ecriture
+PART = '.part'
+# un morceau independant est termine tous les CHUNK_SIZE octets avant compression
+# ou toutes les CHUNK_PERIOD secondes (donnees perdues au pire en cas de coupure)
+CHUNK_SIZE = 8*1024*1024
+CHUNK_PERIOD = 30
+# les donnees compressees sont ecrites par paquets d'au moins WRITE_SIZE octets,
+# alignes sur ALIGN octets dans le fichier
+WRITE_SIZE = 1024*1024
+ALIGN = 64*1024
+# pas de reservation de la place des blocs (fallocate)
+PREALLOC = 16*1024*1024
+# reservation sans changer la taille du fichier (linux/falloc.h)
+FALLOC_FL_KEEP_SIZE = 1
+# erreurs de fallocate d'un systeme de fichiers sans reservation (exFAT, NTFS via FUSE...)
+NO_FALLOCATE = (errno.EOPNOTSUPP, errno.ENOSYS)
+
+def reserve(fd, offset, length):
+    """
+        Reserve la place d'un fichier sans ecrire de zeros ni changer sa taille
+        Contrairement a posix_fallocate, la glibc ne remplit pas le fichier de zeros
+        sur un systeme de fichiers sans reservation : l'erreur est retournee
+        @return: False si le systeme de fichiers ne permet pas la reservation
+        @rtype: bool
+    """
+    if fallocate is None:
+        return False
+    if fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in NO_FALLOCATE:
+        return False
+    raise OSError(err, os.strerror(err))
+
+def fsyncDir(path):
+    """
+        Synchronise un dossier sur le disque (rend un renommage durable)
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class BlockWriter:
+    """
+        Ecriture d'un bloc compresse en morceaux independants
+        Chaque morceau est un flux complet du codec, les lecteurs habituels (xz,
+        gzip, lzma.open...) lisent les flux concatenes comme un seul fichier
+        La position de chaque morceau est gardee (index) : un morceau peut etre lu
+        seul, sans decompresser le debut du bloc (decompress.py --seek/--range)
+        La memoire utilisee est celle d'un seul compresseur et d'un tampon d'ecriture
+        Les donnees compressees sont ecrites par paquets d'au moins WRITE_SIZE octets
+        alignes sur ALIGN octets, dans une place reservee par fallocate par pas de
+        prealloc octets (moins de fragmentation). La reservation demande un systeme de
+        fichiers qui la gere (ext4, XFS, Btrfs, FAT32), elle est abandonnee sinon (exFAT)
+    """
+    def __init__(self, path, codec='xz', level=None, chunk=CHUNK_SIZE, period=CHUNK_PERIOD,\
+        prealloc=PREALLOC):
+        """
+            @param path: chemin final du bloc
+            @param codec: codec de compression (voir CODECS)
+            @param level: niveau de compression, None pour le niveau par defaut
+            @param chunk: taille max d'un morceau avant compression (octets)
+            @param period: duree max d'un morceau (s)
+            @param prealloc: pas de reservation de la place du fichier (octets), 0 pour
+                ne pas reserver
+        """
+        self.path = path
+        self.codec = codec
+        self.level = level
+        self.chunk = chunk
+        self.period = period
+        self.prealloc = prealloc if fallocate is not None else 0
+        self.out = open(path + PART, 'wb', buffering=0)
+        self.buffer = bytearray() # donnees compressees pas encore ecrites
+        self.pos = 0 # octets ecrits dans le fichier
+        self.allocated = 0 # octets reserves dans le fichier
+        self.compressor = makeCompressor(codec, level)
+        self.raw = 0 # octets du morceau en cours avant compression
+        self.deadline = time.monotonic() + period
+        self.chunks = 0 # morceaux termines
+        self.index = [] # (position, taille) de chaque morceau termine dans le fichier
+
+    @property
+    def written(self):
+        """
+            Taille du bloc compresse (octets), tampon d'ecriture compris
+        """
+        return self.pos + len(self.buffer)
+
+    def write(self, data):
+        """
+            Compresse et ecrit une trame, termine le morceau si besoin
+            Les morceaux se terminent toujours entre deux trames
+        """
+        self.buffer += self.compressor.compress(data)
+        if len(self.buffer) >= WRITE_SIZE:
+            self.__drain(False)
+        self.raw += len(data)
+        if self.raw >= self.chunk or time.monotonic() >= self.deadline:
+            self.endChunk()
+
+    def __drain(self, full):
+        """
+            Ecrit le tampon dans le fichier
+            @param full: ecrit tout le tampon, sinon seulement jusqu'au dernier
+                multiple de ALIGN (la suite reste dans le tampon)
+        """
+        size = len(self.buffer) if full else (self.written // ALIGN) * ALIGN - self.pos
+        if size <= 0:
+            return
+        if self.prealloc and self.pos + size > self.allocated:
+            end = ((self.pos + size) // self.prealloc + 1) * self.prealloc
+            if reserve(self.out.fileno(), self.allocated, end - self.allocated):
+                self.allocated = end
+            else:
+                logging.info('Reservation impossible sur ce systeme de fichiers : %s', self.path)
+                self.prealloc = 0
+        view = memoryview(self.buffer)
+        done = 0
+        try:
+            while done < size:
+                done += self.out.write(view[done:size])
+        finally:
+            view.release()
+        del self.buffer[:size]
+        self.pos += size
+
+    def endChunk(self):
+        """
+            Termine le morceau en cours et le synchronise sur le disque
+        """
+        self.buffer += self.compressor.flush()
+        self.__drain(True)
+        os.fsync(self.out.fileno())
+        self.__mark()
+        self.compressor = makeCompressor(self.codec, self.level)
+        self.raw = 0
+        self.deadline = time.monotonic() + self.period
+        self.chunks += 1
+
+    def __mark(self):
+        """
+            Ajoute le morceau qui vient d'etre ecrit a l'index
+        """
+        start = sum(self.index[-1]) if self.index else 0
+        self.index.append((start, self.pos - start))
+
+    def close(self, path=None):
+        """
+            Termine le bloc et donne au fichier son nom final (renommage atomique)
+            La place reservee et non utilisee est rendue
+            @param path: chemin final du bloc, None pour celui donne a l'ouverture
+        """
+        if self.raw or not self.chunks: # pas de morceau vide a la fin
+            self.buffer += self.compressor.flush()
+            self.chunks += 1
+            self.__drain(True)
+            self.__mark()
+        if self.allocated > self.pos:
+            os.ftruncate(self.out.fileno(), self.pos)
+        os.fsync(self.out.fileno())
+        self.out.close()
+        if path is not None:
+            self.path = path
+        os.rename(self.out.name, self.path)
+        fsyncDir(os.path.dirname(os.path.abspath(self.path)))
+
+    def abort(self):
+        """
+            Ferme le fichier temporaire sans le renommer (erreur d'ecriture)
+        """
+        try:
+            self.out.close()
+        except OSError:
+            pass
+
+def openBlock(path):
+    """
+        Ouvre en lecture un bloc compresse, le codec est deduit de l'extension
+        @return: fichier decompresse (methode read())
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path)
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError('Le module zstandard est necessaire pour lire '+path)
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'),\
+            read_across_frames=True, closefd=True)
+    if path.endswith('.lz4'):
+        if lz4 is None:
+            raise RuntimeError('Le module lz4 est necessaire pour lire '+path)
+        return lz4.frame.open(path)
+    return lzma.open(path)
+
+# codecs disponibles : nom -> (extension, niveau par defaut)
+CODECS = {'xz': ('.xz', 6), 'gzip': ('.gz', 6)}
+if zstandard is not None:
+    CODECS['zstd'] = ('.zst', 3)
+if lz4 is not None:
+    CODECS['lz4'] = ('.lz4', 0)
+# niveau de compression du mode degrade (place libre faible) : plus lent, fichiers
+# plus petits (xz 7 : dictionnaire de 16 Mo, environ 190 Mo de memoire par processus)
+HIGH_LEVELS = {'xz': 7, 'gzip': 9, 'zstd': 12, 'lz4': 9}
+# extensions de tous les codecs connus (disponibles ou non)
+EXTENSIONS = ('.xz', '.gz', '.zst', '.lz4')
+# le nom des blocs au format delta (module delta) contient DELTA avant l'extension
+# du codec (ex : 20180601100000_1-500.txt.dlt.xz)
+DELTA = '.dlt'
+
+def isDelta(path):
+    """
+        Retourne True si le bloc path est au format delta (d'apres son nom)
+    """
+    return os.path.splitext(os.path.splitext(path)[0])[1] == DELTA
+
+# commandes envoyees aux processus de compression, un processus peut avoir
+# plusieurs blocs ouverts en meme temps (un par telemetre), designes par un numero
+OPEN = 'open' # ('open', bloc, chemin, codec, niveau, filtre, delta) : debut d'un bloc
+FRAME = 'frame' # ('frame', bloc, trame) : trame a ajouter au bloc
+SLICE = 'slice' # ('slice', bloc, position, taille, fin) : trame dans le tampon partage
+CLOSE = 'close' # ('close', bloc, chemin) : fin du bloc, renomme en chemin (ou None)
+STOP = 'stop' # ('stop',) : fin du processus
+# nombre de blocs ouverts en meme temps dont la taille compressee est suivie
+SLOTS = 64
+# attente max d'une place dans une file pleine avant de verifier le processus (s)
+PUT_TIMEOUT = 1
+
+def addFrame(block, data):
+    """
+        Ajoute une trame a un bloc ouvert d'un processus de compression
+        @param block: [BlockWriter, resume, filtre des trames, DeltaEncoder ou None]
+        @param data: trame (bytes ou memoryview du tampon partage)
+    """
+    if block[2] is not None:
+        data = block[2].apply(data)
+    if block[3] is None:
+        writeBlock(block, data, (data,))
+    else:
+        data = block[3].add(data) # enregistrements des groupes termines
+        writeBlock(block, data, block[3].done)
+
+def writeBlock(block, data, frames):
+    """
+        Ecrit des donnees dans un bloc, le resume du bloc suit les morceaux du fichier
+        @param data: trame ou enregistrements au format delta
+        @param frames: trames contenues dans data
+    """
+    if block[1] is not None:
+        for frame in frames:
+            block[1].update(frame)
+    if not data:
+        return
+    chunks = block[0].chunks
+    block[0].write(data)
+    if block[1] is not None and block[0].chunks > chunks:
+        block[1].endChunk() # les trames suivantes sont dans un nouveau morceau
+
+def compressWorker(q, ring=None, index=0, sizes=None, prealloc=PREALLOC, totals=None):
+    """
+        Boucle d'un processus de compression
+        Les trames recues sont filtrees (module filters, si le bloc a un filtre),
+        mises au format delta (module delta, si le bloc est a ce format),
+        compressees et ecrites dans le fichier de leur bloc (BlockWriter). A la fin
+        d'un bloc le fichier est renomme et le resume du bloc est ajoute a l'index du
+        dossier (module summary)
+        Ce processus s'arrete si son processus pere s'arrete. Une erreur pendant le
+        traitement d'une commande abandonne seulement le bloc concerne (les morceaux
+        complets sont recuperables avec recover.py), la place des trames dans le
+        tampon partage est toujours liberee
+        @param q: file contenant les commandes et les trames a compresser
+        @param ring: tampon SharedRing contenant les trames (commandes SLICE)
+        @param index: numero du processus (consommateur du tampon)
+        @param sizes: tableau partage de la taille compressee des blocs ouverts
+            (case numero du bloc % SLOTS), lu par le pool pour la rotation des blocs
+        @param prealloc: pas de reservation de la place des blocs (octets)
+        @param totals: tableau partage des octets compresses produits par chaque processus
+    """
+    parent = os.getppid()
+    blocks = {} # blocs ouverts : numero -> [BlockWriter, resume, filtre, DeltaEncoder]
+    while True:
+        try:
+            item = q.get(timeout=1)
+        except queue.Empty:
+            if os.getppid() != parent: # si ce processus est orphelin (crash du process pere)
+                logging.debug('Arret du processus orphelin avec le PID %s', os.getpid())
+                os._exit(0) # arret direct du processus
+            continue
+
+        cmd = item[0]
+        if cmd == STOP:
+            break
+        block = blocks.get(item[1])
+        try:
+            if cmd == SLICE:
+                _, _, pos, size, end = item
+                if block is not None:
+                    written = block[0].written
+                    addFrame(block, ring.read(pos, size)) # lecture sans copie
+                    if sizes is not None:
+                        sizes[item[1] % SLOTS] = block[0].written
+                        totals[index] += block[0].written - written
+            elif cmd == FRAME:
+                if block is not None:
+                    written = block[0].written
+                    addFrame(block, item[2])
+                    if sizes is not None:
+                        sizes[item[1] % SLOTS] = block[0].written
+                        totals[index] += block[0].written - written
+            elif cmd == OPEN:
+                _, num, path, codec, level, filt, delta = item
+                blocks[num] = [BlockWriter(path, codec, level, prealloc=prealloc),\
+                    BlockSummary() if BlockSummary is not None else None, filt,\
+                    DeltaEncoder() if delta else None]
+            elif cmd == CLOSE:
+                del blocks[item[1]]
+                if block is not None:
+                    if block[3] is not None:
+                        data = block[3].flush()
+                        writeBlock(block, data, block[3].done)
+                    block[0].close(item[2])
+                    path = block[0].path
+                    logging.info('Bloc %s enregistre en %s morceaux (PID %s)', path,\
+                        block[0].chunks, os.getpid())
+                    if block[1] is not None:
+                        appendIndex(os.path.dirname(path), block[1].result(\
+                            os.path.basename(path), os.path.getsize(path), block[0].index))
+        except Exception as exc:
+            # nom du bloc : chemin du fichier s'il est ouvert, sinon numero
+            name = block[0].path if block is not None else\
+                (item[2] if cmd == OPEN else item[1])
+            if isinstance(exc, OSError) and exc.errno == errno.ENOSPC:
+                logging.critical("Support de stockage plein! Bloc %s abandonne", name)
+            elif isinstance(exc, OSError):
+                logging.exception("Erreur d'ecriture du bloc %s, bloc abandonne (PID %s)",\
+                    name, os.getpid())
+            else:
+                logging.exception('Erreur de compression du bloc %s, bloc abandonne (PID %s)',\
+                    name, os.getpid())
+            if block is not None:
+                block[0].abort()
+            if cmd != CLOSE:
+                blocks[item[1]] = None # les trames suivantes du bloc sont ignorees
+        finally:
+            if cmd == SLICE:
+                ring.release(index, item[4])
+    logging.info('Fin du processus avec le PID %s', os.getpid())
+
+class CompressionPool:
+    """
+        Pool de processus de compression alimentes par des files bornees
+        Les blocs sont distribues a tour de role aux processus, plusieurs blocs
+        (un par telemetre) peuvent etre ouverts en meme temps. Quand la file d'un
+        processus est pleine, put() attend (contre-pression) et le temps d'attente
+        est comptabilise. Un processus arrete (erreur) provoque une RuntimeError
+        au lieu d'une attente sans fin
+        Avec un tampon partage, seuls les descripteurs des trames passent par les files
+    """
+    def __init__(self, workers=2, maxsize=2000, ring=None, prealloc=PREALLOC):
+        """
+            @param workers: nombre de processus de compression
+            @param maxsize: nombre max de trames en attente par processus
+            @param ring: tampon SharedRing contenant les trames, un consommateur par processus
+            @param prealloc: pas de reservation de la place des blocs (octets), 0 pour
+                ne pas reserver
+        """
+        self.ring = ring
+        # taille compressee des blocs ouverts, ecrite par les processus sans verrou
+        self.sizes = multiprocessing.RawArray('q', SLOTS)
+        # octets compresses produits par chaque processus depuis le debut
+        self.totals = multiprocessing.RawArray('q', workers)
+        self.queues = [multiprocessing.Queue(maxsize) for _ in range(workers)]
+        self.procs = [multiprocessing.Process(target=compressWorker,\
+            args=(q, ring, i, self.sizes, prealloc, self.totals))\
+            for i, q in enumerate(self.queues)]
+        for p in self.procs:
+            p.start()
+            logging.debug("Demarrage d'un processus de compression avec le PID %s", p.pid)
+        self.open = {} # blocs ouverts : numero -> numero du processus
+        self.current = None # dernier bloc commence
+        self.blocks = 0 # nombre de blocs commences
+        self.frames = 0 # nombre de trames transmises
+        self.blocked = 0 # nombre de put() ayant attendu
+        self.blockedTime = 0.0 # temps total d'attente (s)
+        self.maxDepth = 0 # nombre max de trames en attente observe
+
+    def startBlock(self, path, codec='xz', level=None, filt=None, delta=False):
+        """
+            Commence un nouveau bloc enregistre dans path
+            @param codec: codec de compression du bloc (voir CODECS)
+            @param level: niveau de compression, None pour le niveau par defaut
+            @param filt: filtre applique aux trames avant compression (FrameFilter), None
+                pour garder les trames completes
+            @param delta: bloc au format delta (module delta)
+            @return: numero du bloc
+        """
+        block = self.blocks
+        self.blocks += 1
+        self.sizes[block % SLOTS] = 0
+        self.open[block] = block % len(self.queues)
+        self.current = block
+        self.__send(self.open[block], (OPEN, block, path, codec, level, filt, delta))
+        return block
+
+    def __send(self, index, item):
+        """
+            Ajoute item a la file du processus index, attend tant que la file est pleine
+            @raise RuntimeError: si le processus est arrete
+        """
+        while True:
+            try:
+                self.queues[index].put(item, timeout=PUT_TIMEOUT)
+                return
+            except queue.Full:
+                proc = self.procs[index]
+                if not proc.is_alive():
+                    raise RuntimeError('Processus de compression {} arrete (code {})'.format(\
+                        proc.pid, proc.exitcode))
+
+    def put(self, data, block=None):
+        """
+            Ajoute une trame a un bloc
+            @param data: trame (bytes) ou descripteur (position, taille, fin) d'une
+                trame du tampon partage
+            @param block: numero du bloc, None pour le dernier bloc commence
+        """
+        if block is None:
+            block = self.current
+        index = self.open[block]
+        if isinstance(data, tuple):
+            self.ring.assign(index, data[2])
+            item = (SLICE, block) + data
+        else:
+            item = (FRAME, block, data)
+        q = self.queues[index]
+        try:
+            q.put_nowait(item)
+        except queue.Full:
+            self.blocked += 1
+            start = time.monotonic()
+            self.__send(index, item)
+            self.blockedTime += time.monotonic() - start
+        self.frames += 1
+        try:
+            self.maxDepth = max(self.maxDepth, q.qsize())
+        except NotImplementedError: # qsize() indisponible sur certains systemes
+            pass
+
+    def compressed(self, block=None):
+        """
+            Retourne la taille compressee d'un bloc ouvert (octets), en retard du
+            contenu des files et des tampons du compresseur
+            @param block: numero du bloc, None pour le dernier bloc commence
+        """
+        if block is None:
+            block = self.current
+        return self.sizes[block % SLOTS]
+
+    def written(self):
+        """
+            Retourne le nombre total d'octets compresses produits (tous les blocs)
+        """
+        return sum(self.totals)
+
+    def endBlock(self, block=None, path=None):
+        """
+            Termine un bloc, le fichier sera ferme par le processus de compression
+            @param block: numero du bloc, None pour le dernier bloc commence
+            @param path: nouveau chemin du bloc, None pour garder celui de startBlock()
+        """
+        if block is None:
+            block = self.current
+        if block in self.open:
+            self.__send(self.open.pop(block), (CLOSE, block, path))
+        if block == self.current:
+            self.current = None
+
+    def close(self):
+        """
+            Termine les blocs ouverts et attend la fin des processus de compression
+        """
+        for block in list(self.open):
+            try:
+                self.endBlock(block)
+            except RuntimeError as exc:
+                logging.error('%s, bloc %s perdu', exc, block)
+        for i, p in enumerate(self.procs):
+            if p.is_alive():
+                try:
+                    self.__send(i, (STOP,))
+                except RuntimeError:
+                    pass
+        for p in self.procs:
+            p.join()
+
+    def stats(self):
+        """
+            Retourne les statistiques de contre-pression du pool
+            @rtype: dict
+        """
+        return {'blocks': self.blocks, 'frames': self.frames, 'blocked': self.blocked,\
+            'blockedTime': round(self.blockedTime, 3), 'maxDepth': self.maxDepth,\
+            'written': self.written()}
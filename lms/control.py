@@ -0,0 +1,38 @@
+"""
+    Client de l'API de controle du daemon d'acquisition (daemon.py)
+    Une requete par connexion sur le socket Unix : un objet JSON sur une ligne
+    ({"command": "status", ...}), la reponse est un objet JSON sur une ligne
+    ({"ok": true, ...} ou {"ok": false, "error": "..."})
+"""
+
+import os
+import json
+import socket
+
+# socket de controle du daemon (dans le dossier de ce script)
+SOCKET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scanner.sock')
+
+def call(command, path=SOCKET, timeout=5, **params):
+    """
+        Envoie une commande au daemon et retourne sa reponse
+        @param command: nom de la commande (test, status, start, stop, crash,
+            reconfigure, stats, preview)
+        @param path: chemin du socket de controle
+        @param timeout: temps d'attente max de la reponse (s)
+        @param params: parametres de la commande
+        @return: reponse du daemon, {'ok': False, 'error': ...} s'il ne repond pas
+        @rtype: dict
+    """
+    request = dict(params, command=command)
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.sendall(json.dumps(request).encode()+b'\n')
+            with sock.makefile('rb') as fic:
+                line = fic.readline()
+    except OSError as exc:
+        return {'ok': False, 'error': 'Daemon injoignable : '+str(exc)}
+    if not line:
+        return {'ok': False, 'error': 'Pas de reponse du daemon'}
+    return json.loads(line.decode())
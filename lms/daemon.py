@@ -0,0 +1,366 @@
+"""
+    Daemon d'acquisition
+    Garde les connexions aux telemetres ouvertes et pilote les enregistrements
+    a travers une API de controle JSON sur un socket Unix (client : control.py).
+    L'interface web n'a plus a lancer scanner.py pour chaque action : une commande
+    prend quelques millisecondes et le telemetre ne voit plus de connexions a repetition
+    Commandes : test, status, start, stop, crash, reconfigure, stats, preview
+    SIGUSR1 arrete proprement l'enregistrement en cours, SIGTERM arrete aussi le daemon
+"""
+
+import os
+import json
+import base64
+import signal
+import logging
+import argparse
+import threading
+import socketserver
+from logging.handlers import RotatingFileHandler
+from LMS5xx import LMS5xx
+from compression import CODECS
+from recorder import Session
+from preview import Preview
+from scanner import loadConfig, saveConfig, addOptions, CONFIGPATH, PATH
+from control import SOCKET
+
+class Daemon:
+    """
+        Connexions aux telemetres et enregistrement en cours
+    """
+    def __init__(self, hosts, port=None, binary=False, loads=None, dest=PATH, size=500000,\
+        workers=2, queue=2000, ring=32, rcvbuf=1 << 22, codec='xz', level=None, period=0,\
+        budget=0, prealloc=16, reserve=64, degrade=True, delta=False):
+        """
+            @param hosts: adresses des telemetres (adresse ou adresse:port)
+            @param port: port par defaut des telemetres (2111 en ASCII, 2112 en binaire)
+            @param binary: protocole CoLa-B
+            @param loads: fichiers de config (un pour tous ou un par telemetre)
+            autres parametres : voir les options de scanner.py
+        """
+        self.settings = {'ip': list(hosts), 'port': port, 'binary': binary,\
+            'load': list(loads or ['defaults.ini']), 'dest': dest, 'size': size,\
+            'workers': workers, 'queue': queue, 'ring': ring, 'rcvbuf': rcvbuf,\
+            'codec': codec, 'level': level, 'period': period, 'budget': budget,\
+            'prealloc': prealloc, 'reserve': reserve, 'degrade': degrade, 'delta': delta}
+        self.devices = [] # connexions ouvertes, dans l'ordre de settings['ip']
+        self.lock = threading.Lock() # une seule commande a la fois sur les telemetres
+        self.session = None # enregistrement en cours
+        self.thread = None # thread d'enregistrement
+        self.stopping = threading.Event() # demande d'arret de l'enregistrement
+        self.aborted = False # arret sans terminer les blocs (crash)
+        self.last = None # statistiques du dernier enregistrement
+        self.preview = Preview() # apercu en direct des mesures
+
+    def recording(self):
+        """
+            Retourne True si un enregistrement est en cours
+        """
+        return self.thread is not None and self.thread.is_alive()
+
+    def port(self):
+        """
+            Retourne le port par defaut des telemetres
+        """
+        if self.settings['port'] is None:
+            return 2112 if self.settings['binary'] else 2111
+        return int(self.settings['port'])
+
+    def connect(self):
+        """
+            Ouvre les connexions qui ne le sont pas encore
+            @return: True si tous les telemetres sont connectes
+        """
+        if not self.devices:
+            self.devices = [LMS5xx(self.settings['binary']) for _ in self.settings['ip']]
+        for host, lms in zip(self.settings['ip'], self.devices):
+            if not lms.isConnected():
+                host, _, port = host.partition(':') # adresse[:port]
+                lms.connect(host, int(port or self.port()), self.settings['rcvbuf'])
+        return all(lms.isConnected() for lms in self.devices)
+
+    def disconnect(self):
+        """
+            Ferme les connexions aux telemetres
+        """
+        for lms in self.devices:
+            if lms.isConnected():
+                lms.disconnect()
+        self.devices = []
+
+    def loads(self):
+        """
+            Retourne le fichier de config de chaque telemetre
+        """
+        loads = self.settings['load']
+        if len(loads) == 1:
+            return loads * len(self.settings['ip'])
+        if len(loads) != len(self.settings['ip']):
+            raise ValueError('Donner un fichier de config pour tous les telemetres ou un par telemetre')
+        return loads
+
+    def handle(self, request):
+        """
+            Execute une commande de l'API de controle
+            @param request: dict contenant le nom de la commande et ses parametres
+            @return: reponse
+            @rtype: dict
+        """
+        command = request.pop('command', None)
+        method = getattr(self, 'do'+str(command).capitalize(), None)
+        if method is None:
+            return {'ok': False, 'error': 'Commande inconnue : '+str(command)}
+        logging.debug('Commande %s : %s', command, request)
+        try:
+            return dict({'ok': True}, **method(**request))
+        except (TypeError, ValueError, RuntimeError, OSError) as exc:
+            logging.warning('Commande %s : %s', command, exc)
+            return {'ok': False, 'error': str(exc)}
+
+    def doTest(self, ip=None, port=None):
+        """
+            Test de connexion, change d'abord de telemetre si ip ou port sont donnes
+        """
+        if ip is not None or port is not None:
+            self.doReconfigure(ip=ip, port=port)
+        with self.lock:
+            if self.recording():
+                return {'message': 'OK', 'recording': True}
+            # une connexion ouverte est verifiee par une requete, refaite si
+            # le telemetre ne repond plus (redemarrage)
+            if not self.connect() or 0 in [lms.queryStatus() for lms in self.devices]:
+                self.disconnect()
+                if not self.connect():
+                    raise RuntimeError('Impossible de se connecter au telemetre')
+        return {'message': 'OK', 'recording': False}
+
+    def doStatus(self):
+        """
+            Code d'etat de chaque telemetre
+            Pendant un enregistrement les sockets appartiennent au thread de reception,
+            le code 7 (en mesure) est retourne sans interroger les telemetres
+        """
+        with self.lock:
+            if self.recording():
+                return {'codes': [7]*len(self.devices), 'recording': True,\
+                    'path': self.session.path}
+            if not self.connect():
+                raise RuntimeError('Impossible de se connecter au telemetre')
+            codes = [lms.queryStatus() for lms in self.devices]
+            if 0 in codes: # connexion perdue, une seule nouvelle tentative
+                self.disconnect()
+                if self.connect():
+                    codes = [lms.queryStatus() for lms in self.devices]
+        return {'codes': codes, 'recording': False}
+
+    def doStart(self, load=None):
+        """
+            Charge la config dans les telemetres et demarre un enregistrement
+            @param load: fichier(s) de config, remplace le reglage courant
+        """
+        with self.lock:
+            if self.recording():
+                raise RuntimeError('Enregistrement deja en cours')
+            if load is not None:
+                self.settings['load'] = [load] if isinstance(load, str) else list(load)
+            loads = self.loads()
+            if not self.connect():
+                raise RuntimeError('Impossible de se connecter au telemetre')
+            for lms, load in zip(self.devices, loads):
+                saveConfig(lms, *loadConfig(load))
+            # attend que les telemetres soient prets a mesurer
+            if not all([lms.waitReady() for lms in self.devices]):
+                raise RuntimeError("Les telemetres ne sont pas prets a mesurer")
+            opts = self.settings
+            session = Session(self.devices, opts['ip'], loads, opts['dest'], CONFIGPATH,\
+                opts['binary'], opts['size'], opts['workers'], opts['queue'], opts['ring'],\
+                opts['codec'], opts['level'], self.preview, opts['period'], opts['budget'],\
+                opts['prealloc'], opts['reserve'], opts['degrade'], opts['delta'])
+            self.preview.clear()
+            session.open()
+            self.session = session
+            self.stopping.clear()
+            self.aborted = False
+            self.thread = threading.Thread(target=self.__record, args=(session,), daemon=True)
+            self.thread.start()
+        logging.info('Enregistrement demarre dans %s', session.path)
+        return {'path': session.path}
+
+    def __record(self, session):
+        """
+            Boucle d'enregistrement (thread)
+            Une erreur arrete l'enregistrement immediatement (session.abort()) : les
+            processus de compression et le tampon partage sont liberes
+        """
+        try:
+            session.run(self.stopping.is_set)
+            if self.aborted:
+                session.abort()
+                return
+            self.last = session.close()
+        except Exception:
+            logging.exception("Erreur pendant l'enregistrement %s, arret immediat", session.path)
+            try:
+                session.abort()
+            except Exception:
+                logging.exception("Arret de l'enregistrement %s incomplet", session.path)
+
+    def doStop(self, wait=True):
+        """
+            Arrete l'enregistrement sans perte de donnees
+            @param wait: attend la fin de la compression et retourne les statistiques
+        """
+        if not self.recording():
+            raise RuntimeError("Pas d'enregistrement en cours")
+        self.stopping.set()
+        if not wait:
+            return {'path': self.session.path}
+        self.thread.join()
+        return {'path': self.session.path, 'stats': self.last}
+
+    def doCrash(self):
+        """
+            Arrete l'enregistrement immediatement, seuls les morceaux complets des
+            blocs en cours sont gardes
+        """
+        if not self.recording():
+            raise RuntimeError("Pas d'enregistrement en cours")
+        self.aborted = True
+        self.stopping.set()
+        self.thread.join()
+        return {'path': self.session.path}
+
+    def doReconfigure(self, **settings):
+        """
+            Change les reglages (telemetres, fichiers de config, options d'enregistrement)
+            Refuse pendant un enregistrement
+        """
+        unknown = set(settings) - set(self.settings)
+        if unknown:
+            raise ValueError('Reglages inconnus : '+', '.join(sorted(unknown)))
+        settings = {k: v for k, v in settings.items() if v is not None}
+        for key in ('ip', 'load'):
+            if isinstance(settings.get(key), str):
+                settings[key] = [settings[key]]
+        if 'codec' in settings and settings['codec'] not in CODECS:
+            raise ValueError('Codec inconnu : '+str(settings['codec']))
+        with self.lock:
+            if self.recording():
+                raise RuntimeError('Enregistrement en cours')
+            changed = [k for k, v in settings.items() if self.settings[k] != v]
+            self.settings.update(settings)
+            if set(changed) & {'ip', 'port', 'binary', 'rcvbuf'}:
+                self.disconnect() # nouvelle connexion a la prochaine commande
+        if changed:
+            logging.info('Nouveaux reglages : %s', {k: settings[k] for k in changed})
+        return {'settings': self.settings}
+
+    def doStats(self):
+        """
+            Statistiques de l'enregistrement en cours, sinon du dernier enregistrement
+        """
+        if self.recording():
+            return {'recording': True, 'path': self.session.path, 'stats': self.session.stats()}
+        return {'recording': False, 'path': self.session.path if self.session else None,\
+            'stats': self.last}
+
+    def doPreview(self, device=0, step=1, after=0):
+        """
+            Derniere trame d'apercu (encodee en base64) du telemetre device
+            L'enregistreur ne copie des trames que pendant quelques secondes apres
+            chaque appel
+            @param step: garde une mesure sur step
+            @param after: numero de la derniere trame d'apercu deja recue
+        """
+        seq, data = self.preview.latest(int(device), int(step), int(after))
+        return {'recording': self.recording(), 'seq': seq,\
+            'data': None if data is None else base64.b64encode(data).decode()}
+
+    def shutdown(self):
+        """
+            Arrete l'enregistrement en cours et ferme les connexions
+        """
+        if self.recording():
+            self.stopping.set()
+            self.thread.join()
+        self.disconnect()
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """
+        Une requete JSON par connexion
+    """
+    def handle(self):
+        line = self.rfile.readline()
+        try:
+            request = json.loads(line.decode())
+            if not isinstance(request, dict):
+                raise ValueError('la requete doit etre un objet JSON')
+        except ValueError as exc:
+            reply = {'ok': False, 'error': 'Requete invalide : '+str(exc)}
+        else:
+            reply = self.server.daemon.handle(request)
+        try:
+            self.wfile.write(json.dumps(reply).encode()+b'\n')
+        except OSError: # client parti avant la reponse (timeout)
+            logging.warning('Reponse non transmise : %s', reply)
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, daemon):
+        """
+            @param path: chemin du socket de controle
+            @param daemon: classe Daemon executant les commandes
+        """
+        if os.path.exists(path): # socket d'un daemon precedent
+            os.remove(path)
+        socketserver.UnixStreamServer.__init__(self, path, ControlHandler)
+        self.daemon = daemon
+
+def main():
+    # --- PARAMETRAGE DU LOGGER ---
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s :: %(levelname)s :: %(message)s')
+    file_handler = RotatingFileHandler(os.path.join(CONFIGPATH, 'log.txt'), mode='a', maxBytes=1000000)
+    file_handler.setLevel(logging.DEBUG)
+    file_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
+
+    # --- PARSING DES ARGUMENTS ---
+    parser = argparse.ArgumentParser(description="Daemon d'acquisition LMS5xx")
+    addOptions(parser)
+    parser.add_argument('--socket', default=SOCKET,\
+        help='Chemin du socket de controle')
+    args = parser.parse_args()
+
+    daemon = Daemon(args.ip or ['192.168.1.12'], args.port, args.binary,\
+        args.load or ['defaults.ini'], args.dest, args.size, args.workers, args.queue,\
+        args.ring, args.rcvbuf, args.codec, args.level, args.period, args.budget, args.prealloc,\
+        args.reserve, not args.nodegrade, args.delta)
+    server = ControlServer(args.socket, daemon)
+    logging.info('Daemon demarre, socket de controle %s', args.socket)
+
+    def stopRecording(a, b):
+        logging.info("Signal d'arret de l'enregistrement recu")
+        daemon.stopping.set()
+
+    def stopDaemon(a, b):
+        logging.info("Signal d'arret du daemon recu")
+        # shutdown() attend la fin de serve_forever(), il doit etre appele d'un autre thread
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGUSR1, stopRecording)
+    signal.signal(signal.SIGTERM, stopDaemon)
+    signal.signal(signal.SIGINT, stopDaemon)
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+        daemon.shutdown()
+        logging.info('Daemon arrete')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+"""
+    Decodage vectorise (NumPy) des trames LMDscandata CoLa-A
+    Un lot de trames (une par ligne) est decoupe en elements puis les valeurs
+    hexadecimales sont converties colonne par colonne, sans boucle Python sur
+    chaque element. Toutes les trames d'un enregistrement ont le meme nombre
+    d'elements, les trames differentes sont comptees comme invalides
+    Les trames CoLa-B sont decodees dans le meme format (decodeBinaryBatch)
+"""
+
+import numpy as np
+from cola import decodeScanData
+
+# position des champs de l'en-tete dans une trame (elements separes par des espaces)
+HEADER = {'version': 2, 'device': 3, 'serial': 4, 'telegramCounter': 7, 'scanCounter': 8,\
+    'timeSinceStartup': 9, 'timeOfTransmission': 10, 'scanFrequency': 16, 'measFrequency': 17}
+HEADER_DTYPE = np.dtype([(name, np.uint32) for name in HEADER])
+
+# position des champs d'un canal relativement a la balise DISTn/RSSIn
+SCALE_FACTOR = 1
+SCALE_OFFSET = 2
+START_ANGLE = 3
+STEP = 4
+AMOUNT = 5
+DATA = 6
+CHANNEL_DTYPE = np.dtype([('scale', np.float32), ('offset', np.float32),\
+    ('start', np.int32), ('step', np.uint32), ('amount', np.uint32)])
+
+# date en fin de trame (annee, mois, jour, heure, minute, seconde, microseconde)
+DATE_LENGTH = 7
+
+# valeur de chaque caractere hexadecimal, 255 pour les autres caracteres
+HEX = np.full(256, 255, dtype=np.uint8)
+for i, c in enumerate(b'0123456789ABCDEF'):
+    HEX[c] = i
+for i, c in enumerate(b'abcdef'):
+    HEX[c] = 10 + i
+
+# separateurs d'elements : espace, fin de ligne, STX et ETX
+SEPARATORS = np.zeros(256, dtype=bool)
+SEPARATORS[[0x20, 0x0A, 0x0D, 0x02, 0x03]] = True
+
+class Layout:
+    """
+        Position des elements dans les trames d'un enregistrement
+        Construite a partir de la premiere trame
+    """
+    def __init__(self, line):
+        """
+            @param line: premiere trame (str ou bytes)
+        """
+        if isinstance(line, bytes):
+            line = line.decode()
+        tokens = line.split()
+        self.ntok = len(tokens) # nombre d'elements par trame
+        self.channels = {} # position de chaque balise DISTn/RSSIn
+        self.amount = {} # nombre de mesures de chaque canal
+        for i, tok in enumerate(tokens):
+            if tok.startswith('DIST') or tok.startswith('RSSI'):
+                self.channels[tok] = i
+                self.amount[tok] = int(tokens[i+AMOUNT], 16)
+        self.date = list(range(self.ntok-1-DATE_LENGTH, self.ntok-1)) # colonnes de la date
+
+    def columns(self, name):
+        """
+            Retourne les indices des mesures du canal name
+        """
+        ind = self.channels[name]
+        return list(range(ind+DATA, ind+DATA+self.amount[name]))
+
+def tokenize(buff, ntok):
+    """
+        Decoupe buff (trames separees par des retours a la ligne) en elements
+        @param buff: bytes contenant des trames completes
+        @param ntok: nombre d'elements attendu par trame
+        @return: tableau des octets, debuts et fins des elements (nb trames x ntok),
+            nombre de trames invalides
+    """
+    a = np.frombuffer(buff, dtype=np.uint8)
+    istok = ~SEPARATORS[a]
+    edges = np.diff(istok.astype(np.int8), prepend=0, append=0)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+
+    # numero de ligne de chaque element
+    lines = np.searchsorted(np.flatnonzero(a == 0x0A), starts)
+    counts = np.bincount(lines)
+    good = counts == ntok
+    invalid = int(np.count_nonzero((counts != ntok) & (counts > 0)))
+    keep = good[lines]
+    return a, starts[keep].reshape(-1, ntok), ends[keep].reshape(-1, ntok), invalid
+
+def decodeColumns(a, starts, ends, cols):
+    """
+        Convertit les elements hexadecimaux des colonnes cols en entiers
+        La conversion est faite caractere par caractere sur toutes les trames
+        et toutes les colonnes a la fois (au plus 8 iterations pour 32 bits)
+        @param a: tableau des octets retourne par tokenize()
+        @param starts: debuts des elements retournes par tokenize()
+        @param ends: fins des elements retournes par tokenize()
+        @param cols: liste des colonnes a convertir
+        @return: valeurs (nb trames x nb colonnes, uint64), masque des elements non hexa
+    """
+    s = starts[:, cols]
+    width = ends[:, cols] - s
+    res = np.zeros(s.shape, dtype=np.uint64)
+    bad = np.zeros(s.shape, dtype=bool)
+    if s.size == 0:
+        return res, bad
+    for k in range(int(width.max())):
+        mask = k < width
+        digit = HEX[a[np.where(mask, s + k, 0)]]
+        bad |= mask & (digit == 255)
+        res = np.where(mask, (res << np.uint64(4)) | digit, res)
+    return res, bad
+
+def inWindow(date, window):
+    """
+        Retourne le masque des trames dont la date est dans l'intervalle window
+        @param date: champs de date (nb trames x 7)
+        @param window: (debut, fin) en numpy.datetime64, None pour une borne ouverte
+    """
+    stamps = timestamps(date)
+    keep = ~np.isnat(stamps)
+    if window[0] is not None:
+        keep &= stamps >= window[0]
+    if window[1] is not None:
+        keep &= stamps <= window[1]
+    return keep
+
+def selectInfo(info, measures, amount):
+    """
+        Corrige l'angle de depart, le pas et le nombre de mesures d'un canal apres
+        selection des mesures measures (slice de premier element et pas positifs)
+        @param amount: nombre de mesures gardees
+    """
+    first, _, step = measures.indices(2**31)
+    res = info.copy()
+    res['start'] = info['start'] + info['step'].astype(np.int64) * first
+    res['step'] = info['step'] * step
+    res['amount'] = amount
+    return res
+
+def filterRows(res, keep):
+    """
+        Ne garde que les trames keep (masque) d'un lot decode
+    """
+    res['header'] = res['header'][keep]
+    res['date'] = res['date'][keep]
+    res['info'] = {k: v[keep] for k, v in res['info'].items()}
+    res['channels'] = {k: v[keep] for k, v in res['channels'].items()}
+
+def decodeBatch(buff, layout, channels, measures=None, window=None):
+    """
+        Decode un lot de trames
+        Les colonnes hors de la selection measures ne sont pas decodees, les trames
+        hors de l'intervalle window ne sont decodees que pour leur en-tete et leur date
+        @param buff: bytes contenant des trames completes separees par des retours a la ligne
+        @param layout: structure Layout de l'enregistrement
+        @param channels: liste des canaux a decoder (ex: ['DIST1', 'RSSI1'])
+        @param measures: mesures a garder dans chaque canal (slice), None pour toutes
+        @param window: intervalle (debut, fin) de dates a garder (numpy.datetime64,
+            None pour une borne ouverte), None pour toutes les trames
+        @return: dict contenant
+            'header': tableau structure des champs de l'en-tete
+            'date': champs de la date (nb trames x 7)
+            'info': dict canal -> tableau structure (facteur, offset, angle, pas, nb)
+            'channels': dict canal -> mesures brutes (nb trames x nb mesures, uint16)
+            'invalid': nombre de trames invalides
+            'outside': nombre de trames hors de l'intervalle window
+        @rtype: dict
+    """
+    a, starts, ends, invalid = tokenize(buff, layout.ntok)
+    cols = list(HEADER.values()) + layout.date
+    values, bad = decodeColumns(a, starts, ends, cols)
+
+    header = np.empty(len(values), dtype=HEADER_DTYPE)
+    for i, name in enumerate(HEADER):
+        header[name] = values[:, i]
+    res = {'header': header, 'date': values[:, len(HEADER):].astype(np.int64),\
+        'info': {}, 'channels': {}, 'invalid': invalid, 'outside': 0}
+
+    if window is not None:
+        # les mesures des trames hors de l'intervalle ne sont pas decodees
+        keep = inWindow(res['date'], window) | bad.any(axis=1)
+        res['outside'] = int(np.count_nonzero(~keep))
+        if res['outside']:
+            filterRows(res, keep)
+            starts, ends, bad = starts[keep], ends[keep], bad[keep]
+
+    for name in channels:
+        ind = layout.channels[name]
+        values, chbad = decodeColumns(a, starts, ends, list(range(ind+SCALE_FACTOR, ind+DATA)))
+        bad |= chbad.any(axis=1, keepdims=True)
+        info = np.empty(len(values), dtype=CHANNEL_DTYPE)
+        info['scale'] = values[:, 0].astype(np.uint32).view(np.float32)
+        info['offset'] = values[:, 1].astype(np.uint32).view(np.float32)
+        info['start'] = values[:, 2].astype(np.uint32).view(np.int32)
+        info['step'] = values[:, 3]
+        info['amount'] = values[:, 4]
+        columns = layout.columns(name)
+        if measures is not None:
+            columns = columns[measures]
+            info = selectInfo(info, measures, len(columns))
+        res['info'][name] = info
+        values, chbad = decodeColumns(a, starts, ends, columns)
+        bad |= chbad.any(axis=1, keepdims=True)
+        res['channels'][name] = values.astype(np.uint16)
+
+    # trames contenant des elements non hexadecimaux
+    rows = bad.any(axis=1)
+    if rows.any():
+        res['invalid'] += int(np.count_nonzero(rows))
+        filterRows(res, ~rows)
+    return res
+
+def decodeBinaryBatch(frames, channels, measures=None, window=None):
+    """
+        Decode un lot de trames CoLa-B LMDscandata
+        Le resultat a le meme format que celui de decodeBatch()
+        @param frames: liste de trames CoLa-B completes
+        @param channels: liste des canaux a decoder (ex: ['DIST1', 'RSSI1'])
+        @param measures: mesures a garder dans chaque canal (slice), None pour toutes
+        @param window: intervalle (debut, fin) de dates a garder, None pour toutes
+        @rtype: dict
+    """
+    scans = [decodeScanData(frame) for frame in frames]
+    header = np.empty(len(scans), dtype=HEADER_DTYPE)
+    for name in HEADER:
+        header[name] = [scan[name] for scan in scans]
+    date = np.array([scan['date'] or (0,)*DATE_LENGTH for scan in scans], dtype=np.int64)
+    res = {'header': header, 'date': date.reshape(-1, DATE_LENGTH),\
+        'info': {}, 'channels': {}, 'invalid': 0, 'outside': 0}
+    if window is not None:
+        keep = inWindow(res['date'], window)
+        res['outside'] = int(np.count_nonzero(~keep))
+        scans = [scan for scan, k in zip(scans, keep) if k]
+        res['header'] = header[keep]
+        res['date'] = res['date'][keep]
+    for name in channels:
+        info = np.empty(len(scans), dtype=CHANNEL_DTYPE)
+        for field in CHANNEL_DTYPE.names:
+            info[field] = [scan['channels'][name][field] for scan in scans]
+        values = np.array([scan['channels'][name]['values'] for scan in scans],\
+            dtype=np.uint16).reshape(len(scans), -1)
+        if measures is not None:
+            values = values[:, measures]
+            info = selectInfo(info, measures, values.shape[1])
+        res['info'][name] = info
+        res['channels'][name] = values
+    return res
+
+def decodeFrame(frame):
+    """
+        Decode une seule trame LMDscandata
+        @param frame: trame CoLa-A (avec ou sans STX/ETX) ou CoLa-B complete
+        @return: date (tuple de 7 entiers ou None), dict canal -> (facteur, offset,
+            angle de depart, pas, mesures brutes uint16)
+        @rtype: tuple
+    """
+    if frame[:4] == b'\x02\x02\x02\x02':
+        scan = decodeScanData(frame)
+        return scan['date'], {name: (ch['scale'], ch['offset'], ch['start'], ch['step'],\
+            np.array(ch['values'], dtype=np.uint16)) for name, ch in scan['channels'].items()}
+    line = bytes(frame).strip(b'\x02\x03') + b'\n'
+    layout = Layout(line)
+    batch = decodeBatch(line, layout, list(layout.channels))
+    if len(batch['header']) == 0:
+        return None, {}
+    return tuple(int(x) for x in batch['date'][0]), {name: (float(info['scale'][0]),\
+        float(info['offset'][0]), int(info['start'][0]), int(info['step'][0]),\
+        batch['channels'][name][0]) for name, info in batch['info'].items()}
+
+def timestamps(date):
+    """
+        Convertit les champs de date (nb trames x 7) en datetime64[us]
+        Les dates invalides (mois, jour ou heure hors limites) valent NaT
+        @rtype: tableau datetime64[us]
+    """
+    year, month, day, hour, minute, second, usec = date.T
+    valid = (year >= 1970) & (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31) &\
+        (hour < 24) & (minute < 60) & (second < 60) & (usec < 1000000)
+    months = np.where(valid, (year-1970)*12 + month-1, 0).astype('datetime64[M]')
+    days = months.astype('datetime64[D]') + np.where(valid, day-1, 0).astype('timedelta64[D]')
+    valid &= days < (months + np.timedelta64(1, 'M')).astype('datetime64[D]')
+    usecs = ((hour*60 + minute)*60 + second)*1000000 + usec
+    res = days.astype('datetime64[us]') + usecs.astype('timedelta64[us]')
+    res[~valid] = np.datetime64('NaT')
+    return res
+
+def scaled(batch, name):
+    """
+        Retourne les mesures du canal name corrigees par le facteur d'echelle et l'offset
+        @rtype: tableau float32 (nb trames x nb mesures)
+    """
+    info = batch['info'][name]
+    return batch['channels'][name] * info['scale'][:, None] + info['offset'][:, None]
+
+def angles(batch, name):
+    """
+        Retourne l'angle (en degres) de chaque mesure du canal name
+        @rtype: tableau float64 (nb trames x nb mesures)
+    """
+    info = batch['info'][name]
+    steps = np.arange(batch['channels'][name].shape[1])
+    return (info['start'][:, None] + info['step'][:, None].astype(np.int64) * steps) / 10000
+
+def iterChunks(fil, size=1 << 23):
+    """
+        Lis le fichier fil (ouvert en binaire) par blocs d'environ size octets
+        coupes sur une fin de ligne
+        @return: generateur de bytes contenant des trames completes
+    """
+    rest = b''
+    for chunk in iter(lambda: fil.read(size), b''):
+        chunk = rest + chunk
+        cut = chunk.rfind(b'\n') + 1
+        rest = chunk[cut:]
+        if cut:
+            yield chunk[:cut]
+    if rest:
+        yield rest + b'\n'
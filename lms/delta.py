@@ -0,0 +1,410 @@
+"""
+    Format de bloc delta : mesures en colonnes d'entiers 16 bits avant compression
+    Les trames d'un bloc sont regroupees par groupes de trames de meme geometrie.
+    Dans un groupe, les mesures des canaux DISTn/RSSIn forment une matrice
+    (trames x mesures) : chaque mesure est remplacee par sa difference avec la meme
+    mesure du scan precedent (delta), codee en zigzag (petits entiers positifs), puis
+    les octets de poids faible et de poids fort sont separes (byte shuffle). Avec un
+    telemetre fixe les differences sont petites et les octets de poids fort presque
+    tous nuls : le codec (xz, zstd...) compresse mieux et plus vite que le texte
+    hexadecimal des trames CoLa-A
+    Le reste de chaque trame (en-tete, compteurs, date...) est garde tel quel
+    (squelette). Les trames sont reconstruites a l'octet pres : un groupe qui ne
+    peut pas etre reconstruit exactement (valeurs hexadecimales non canoniques,
+    trame differente) est enregistre sans transformation
+    Chaque groupe est un enregistrement independant (premier scan du groupe non
+    differencie) : les morceaux d'un bloc (compression.BlockWriter) restent lisibles
+    separement apres une coupure (recover.py). Le nom des blocs a ce format contient
+    compression.DELTA (ex : 20180601100000_1-500.txt.dlt.xz), decompress.py les relit
+    Format d'un enregistrement (little endian) : en-tete RECORD (magique, type,
+    nombre de trames n, taille du contenu), puis selon le type
+        RAW : taille de chaque trame (uint32 x n), trames
+        ASCII, BINARY : nombre de canaux c (uint16), mesures par canal (uint16 x c),
+            octets par mesure (uint8 x c, 0 pour le texte hexadecimal CoLa-A), taille
+            des squelettes (uint32 x n), position des mesures de chaque canal dans
+            chaque squelette (uint32 x n x c), squelettes, puis les octets de poids
+            faible et les octets de poids fort des mesures transformees, mesure par
+            mesure (toutes les trames du groupe a la suite)
+"""
+
+import time
+import struct
+import numpy as np
+from framer import BINARY_STX
+from cola import HEADER, CHANNEL
+from decoder import Layout, tokenize, decodeColumns, AMOUNT, DATA
+
+# en-tete d'un enregistrement : magique, type, nombre de trames, taille du contenu
+MAGIC = b'LMDD'
+RECORD = struct.Struct('<4sBHI')
+# types d'enregistrement
+RAW = 0 # trames sans transformation
+ASCII = 1 # trames CoLa-A
+BINARY = 2 # trames CoLa-B
+# nombre max de trames d'un groupe
+GROUP = 128
+# duree max d'un groupe (s), les trames du groupe en cours sont perdues en cas de coupure
+GROUP_PERIOD = 10
+# element CoLa-A (hexadecimal majuscule) de chaque entier 16 bits, rempli au
+# premier decodage d'une trame CoLa-A (hexTable())
+HEX_TABLE = []
+
+def hexTable():
+    """
+        Retourne la table HEX_TABLE, construite au premier appel
+        @rtype: liste de bytes
+    """
+    if not HEX_TABLE:
+        HEX_TABLE.extend([format(i, 'X').encode() for i in range(1 << 16)])
+    return HEX_TABLE
+
+def encodeValues(values):
+    """
+        Delta entre scans, zigzag et separation des octets d'une matrice de mesures
+        @param values: mesures (nb trames x nb mesures, uint16)
+        @return: octets de poids faible puis de poids fort, mesure par mesure
+        @rtype: bytes
+    """
+    delta = values.copy()
+    delta[1:] -= values[:-1] # difference modulo 2**16
+    delta = delta.view(np.int16)
+    zigzag = ((delta << 1) ^ (delta >> 15)).view(np.uint16)
+    data = np.ascontiguousarray(zigzag.T, dtype='<u2').view(np.uint8)
+    return data.reshape(-1, 2).T.tobytes()
+
+def decodeValues(data, frames, measures):
+    """
+        Operation inverse de encodeValues()
+        @return: mesures (nb trames x nb mesures, uint16)
+    """
+    planes = np.frombuffer(data, dtype=np.uint8, count=2*frames*measures).reshape(2, -1)
+    zigzag = planes[0].astype(np.uint16) | (planes[1].astype(np.uint16) << 8)
+    zigzag = zigzag.reshape(measures, frames).T
+    delta = (zigzag >> 1) ^ -(zigzag & 1)
+    return np.cumsum(delta, axis=0, dtype=np.uint16)
+
+def binaryChannels(frame):
+    """
+        Retourne la position des mesures d'une trame CoLa-B LMDscandata
+        @return: tuple de (position dans la trame, nombre de mesures, octets par mesure),
+            None si ce n'est pas une trame LMDscandata
+    """
+    if frame[:4] != BINARY_STX:
+        return None
+    pos = frame.find(b'LMDscandata ', 8, 40)
+    if pos < 0:
+        return None
+    try:
+        pos += len(b'LMDscandata ') + HEADER.size
+        nbenc, = struct.unpack_from('>H', frame, pos)
+        pos += 2 + 6*nbenc
+        res = []
+        for width in (2, 1): # canaux 16 bits puis canaux 8 bits
+            count, = struct.unpack_from('>H', frame, pos)
+            pos += 2
+            for _ in range(count):
+                amount = CHANNEL.unpack_from(frame, pos)[5]
+                pos += CHANNEL.size
+                if amount:
+                    res.append((pos, amount, width))
+                pos += width*amount
+    except struct.error:
+        return None
+    if pos > len(frame) - 1:
+        return None
+    return tuple(res)
+
+def frameKey(frame):
+    """
+        Retourne la geometrie d'une trame : les trames d'un groupe ont la meme geometrie
+        @return: (ASCII, nb d'elements) ou (BINARY, position des mesures), None si la
+            trame n'est pas une trame LMDscandata
+    """
+    if frame[:4] == BINARY_STX:
+        channels = binaryChannels(frame)
+        return None if channels is None else (BINARY, channels)
+    if b'LMDscandata' not in frame[:32]:
+        return None
+    return (ASCII, frame.count(b' '))
+
+def skeletons(frames, cuts):
+    """
+        Retire les mesures des trames
+        @param frames: trames
+        @param cuts: (debut, fin) des mesures de chaque canal dans chaque trame
+            (nb trames x nb canaux x 2)
+        @return: squelettes, position des mesures dans chaque squelette (nb trames x nb canaux)
+    """
+    res = []
+    offsets = np.empty(cuts.shape[:2], dtype='<u4')
+    for i, frame in enumerate(frames):
+        parts = []
+        prev = size = 0
+        for c, (start, end) in enumerate(cuts[i].tolist()):
+            parts.append(frame[prev:start])
+            size += start - prev
+            offsets[i, c] = size
+            prev = end
+        parts.append(frame[prev:])
+        res.append(b''.join(parts))
+    return res, offsets
+
+def asciiGroup(frames):
+    """
+        Separe les mesures d'un groupe de trames CoLa-A, toutes les trames sont
+        decoupees et converties en une seule fois (module decoder)
+        @return: (mesures, largeurs, squelettes, positions, valeurs) ou None si les
+            trames ne peuvent pas etre reconstruites exactement
+    """
+    layout = Layout(frames[0].strip(b'\x02\x03'))
+    names = [name for name in sorted(layout.channels, key=layout.channels.get)\
+        if layout.amount[name] > 0]
+    if not names:
+        return None
+    buff = b'\n'.join(frames) + b'\n'
+    a, starts, ends, invalid = tokenize(buff, layout.ntok)
+    if invalid or len(starts) != len(frames):
+        return None
+
+    # memes canaux et memes nombres de mesures dans toutes les trames
+    heads = [layout.channels[name] for name in names]
+    amounts = [layout.amount[name] for name in names]
+    found, bad = decodeColumns(a, starts, ends, [head + AMOUNT for head in heads])
+    if bad.any() or (found != np.array(amounts, dtype=np.uint64)).any():
+        return None
+    for head, name in zip(heads, names):
+        tag = np.frombuffer(name.encode(), dtype=np.uint8)
+        if (ends[:, head] - starts[:, head] != len(tag)).any() or\
+            (a[starts[:, head, None] + np.arange(len(tag))] != tag).any():
+            return None
+
+    # mesures hexadecimales canoniques : 16 bits, majuscules, sans zeros en tete
+    cols = [head + DATA + i for head, amount in zip(heads, amounts) for i in range(amount)]
+    values, bad = decodeColumns(a, starts, ends, cols)
+    if bad.any() or values.max() > 0xFFFF:
+        return None
+    s = starts[:, cols]
+    width = ends[:, cols] - s
+    if (width != 1 + (values > 0xF) + (values > 0xFF) + (values > 0xFFF)).any():
+        return None
+    for k in range(4):
+        mask = k < width
+        if (mask & (a[np.where(mask, s + k, 0)] >= ord('a'))).any():
+            return None
+
+    # les mesures d'un canal sont separees par un seul espace
+    lines = np.cumsum([0] + [len(frame) + 1 for frame in frames[:-1]])
+    cuts = np.empty((len(frames), len(names), 2), dtype=np.int64)
+    pos = 0
+    for c, (head, amount) in enumerate(zip(heads, amounts)):
+        first, last = head + DATA, head + DATA + amount - 1
+        if (ends[:, last] - starts[:, first] != width[:, pos:pos+amount].sum(axis=1) +\
+            amount - 1).any():
+            return None
+        cuts[:, c, 0] = starts[:, first] - lines
+        cuts[:, c, 1] = ends[:, last] - lines
+        pos += amount
+    skel, offsets = skeletons(frames, cuts)
+    return amounts, [0] * len(names), skel, offsets, values.astype(np.uint16)
+
+def binaryGroup(frames, channels):
+    """
+        Separe les mesures d'un groupe de trames CoLa-B de meme geometrie, les mesures
+        d'un canal de toutes les trames sont converties en une seule fois
+        @param channels: position des mesures (binaryChannels())
+        @return: (mesures, largeurs, squelettes, positions, valeurs)
+    """
+    amounts = [amount for _, amount, _ in channels]
+    values = np.empty((len(frames), sum(amounts)), dtype=np.uint16)
+    cuts = np.empty((len(frames), len(channels), 2), dtype=np.int64)
+    pos = 0
+    for c, (start, amount, width) in enumerate(channels):
+        end = start + width*amount
+        data = b''.join([frame[start:end] for frame in frames])
+        values[:, pos:pos+amount] = np.frombuffer(data, dtype='>u2' if width == 2 else\
+            np.uint8).reshape(len(frames), amount)
+        cuts[:, c] = (start, end)
+        pos += amount
+    skel, offsets = skeletons(frames, cuts)
+    return amounts, [width for _, _, width in channels], skel, offsets, values
+
+def encodeRaw(frames):
+    """
+        Enregistrement des trames sans transformation
+        @rtype: bytes
+    """
+    body = np.array([len(frame) for frame in frames], dtype='<u4').tobytes() + b''.join(frames)
+    return RECORD.pack(MAGIC, RAW, len(frames), len(body)) + body
+
+def encodeGroup(frames, key):
+    """
+        Enregistrement d'un groupe de trames de meme geometrie
+        @param key: geometrie des trames (frameKey())
+        @rtype: bytes
+    """
+    if key is None:
+        return encodeRaw(frames)
+    if key[0] == BINARY:
+        group = binaryGroup(frames, key[1])
+    else:
+        group = asciiGroup(frames)
+    if group is None:
+        return encodeRaw(frames)
+    amounts, widths, skel, offsets, values = group
+    body = b''.join([struct.pack('<H', len(amounts)), np.array(amounts, dtype='<u2').tobytes(),\
+        bytes(widths), np.array([len(s) for s in skel], dtype='<u4').tobytes(),\
+        offsets.tobytes(), b''.join(skel), encodeValues(values)])
+    return RECORD.pack(MAGIC, key[0], len(frames), len(body)) + body
+
+def decodeRecord(kind, count, body):
+    """
+        Reconstruit les trames d'un enregistrement
+        @param kind: type de l'enregistrement
+        @param count: nombre de trames
+        @param body: contenu de l'enregistrement (sans l'en-tete)
+        @rtype: liste de bytes
+    """
+    if kind == RAW:
+        sizes = np.frombuffer(body, dtype='<u4', count=count)
+        ends = (np.cumsum(sizes) + 4*count).tolist()
+        return [body[end-size:end] for end, size in zip(ends, sizes.tolist())]
+    if kind not in (ASCII, BINARY):
+        raise ValueError('Type d\'enregistrement delta inconnu : '+str(kind))
+    nchan, = struct.unpack_from('<H', body)
+    pos = 2
+    amounts = np.frombuffer(body, dtype='<u2', count=nchan, offset=pos).tolist()
+    pos += 2*nchan
+    widths = list(body[pos:pos+nchan])
+    pos += nchan
+    sizes = np.frombuffer(body, dtype='<u4', count=count, offset=pos).tolist()
+    pos += 4*count
+    offsets = np.frombuffer(body, dtype='<u4', count=count*nchan, offset=pos)
+    offsets = offsets.reshape(count, nchan).tolist()
+    pos += 4*count*nchan
+    starts = np.cumsum([pos] + sizes).tolist()
+    values = decodeValues(body[starts[-1]:], count, sum(amounts))
+
+    # mesures de chaque canal de chaque trame, converties canal par canal
+    channels = []
+    col = 0
+    for amount, width in zip(amounts, widths):
+        block = values[:, col:col+amount]
+        if width == 0:
+            table = hexTable()
+            channels.append([b' '.join([table[v] for v in row]) for row in block.tolist()])
+        else:
+            data = block.astype('>u2' if width == 2 else np.uint8).tobytes()
+            size = width*amount
+            channels.append([data[i*size:(i+1)*size] for i in range(count)])
+        col += amount
+
+    frames = []
+    for i in range(count):
+        skel = body[starts[i]:starts[i+1]]
+        parts = []
+        prev = 0
+        for c in range(nchan):
+            parts.append(skel[prev:offsets[i][c]])
+            parts.append(channels[c][i])
+            prev = offsets[i][c]
+        parts.append(skel[prev:])
+        frames.append(b''.join(parts))
+    return frames
+
+class DeltaEncoder:
+    """
+        Regroupe les trames d'un bloc et les encode en enregistrements
+        Un groupe se termine apres GROUP trames, GROUP_PERIOD secondes, a un
+        changement de geometrie ou a la fin du bloc (flush()). Les enregistrements
+        sont ecrits en entier dans un morceau du bloc : un morceau se termine entre
+        deux enregistrements, un groupe peut donc etre lu sans le morceau precedent
+    """
+    def __init__(self, group=GROUP, period=GROUP_PERIOD):
+        """
+            @param group: nombre max de trames d'un groupe
+            @param period: duree max d'un groupe (s)
+        """
+        self.group = group
+        self.period = period
+        self.frames = [] # trames du groupe en cours
+        self.key = None # geometrie des trames du groupe en cours
+        self.deadline = None # fin du groupe en cours
+        self.records = 0 # enregistrements produits
+        self.raw = 0 # enregistrements sans transformation
+        self.done = [] # trames encodees par le dernier appel de add() ou flush()
+
+    def add(self, frame):
+        """
+            Ajoute une trame au groupe en cours, les trames des enregistrements
+            retournes sont dans done
+            @return: enregistrements termines (vide si le groupe n'est pas termine)
+            @rtype: bytes
+        """
+        frame = bytes(frame) # la trame du tampon partage peut etre liberee apres l'appel
+        key = frameKey(frame)
+        res = b''
+        done = []
+        if self.frames and key != self.key:
+            res = self.flush()
+            done = self.done
+        if not self.frames:
+            self.key = key
+            self.deadline = time.monotonic() + self.period
+        self.frames.append(frame)
+        if len(self.frames) >= self.group or time.monotonic() >= self.deadline:
+            res += self.flush()
+            done = done + self.done
+        self.done = done
+        return res
+
+    def flush(self):
+        """
+            Encode le groupe en cours
+            @rtype: bytes
+        """
+        self.done = self.frames
+        if not self.frames:
+            return b''
+        frames, self.frames = self.frames, []
+        res = encodeGroup(frames, self.key)
+        self.records += 1
+        if res[4] == RAW:
+            self.raw += 1
+        return res
+
+class RecordReader:
+    """
+        Reconstruit les trames d'un flux d'enregistrements decompresse, lu par
+        morceaux de taille quelconque
+    """
+    def __init__(self):
+        self.buffer = bytearray() # debut d'enregistrement incomplet
+        self.records = 0 # enregistrements lus
+
+    def feed(self, data):
+        """
+            Ajoute des donnees au flux
+            @return: trames des enregistrements complets
+            @rtype: liste de bytes
+        """
+        self.buffer += data
+        frames = []
+        pos = 0
+        while len(self.buffer) - pos >= RECORD.size:
+            magic, kind, count, size = RECORD.unpack_from(self.buffer, pos)
+            if magic != MAGIC:
+                raise ValueError('Enregistrement delta invalide a la position '+str(pos))
+            end = pos + RECORD.size + size
+            if end > len(self.buffer):
+                break
+            frames += decodeRecord(kind, count, bytes(self.buffer[pos+RECORD.size:end]))
+            self.records += 1
+            pos = end
+        del self.buffer[:pos]
+        return frames
+
+    def pending(self):
+        """
+            Retourne le nombre d'octets d'un enregistrement incomplet (fin du flux tronquee)
+        """
+        return len(self.buffer)
@@ -0,0 +1,205 @@
+"""
+    Reduction des trames LMDscandata avant compression
+    Une trame filtree reste une trame LMDscandata valide (CoLa-A ou CoLa-B) : les
+    outils de decompression et de conversion la lisent comme une trame du telemetre
+    avec moins de mesures (angle de depart, pas et nombre de mesures corriges)
+    Filtres : une mesure sur step, fenetre angulaire, premiers echos seulement,
+    sans remission (RSSI). Le filtre de chaque telemetre est lu dans son fichier de
+    config (loadFilter), le mode degrade le renforce (FrameFilter.degraded)
+    Le pas angulaire d'un canal est code sur 16 bits (1/10000 degre) : step est
+    reduit si le pas resultant depasse 6.5535 degres
+    Les mesures sont selectionnees par tranches de listes ou de memoryview, sans
+    boucle Python sur chaque mesure
+"""
+
+import struct
+import configparser
+from framer import BINARY_STX, checksum
+from cola import HEADER, CHANNEL, signed
+
+# nombre d'elements avant le nombre d'encodeurs dans une trame CoLa-A
+ASCII_HEADER = 18
+# debut des donnees d'une trame CoLa-B (apres STX et longueur)
+BINARY_PAYLOAD = 8
+# balayage complet du LMS 5xx (1/10000 degre), fenetre par defaut de loadFilter
+SCAN_WINDOW = (-50000, 1850000)
+
+def hexa(value, bits=32):
+    """
+        Retourne value en hexadecimal majuscule CoLa-A (complement a deux sur bits bits)
+        @rtype: bytes
+    """
+    return format(value & ((1 << bits) - 1), 'X').encode()
+
+class FrameFilter:
+    """
+        Filtre des trames d'un telemetre
+    """
+    def __init__(self, step=1, echoes=None, rssi=True, window=None):
+        """
+            @param step: garde une mesure sur step
+            @param echoes: nombre d'echos gardes (canaux DIST1..n et RSSI1..n), None pour tous
+            @param rssi: garde les canaux de remission RSSIn
+            @param window: (angle min, angle max) des mesures gardees (1/10000 degre),
+                None pour garder tout le balayage
+        """
+        self.step = max(1, int(step))
+        self.echoes = echoes
+        self.rssi = rssi
+        self.window = None if window is None else (int(window[0]), int(window[1]))
+
+    def __repr__(self):
+        return 'FrameFilter(step={}, echoes={}, rssi={}, window={})'.format(self.step,\
+            self.echoes, self.rssi, self.window)
+
+    def identity(self):
+        """
+            Retourne True si le filtre ne modifie pas les trames
+        """
+        return self.step == 1 and self.echoes is None and self.rssi and self.window is None
+
+    def degraded(self):
+        """
+            Retourne le filtre du mode degrade : deux fois moins de mesures et premier
+            echo seulement, la fenetre angulaire et la remission sont inchangees
+            @rtype: FrameFilter
+        """
+        return FrameFilter(self.step * 2, 1, self.rssi, self.window)
+
+    def keep(self, name):
+        """
+            Retourne True si le canal name (ex: b'DIST1') est garde
+        """
+        if name.startswith(b'RSSI') and not self.rssi:
+            return False
+        if self.echoes is not None and name[4:].isdigit() and int(name[4:]) > self.echoes:
+            return False
+        return True
+
+    def stepFor(self, angle):
+        """
+            Retourne le facteur de decimation utilisable avec le pas angulaire angle
+        """
+        return max(1, min(self.step, 0xFFFF // max(angle, 1)))
+
+    def select(self, start, angle, amount):
+        """
+            Retourne les mesures gardees d'un canal
+            @param start: angle de la premiere mesure (1/10000 degre)
+            @param angle: pas angulaire (1/10000 degre)
+            @param amount: nombre de mesures
+            @return: (premiere, fin, pas) de la tranche des mesures gardees
+        """
+        step = self.stepFor(angle)
+        if self.window is None or angle <= 0:
+            return 0, amount, step
+        low, high = self.window
+        first = max(0, -((start - low) // angle)) # arrondi superieur de (low-start)/angle
+        end = min(amount, (high - start) // angle + 1)
+        return min(first, amount), max(end, 0), step
+
+    def apply(self, frame):
+        """
+            Filtre une trame LMDscandata (les autres trames et les trames tronquees ou
+            incoherentes ne sont pas modifiees)
+            @param frame: trame CoLa-A (avec STX/ETX) ou CoLa-B complete
+            @rtype: bytes
+        """
+        try:
+            if frame[:4] == BINARY_STX:
+                return self.__binary(frame)
+            return self.__ascii(frame)
+        except (IndexError, ValueError, TypeError, struct.error):
+            return bytes(frame)
+
+    def __ascii(self, frame):
+        """
+            Filtre une trame CoLa-A : les elements sont decoupes une seule fois,
+            les mesures gardees sont une tranche de la liste des elements
+        """
+        tokens = bytes(frame).strip(b'\x02\x03').split(b' ')
+        if len(tokens) <= ASCII_HEADER or tokens[1] != b'LMDscandata':
+            return bytes(frame)
+        pos = ASCII_HEADER
+        pos += 1 + 2*int(tokens[pos], 16) # encodeurs : position et vitesse
+        res = tokens[:pos]
+        for _ in range(2): # canaux 16 bits puis canaux 8 bits
+            count = int(tokens[pos], 16)
+            pos += 1
+            kept = []
+            for _ in range(count):
+                name = tokens[pos]
+                amount = int(tokens[pos+5], 16)
+                if self.keep(name):
+                    start = signed(tokens[pos+3])
+                    angle = int(tokens[pos+4], 16)
+                    first, end, step = self.select(start, angle, amount)
+                    values = tokens[pos+6+first:pos+6+max(end, first)][::step]
+                    kept.append([name, tokens[pos+1], tokens[pos+2],\
+                        hexa(start + first * angle), hexa(angle * step, 16),\
+                        hexa(len(values), 16)])
+                    kept.append(values)
+                pos += 6 + amount
+            res.append(hexa(len(kept) // 2, 16))
+            for part in kept:
+                res.extend(part)
+        res.extend(tokens[pos:])
+        return b'\x02'+b' '.join(res)+b'\x03'
+
+    def __binary(self, frame):
+        """
+            Filtre une trame CoLa-B : les mesures gardees sont une tranche d'une
+            memoryview des mesures, la longueur et la checksum sont recalculees
+        """
+        data = memoryview(bytes(frame))[BINARY_PAYLOAD:-1]
+        pos = bytes(data[:32]).find(b'LMDscandata ')
+        if pos < 0:
+            return bytes(frame)
+        pos += len(b'LMDscandata ') + HEADER.size
+        nbenc, = struct.unpack_from('>H', data, pos)
+        pos += 2 + 6*nbenc
+        res = [data[:pos]]
+        for width in (2, 1): # canaux 16 bits puis canaux 8 bits
+            count, = struct.unpack_from('>H', data, pos)
+            pos += 2
+            kept = []
+            for _ in range(count):
+                name, scale, offset, start, angle, amount = CHANNEL.unpack_from(data, pos)
+                pos += CHANNEL.size
+                values = data[pos:pos+width*amount]
+                pos += width*amount
+                if self.keep(name):
+                    first, end, step = self.select(start, angle, amount)
+                    # tranche des mesures de width octets (ordre des octets inchange)
+                    values = values.cast('H' if width == 2 else 'B')[first:end:step]
+                    kept.append(CHANNEL.pack(name, scale, offset, start + first * angle,\
+                        angle * step, len(values)))
+                    kept.append(values.tobytes())
+            res.append(struct.pack('>H', len(kept) // 2))
+            res.extend(kept)
+        res.append(data[pos:])
+        body = b''.join(res)
+        return BINARY_STX+struct.pack('>I', len(body))+body+bytes([checksum(body)])
+
+def loadFilter(filename):
+    """
+        Lis le filtre des trames dans un fichier de config de telemetre
+        Cles de la section DEFAULT (absentes : trames non filtrees) :
+            beamStep : garde une mesure sur beamStep
+            windowStart, windowStop : fenetre angulaire gardee (1/10000 degre)
+            echoCount : nombre d'echos gardes, 0 pour tous
+            keepRemission : 0 pour supprimer les canaux RSSI
+        @param filename: chemin du fichier de config
+        @return: filtre ou None si les trames ne sont pas modifiees
+        @rtype: FrameFilter ou None
+    """
+    config = configparser.ConfigParser()
+    config.read(filename)
+    config = config['DEFAULT']
+    window = (int(config.get('windowStart', SCAN_WINDOW[0])),\
+        int(config.get('windowStop', SCAN_WINDOW[1])))
+    if window == SCAN_WINDOW:
+        window = None
+    filt = FrameFilter(int(config.get('beamStep', 1)), int(config.get('echoCount', 0)) or None,\
+        bool(int(config.get('keepRemission', 1))), window)
+    return None if filt.identity() else filt
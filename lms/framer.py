@@ -0,0 +1,209 @@
+"""
+    Reassemblage des trames CoLa-A ({stx}...{etx}) et CoLa-B
+    ({stx}{stx}{stx}{stx} longueur donnees checksum) a partir d'un flux d'octets
+    Le buffer est prealloue et reutilise, aucune concatenation de bytes n'est faite
+"""
+
+# en-tete d'une trame CoLa-B
+BINARY_STX = b'\x02\x02\x02\x02'
+
+class TelegramFramer:
+    """
+        Decoupe un flux d'octets en trames completes {stx}...{etx}
+        Les octets recus sont ecrits directement dans un buffer prealloue
+        (recv_into) puis les trames completes sont extraites une par une
+    """
+    def __init__(self, capacity=1 << 17):
+        """
+            @param capacity: taille du buffer en octets, doit etre superieure
+                a la taille de la plus grande trame attendue
+        """
+        self.capacity = capacity
+        self.buf = bytearray(capacity)
+        self.view = memoryview(self.buf)
+        self.start = 0 # debut des donnees non traitees
+        self.end = 0 # fin des donnees recues
+        self.frames = 0 # nombre de trames completes extraites
+        self.resyncs = 0 # nombre de resynchronisations sur un STX
+        self.dropped = 0 # nombre d'octets jetes (hors trame ou trame trop longue)
+
+    def _compact(self):
+        """
+            Ramene les donnees non traitees au debut du buffer
+        """
+        size = self.end - self.start
+        if size and self.start:
+            self.buf[0:size] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = size
+
+    def writable(self):
+        """
+            Retourne une vue sur l'espace libre du buffer, a remplir avec
+            recv_into() puis a valider avec commit()
+            @rtype: memoryview
+        """
+        if self.end == self.capacity:
+            self._compact()
+        if self.end == self.capacity:
+            # trame plus grande que le buffer : on jette tout et on resynchronise
+            self.dropped += self.end
+            self.resyncs += 1
+            self.start = 0
+            self.end = 0
+        return self.view[self.end:]
+
+    def commit(self, n):
+        """
+            Valide n octets ecrits dans la vue retournee par writable()
+            @param n: nombre d'octets ecrits
+        """
+        self.end += n
+
+    def feed(self, data):
+        """
+            Ajoute des octets au buffer (pour les sources sans recv_into)
+            et retourne les trames completes au fur et a mesure
+            @param data: octets recus
+            @return: generateur de trames {stx}...{etx}
+        """
+        data = memoryview(data)
+        while data:
+            free = self.writable()
+            n = min(len(free), len(data))
+            free[:n] = data[:n]
+            self.commit(n)
+            data = data[n:]
+            yield from self
+
+    def next(self):
+        """
+            Extrait la prochaine trame complete du buffer
+            @return: trame {stx}...{etx} ou None si aucune trame complete
+            @rtype: bytes ou None
+        """
+        while True:
+            stx = self.buf.find(b'\x02', self.start, self.end)
+            if stx < 0:
+                # aucun debut de trame : tout ce qui reste est inutilisable
+                self.dropped += self.end - self.start
+                self.start = 0
+                self.end = 0
+                return None
+            if stx > self.start:
+                # octets avant le STX : fin de trame perdue
+                self.dropped += stx - self.start
+                self.resyncs += 1
+                self.start = stx
+            etx = self.buf.find(b'\x03', stx + 1, self.end)
+            if etx < 0:
+                return None # trame incomplete, on attend la suite
+            nxt = self.buf.find(b'\x02', stx + 1, etx)
+            if nxt >= 0:
+                # STX dans la trame : debut de trame tronque, on repart du nouveau STX
+                self.dropped += nxt - stx
+                self.resyncs += 1
+                self.start = nxt
+                continue
+            frame = bytes(self.view[stx:etx + 1])
+            self.start = etx + 1
+            if self.start == self.end:
+                self.start = 0
+                self.end = 0
+            self.frames += 1
+            return frame
+
+    def __iter__(self):
+        """
+            Itere sur les trames completes presentes dans le buffer
+        """
+        frame = self.next()
+        while frame is not None:
+            yield frame
+            frame = self.next()
+
+    def stats(self):
+        """
+            Retourne les compteurs du framer
+            @rtype: dict
+        """
+        return {'frames': self.frames, 'resyncs': self.resyncs, 'dropped': self.dropped}
+
+class BinaryFramer(TelegramFramer):
+    """
+        Decoupe un flux d'octets en trames CoLa-B completes
+        {stx}{stx}{stx}{stx} longueur (4 octets) donnees checksum (1 octet)
+        La checksum (XOR des donnees) est verifiee, une trame invalide est jetee
+    """
+    def __init__(self, capacity=1 << 17):
+        TelegramFramer.__init__(self, capacity)
+        self.badchecksums = 0 # nombre de trames jetees a cause de la checksum
+
+    def next(self):
+        """
+            Extrait la prochaine trame complete et valide du buffer
+            @return: trame complete (en-tete et checksum compris) ou None
+            @rtype: bytes ou None
+        """
+        while True:
+            stx = self.buf.find(BINARY_STX, self.start, self.end)
+            if stx < 0:
+                # on garde les 3 derniers octets, debut possible d'un en-tete
+                keep = max(self.start, self.end - 3)
+                self.dropped += keep - self.start
+                self.start = keep
+                return None
+            if stx > self.start:
+                self.dropped += stx - self.start
+                self.resyncs += 1
+                self.start = stx
+            if self.end - stx < 8:
+                return None # longueur pas encore recue
+            length = int.from_bytes(self.view[stx + 4:stx + 8], 'big')
+            total = length + 9
+            if total > self.capacity:
+                # longueur aberrante : faux en-tete, on cherche le suivant
+                self.dropped += 1
+                self.resyncs += 1
+                self.start = stx + 1
+                continue
+            if self.end - stx < total:
+                return None # trame incomplete, on attend la suite
+            if checksum(self.view[stx + 8:stx + 8 + length]) != self.buf[stx + total - 1]:
+                self.badchecksums += 1
+                self.dropped += 1
+                self.resyncs += 1
+                self.start = stx + 1
+                continue
+            frame = bytes(self.view[stx:stx + total])
+            self.start = stx + total
+            if self.start == self.end:
+                self.start = 0
+                self.end = 0
+            self.frames += 1
+            return frame
+
+    def stats(self):
+        """
+            Retourne les compteurs du framer
+            @rtype: dict
+        """
+        res = TelegramFramer.stats(self)
+        res['badchecksums'] = self.badchecksums
+        return res
+
+def checksum(data):
+    """
+        Calcule la checksum CoLa-B (XOR de tous les octets des donnees)
+        Le XOR est fait par repliements successifs d'un grand entier pour eviter
+        une boucle Python sur chaque octet
+        @param data: donnees de la trame (sans en-tete ni longueur)
+        @rtype: int
+    """
+    size = len(data)
+    res = int.from_bytes(data, 'big')
+    while size > 1:
+        half = (size + 1) // 2 # nombre d'octets de la partie basse
+        res = (res >> (8*half)) ^ (res & ((1 << (8*half)) - 1))
+        size = half
+    return res
@@ -0,0 +1,140 @@
+"""
+    Detection des trames perdues a partir des compteurs des trames LMDscandata
+    Le compteur de telegrammes augmente de 1 a chaque trame envoyee par le telemetre,
+    un saut indique des trames perdues (telemetre, reseau ou enregistreur trop lent).
+    Le compteur de scans saute normalement si l'intervalle de sortie est superieur a 1
+    Les deux compteurs sont sur 16 bits
+"""
+
+import struct
+
+# position des compteurs dans une trame CoLa-B : en-tete (8 octets), commande,
+# version, appareil, numero de serie et etat
+BINARY_COMMAND = b'sSN LMDscandata '
+BINARY_COUNTERS = struct.Struct('>HH')
+BINARY_OFFSET = 8 + len(BINARY_COMMAND) + 10
+# debut d'une trame CoLa-A contenant les compteurs (commande et 7 premiers champs)
+ASCII_HEAD = 128
+# valeur max des compteurs + 1
+MODULO = 1 << 16
+# un saut de plus de la moitie du compteur est un redemarrage du telemetre
+MAX_GAP = MODULO // 2
+# nombre max de trous conserves pour le rapport
+MAX_EVENTS = 10000
+
+def frameCounters(frame):
+    """
+        Lis le compteur de telegrammes et le compteur de scans d'une trame
+        @param frame: trame CoLa-A (avec ou sans STX/ETX) ou CoLa-B complete (bytes
+            ou memoryview, seul le debut de la trame est copie)
+        @return: (compteur de telegrammes, compteur de scans) ou None si illisible
+    """
+    try:
+        if frame[:4] == b'\x02\x02\x02\x02':
+            if frame[8:8+len(BINARY_COMMAND)] != BINARY_COMMAND:
+                return None
+            return BINARY_COUNTERS.unpack_from(frame, BINARY_OFFSET)
+        tokens = bytes(frame[:ASCII_HEAD]).split(b' ', 9)
+        return int(tokens[7], 16), int(tokens[8], 16)
+    except (IndexError, ValueError, struct.error):
+        return None
+
+class GapTracker:
+    """
+        Statistiques des trames perdues d'un enregistrement
+        Les statistiques sont cumulees sur tout l'enregistrement, mark() retourne
+        celles depuis l'appel precedent (un bloc)
+    """
+    def __init__(self):
+        self.last = None # derniers compteurs (telegramme, scan)
+        self.frames = 0 # trames recues
+        self.lost = 0 # trames perdues (sauts du compteur de telegrammes)
+        self.gaps = 0 # nombre de sauts
+        self.maxGap = 0 # plus grand nombre de trames perdues d'un coup
+        self.blockGap = 0 # idem depuis le dernier appel de mark()
+        self.duplicates = 0 # trames recues deux fois
+        self.resets = 0 # remises a zero des compteurs (redemarrage du telemetre)
+        self.skipped = 0 # scans non transmis (sauts du compteur de scans)
+        self.invalid = 0 # trames dont les compteurs sont illisibles
+        self.events = [] # trous : (numero de trame, dernier compteur, compteur suivant, perdues)
+        self.previous = self.stats() # statistiques au dernier appel de mark()
+
+    def update(self, frame):
+        """
+            Prend en compte une trame
+            @param frame: trame CoLa-A ou CoLa-B
+            @return: nombre de trames perdues avant cette trame
+        """
+        return self.updateCounters(frameCounters(frame))
+
+    def updateCounters(self, counters):
+        """
+            Prend en compte les compteurs d'une trame
+            @param counters: compteurs retournes par frameCounters()
+            @return: nombre de trames perdues avant cette trame
+        """
+        if counters is None:
+            self.invalid += 1
+            return 0
+        telegram, scan = counters
+        self.frames += 1
+        last = self.last
+        self.last = (telegram, scan)
+        if last is None:
+            return 0
+        delta = (telegram - last[0]) % MODULO
+        if delta == 1:
+            self.skipped += (scan - last[1] - 1) % MODULO
+            return 0
+        if delta == 0:
+            self.duplicates += 1
+            return 0
+        if delta >= MAX_GAP:
+            self.resets += 1
+            return 0
+        lost = delta - 1
+        self.lost += lost
+        self.gaps += 1
+        self.maxGap = max(self.maxGap, lost)
+        self.blockGap = max(self.blockGap, lost)
+        if len(self.events) < MAX_EVENTS:
+            self.events.append((self.frames - 1, last[0], telegram, lost))
+        return lost
+
+    def stats(self):
+        """
+            Retourne les statistiques cumulees
+            @rtype: dict
+        """
+        return {'frames': self.frames, 'lost': self.lost, 'gaps': self.gaps,\
+            'maxGap': self.maxGap, 'duplicates': self.duplicates, 'resets': self.resets,\
+            'skipped': self.skipped, 'invalid': self.invalid}
+
+    def mark(self):
+        """
+            Retourne les statistiques depuis l'appel precedent
+            @rtype: dict
+        """
+        current = self.stats()
+        res = {k: v - self.previous[k] for k, v in current.items()}
+        res['maxGap'] = self.blockGap
+        self.previous = current
+        self.blockGap = 0
+        return res
+
+    def lossRate(self):
+        """
+            Retourne la proportion de trames perdues
+        """
+        total = self.frames + self.lost
+        return self.lost / total if total else 0.0
+
+    def report(self, blocks=()):
+        """
+            Retourne le rapport des trames perdues de l'enregistrement
+            @param blocks: statistiques de chaque bloc (liste de dict)
+            @rtype: dict
+        """
+        return {'total': self.stats(), 'lossRate': round(self.lossRate(), 6),\
+            'blocks': list(blocks), 'gaps': [{'frame': frame, 'from': first, 'to': last,\
+            'lost': lost} for frame, first, last, lost in self.events]}
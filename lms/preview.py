@@ -0,0 +1,109 @@
+"""
+    Apercu en direct des mesures pendant un enregistrement
+    L'enregistreur copie la derniere trame de chaque telemetre quelques fois par
+    seconde, uniquement si quelqu'un regarde l'apercu (demande recente). Le decodage
+    et le sous-echantillonnage sont faits a la demande, hors de la boucle
+    d'enregistrement. Sans spectateur, le cout pour l'enregistrement est un test
+    d'un booleen par trame
+    Format d'une trame d'apercu (little endian) : en-tete PREVIEW, distances en mm
+    (uint16 x nb), puis RSSI (uint16 x nb) si le bit 0 des flags est a 1
+"""
+
+import time
+import struct
+import threading
+try:
+    import numpy as np
+    from decoder import decodeFrame
+except ImportError:
+    np = None
+
+# numero de la trame, telemetre, flags, nombre de points, angle de depart et pas (1/10000 deg)
+PREVIEW = struct.Struct('<IBBHiI')
+FLAG_RSSI = 1
+
+def encode(frame, seq, device, step=1):
+    """
+        Construit une trame d'apercu a partir d'une trame LMDscandata
+        @param frame: trame du telemetre
+        @param seq: numero de la trame d'apercu
+        @param device: numero du telemetre
+        @param step: garde une mesure sur step
+        @return: trame d'apercu ou None si la trame ne contient pas de distances
+        @rtype: bytes ou None
+    """
+    channels = decodeFrame(frame)[1]
+    if 'DIST1' not in channels:
+        return None
+    scale, offset, start, angle, values = channels['DIST1']
+    dist = np.clip(values[::step] * scale + offset, 0, 0xFFFF).astype('<u2')
+    flags = 0
+    body = dist.tobytes()
+    if 'RSSI1' in channels:
+        flags |= FLAG_RSSI
+        body += channels['RSSI1'][4][::step].astype('<u2').tobytes()
+    return PREVIEW.pack(seq, device, flags, len(dist), start, angle * step) + body
+
+class Preview:
+    """
+        Derniere trame de chaque telemetre, copiee seulement pendant qu'on la regarde
+    """
+    def __init__(self, rate=4, linger=5):
+        """
+            @param rate: nombre max de trames copiees par seconde et par telemetre
+            @param linger: duree de l'apercu apres la derniere demande (s)
+        """
+        self.period = 1 / rate
+        self.linger = linger
+        self.active = False # quelqu'un regarde l'apercu (lu par l'enregistreur)
+        self.deadline = 0.0 # fin de l'apercu sans nouvelle demande
+        self.next = {} # date de la prochaine copie de chaque telemetre
+        self.frames = {} # derniere trame copiee de chaque telemetre : (numero, trame)
+        self.seq = 0 # numero de la derniere trame copiee
+        self.lock = threading.Lock()
+
+    def due(self, index):
+        """
+            Retourne True s'il faut copier la trame du telemetre index (enregistreur)
+            A n'appeler que si active est vrai
+        """
+        now = time.monotonic()
+        if now > self.deadline:
+            self.active = False # plus personne ne regarde
+            return False
+        return now >= self.next.get(index, 0.0)
+
+    def offer(self, index, frame):
+        """
+            Conserve une copie de la trame du telemetre index (enregistreur)
+        """
+        self.next[index] = time.monotonic() + self.period
+        with self.lock:
+            self.seq += 1
+            self.frames[index] = (self.seq, frame)
+
+    def latest(self, device=0, step=1, after=0):
+        """
+            Retourne la derniere trame d'apercu du telemetre device et prolonge l'apercu
+            @param device: numero du telemetre
+            @param step: garde une mesure sur step
+            @param after: numero de la derniere trame deja recue
+            @return: (numero, trame d'apercu) ou (after, None) si pas de nouvelle trame
+        """
+        if np is None:
+            raise RuntimeError("numpy n'est pas installe, apercu indisponible")
+        self.deadline = time.monotonic() + self.linger
+        self.active = True
+        with self.lock:
+            seq, frame = self.frames.get(device, (0, None))
+        if frame is None or seq <= after:
+            return after, None
+        return seq, encode(frame, seq, device, max(1, int(step)))
+
+    def clear(self):
+        """
+            Oublie les trames de l'enregistrement precedent
+        """
+        with self.lock:
+            self.frames = {}
+            self.next = {}
@@ -0,0 +1,110 @@
+"""
+    Thread de reception des trames
+    Le thread vide les sockets des telemetres en continu (un seul selecteur pour
+    tous les telemetres) et copie les trames dans le tampon partage. Le thread
+    principal recupere les descripteurs des trames et les transmet aux processus de
+    compression : une attente de ce cote (file pleine, changement de bloc) ne
+    bloque plus la lecture des sockets
+"""
+
+import time
+import queue
+import logging
+import selectors
+import threading
+from gaps import frameCounters
+
+class Receiver(threading.Thread):
+    """
+        Lecture des trames d'un ou plusieurs telemetres dans un tampon SharedRing
+    """
+    def __init__(self, devices, ring):
+        """
+            @param devices: liste de classes LMS5xx connectees, l'envoi continu des
+                trames est demarre
+            @param ring: tampon SharedRing
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.devices = devices
+        self.ring = ring
+        self.frames = queue.Queue() # descripteurs des trames recues, borne par le tampon
+        self.running = True
+        self.received = [0]*len(devices) # trames recues par telemetre
+        self.overflows = [0]*len(devices) # trames jetees (tampon plein) par telemetre
+        self.maxBacklog = 0 # nombre max de trames en attente de transmission
+        self.lastFrame = [time.monotonic()]*len(devices) # date de la derniere trame recue
+
+    def run(self):
+        selector = selectors.DefaultSelector()
+        for index, lms in enumerate(self.devices):
+            selector.register(lms, selectors.EVENT_READ, index)
+        while self.running and selector.get_map():
+            for key, _ in selector.select(0.1):
+                index = key.data
+                frames = key.fileobj.readFrames()
+                if frames is None: # connexion fermee ou en erreur
+                    logging.error('Telemetre %s : plus de lecture des trames', index + 1)
+                    selector.unregister(key.fileobj)
+                    continue
+                for dat in frames:
+                    self.__store(index, dat)
+        selector.close()
+
+    def __store(self, index, dat):
+        """
+            Copie une trame du telemetre index dans le tampon
+        """
+        self.received[index] += 1
+        self.lastFrame[index] = time.monotonic()
+        desc = self.ring.write(dat)
+        if desc is None:
+            self.overflows[index] += 1
+            if self.ring.overflows == 1 or self.ring.overflows % 1000 == 0:
+                logging.warning('Tampon de reception plein, %d trames perdues',\
+                    self.ring.overflows)
+            return
+        # les compteurs sont lus ici pour ne pas relire la trame dans le tampon
+        self.frames.put((index,) + desc + (frameCounters(dat),))
+        self.maxBacklog = max(self.maxBacklog, self.frames.qsize())
+
+    def silence(self, now=None):
+        """
+            Retourne la duree depuis la derniere trame recue de chaque telemetre (s)
+            @param now: date (time.monotonic()), None pour maintenant
+            @rtype: liste
+        """
+        if now is None:
+            now = time.monotonic()
+        return [now - last for last in self.lastFrame]
+
+    def get(self, timeout):
+        """
+            Retourne le descripteur de la prochaine trame recue
+            @param timeout: temps d'attente max
+            @return: (telemetre, position, taille, fin, compteurs) ou None si rien
+                recu avant le timeout
+        """
+        try:
+            return self.frames.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def stop(self):
+        """
+            Arrete la lecture des sockets et retourne les trames deja recues
+            @return: liste des descripteurs restants
+        """
+        self.running = False
+        self.join()
+        res = []
+        while not self.frames.empty():
+            res.append(self.frames.get())
+        return res
+
+    def stats(self):
+        """
+            Retourne les statistiques de reception
+            @rtype: dict
+        """
+        return {'received': sum(self.received), 'overflows': sum(self.overflows),\
+            'maxBacklog': self.maxBacklog}
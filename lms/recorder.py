@@ -0,0 +1,474 @@
+"""
+    Enregistrement des trames d'un ou plusieurs telemetres
+    Chaque telemetre a son dossier de sortie, ses blocs et ses statistiques.
+    Les trames de tous les telemetres arrivent par un seul thread de reception
+    (module receiver) et sont compressees par un seul pool de processus
+    Une session (classe Session) regroupe tout un enregistrement, elle est utilisee
+    par scanner.py et par le daemon d'acquisition
+"""
+
+import os
+import time
+import json
+import logging
+import configparser
+from gaps import GapTracker
+from compression import CompressionPool, CODECS, HIGH_LEVELS, DELTA, DeltaEncoder
+from ring import SharedRing
+from receiver import Receiver
+from recover import recoverDir
+from filters import FrameFilter, loadFilter
+from storage import StorageWatcher, STAGES, LEVEL, DECIMATE, STOP
+
+# duree sans trame d'un telemetre avant une alerte (s)
+SILENCE = 10
+# periode de verification du thread de reception et des telemetres silencieux (s)
+CHECK_PERIOD = 1
+
+class Device:
+    """
+        Etat de l'enregistrement d'un telemetre
+    """
+    def __init__(self, name, lms, path, host='', filt=None):
+        """
+            @param name: nom du telemetre (logs et statistiques)
+            @param lms: classe LMS5xx connectee
+            @param path: dossier d'enregistrement des blocs
+            @param host: adresse du telemetre
+            @param filt: filtre des trames avant compression (FrameFilter), None pour aucun
+        """
+        self.name = name
+        self.host = host
+        self.lms = lms
+        self.path = path
+        self.filter = filt # filtre des trames des nouveaux blocs
+        self.gaps = GapTracker() # trames perdues (compteurs de telegrammes)
+        self.blocks = [] # statistiques des trames perdues de chaque bloc
+        self.block = None # numero du bloc courant dans le pool de compression
+        self.filename = None # nom du fichier du bloc courant
+        self.count = 0 # trames du bloc courant
+        self.deadline = None # date de fin du bloc courant (rotation par duree)
+        self.first = None # compteur de scans de la premiere trame du bloc courant
+        self.last = None # compteur de scans de la derniere trame du bloc courant
+        self.frames = 0 # trames enregistrees
+        self.bytes = 0 # octets enregistres (avant compression)
+
+    def stats(self, duration):
+        """
+            Retourne les statistiques du telemetre
+            @param duration: duree de l'enregistrement (s)
+            @rtype: dict
+        """
+        return {'name': self.name, 'host': self.host, 'frames': self.frames,\
+            'bytes': self.bytes, 'fps': round(self.frames / duration, 2) if duration else 0.0,\
+            'throughput': round(self.bytes / duration) if duration else 0,\
+            'blocks': len(self.blocks), 'framer': self.lms.framer.stats(),\
+            'gaps': self.gaps.stats()}
+
+class Recorder:
+    """
+        Repartition des trames recues dans les blocs de chaque telemetre
+        Un bloc se termine apres size trames, a la fin de sa periode (alignee sur
+        l'horloge : toutes les 10 minutes pile pour period=600) ou quand sa taille
+        compressee atteint budget. Les blocs ne commencent qu'a la reception d'une
+        trame, une periode sans trame ne cree pas de bloc
+        Nom des blocs : date de debut, puis compteurs de scans de la premiere et de la
+        derniere trame (ex: 20200101120000_1234-5678.txt.xz, .txt.dlt.xz au format delta)
+    """
+    def __init__(self, devices, pool, size, ext, codec='xz', level=None, period=None,\
+        budget=None, delta=False):
+        """
+            @param devices: liste de structures Device, dans l'ordre du Receiver
+            @param pool: pool de compression CompressionPool
+            @param size: nombre de trames par bloc, 0 pour ne pas limiter
+            @param ext: extension des blocs (ex: '.txt.xz')
+            @param codec: codec de compression des blocs
+            @param level: niveau de compression, None pour le niveau par defaut
+            @param period: duree d'un bloc (s), None pour ne pas limiter
+            @param budget: taille compressee d'un bloc (octets, approximative), None
+                pour ne pas limiter
+            @param delta: blocs au format delta (module delta)
+        """
+        self.devices = devices
+        self.pool = pool
+        self.size = size
+        self.ext = ext
+        self.codec = codec
+        self.level = level
+        self.period = period or None
+        self.budget = budget or None
+        self.delta = delta
+        self.start = time.monotonic()
+
+    def put(self, desc):
+        """
+            Enregistre une trame
+            @param desc: descripteur retourne par Receiver.get()
+        """
+        index, pos, size, end, counters = desc
+        dev = self.devices[index]
+        if dev.block is not None and self.period is not None and time.time() >= dev.deadline:
+            self.endBlock(dev) # la trame appartient a la periode suivante
+        if dev.block is None:
+            self.startBlock(dev)
+        dev.gaps.updateCounters(counters)
+        if counters is not None:
+            if dev.first is None:
+                dev.first = counters[1]
+            dev.last = counters[1]
+        self.pool.put((pos, size, end), dev.block)
+        dev.count += 1
+        dev.frames += 1
+        dev.bytes += size
+        if self.size and dev.count >= self.size:
+            self.endBlock(dev)
+        elif self.budget is not None and self.pool.compressed(dev.block) >= self.budget:
+            self.endBlock(dev)
+
+    def tick(self):
+        """
+            Termine les blocs dont la periode est finie (sans trame recue), appele
+            a chaque pas de la session
+        """
+        if self.period is None:
+            return
+        now = time.time()
+        for dev in self.devices:
+            if dev.block is not None and now >= dev.deadline:
+                self.endBlock(dev)
+
+    def startBlock(self, dev):
+        """
+            Commence un bloc du telemetre dev, le nom du fichier correspond
+            a la date de debut du bloc (les compteurs de scans sont ajoutes a la fin)
+        """
+        now = time.time()
+        dev.filename = time.strftime('%Y%m%d%H%M%S', time.localtime(now))+self.ext
+        dev.block = self.pool.startBlock(os.path.join(dev.path, dev.filename),\
+            self.codec, self.level, dev.filter, self.delta)
+        dev.count = 0
+        dev.first = dev.last = None
+        if self.period is not None:
+            dev.deadline = (now // self.period + 1) * self.period
+
+    def endBlock(self, dev):
+        """
+            Termine le bloc courant du telemetre dev
+        """
+        if dev.block is None:
+            return
+        if dev.first is not None: # ajoute les compteurs de scans au nom du bloc
+            dev.filename = dev.filename[:-len(self.ext)]+'_'+str(dev.first)+'-'+\
+                str(dev.last)+self.ext
+        self.pool.endBlock(dev.block, os.path.join(dev.path, dev.filename))
+        dev.block = None
+        block = dev.gaps.mark()
+        dev.blocks.append(dict(block, file=dev.filename))
+        logging.info('%s : bloc %s termine (%d trames), compression : %s', dev.name,\
+            dev.filename, dev.count, self.pool.stats())
+        if block['lost'] > 0:
+            logging.warning('%s : %d trames perdues dans le bloc %s : %s', dev.name,\
+                block['lost'], dev.filename, block)
+
+    def rotate(self):
+        """
+            Termine les blocs en cours, les trames suivantes commencent de nouveaux
+            blocs (avec le niveau de compression et le filtre actuels)
+        """
+        for dev in self.devices:
+            self.endBlock(dev)
+
+    def close(self):
+        """
+            Termine les blocs en cours et ecrit le rapport des trames perdues
+            de chaque telemetre (gaps.json dans son dossier)
+        """
+        for dev in self.devices:
+            self.endBlock(dev)
+            logging.info('%s : trames perdues : %s', dev.name, dev.gaps.stats())
+            with open(os.path.join(dev.path, 'gaps.json'), 'w') as fic:
+                json.dump(dev.gaps.report(dev.blocks), fic, indent=1)
+
+    def stats(self):
+        """
+            Retourne les statistiques de chaque telemetre
+            @rtype: liste de dict
+        """
+        duration = time.monotonic() - self.start
+        return [dev.stats(duration) for dev in self.devices]
+
+class Session:
+    """
+        Enregistrement complet : dossier de mesures, tampon, pool de compression,
+        thread de reception et repartition des trames en blocs
+        Les telemetres doivent etre configures et prets a mesurer
+    """
+    def __init__(self, devices, hosts, loads, dest, configpath, binary=False, size=500000,\
+        workers=2, queue=2000, ring=32, codec='xz', level=None, preview=None, period=None,\
+        budget=None, prealloc=16, reserve=64, degrade=True, delta=False):
+        """
+            @param devices: liste de classes LMS5xx connectees
+            @param hosts: adresse de chaque telemetre
+            @param loads: fichier de config de chaque telemetre (dans configpath)
+            @param dest: dossier contenant les dossiers de mesures
+            @param configpath: dossier des fichiers de config (et de log.txt, ../info.txt)
+            @param binary: protocole CoLa-B
+            @param size: nombre de trames par bloc (par telemetre)
+            @param workers: nombre de processus de compression
+            @param queue: nombre max de trames en attente de compression par processus
+            @param ring: taille du tampon partage de reception (en Mo)
+            @param codec: codec de compression des blocs
+            @param level: niveau de compression, None pour le niveau par defaut
+            @param preview: classe Preview recevant une copie des trames regardees
+            @param period: duree d'un bloc (s), None ou 0 pour ne pas limiter
+            @param budget: taille compressee d'un bloc (en Mo), None ou 0 pour ne pas limiter
+            @param prealloc: pas de reservation de la place des blocs (en Mo), 0 pour
+                ne pas reserver
+            @param reserve: place gardee libre sur le support (en Mo)
+            @param degrade: passe en mode degrade (compression plus forte puis
+                decimation) quand la place libre devient faible, sinon arrete seulement
+                l'enregistrement (module storage)
+            @param delta: blocs au format delta (module delta, necessite numpy)
+        """
+        self.devices = devices
+        self.hosts = hosts
+        self.loads = loads
+        self.dest = dest
+        self.configpath = configpath
+        self.binary = binary
+        self.size = size
+        self.workers = workers
+        self.queue = queue
+        self.ringSize = ring
+        self.codec = codec
+        self.level = level
+        self.preview = preview
+        self.period = period
+        self.budget = budget
+        self.prealloc = prealloc
+        self.reserve = reserve
+        self.degrade = degrade
+        self.delta = delta
+        self.watcher = None # surveillance de la place libre (StorageWatcher)
+        self.full = False # arret demande par le mode degrade (support presque plein)
+        self.failed = False # arret : thread de reception arrete
+        self.silent = set() # telemetres sans trame depuis plus de SILENCE s
+        self.nextCheck = 0.0 # date de la prochaine verification de la reception
+        self.path = None # dossier des mesures
+        self.ring = None
+        self.pool = None
+        self.receiver = None
+        self.recorder = None
+        self.start = None
+
+    def open(self):
+        """
+            Cree le dossier des mesures et demarre l'acquisition continue
+            @return: chemin du dossier des mesures
+        """
+        if self.delta and DeltaEncoder is None:
+            raise RuntimeError("numpy n'est pas installe, format delta indisponible")
+        # lecture fichier info
+        try:
+            with open(os.path.join(self.configpath, '../info.txt'), 'r') as fic:
+                buff = fic.read()
+        except FileNotFoundError:
+            buff = ''
+
+        # les mesures sont enregistrees dans un dossier separe
+        self.path = os.path.join(self.dest, time.strftime('%Y%m%d%H%M%S', time.localtime()), '')
+        os.mkdir(self.path)
+
+        # ecriture debut fichier info
+        with open(os.path.join(self.path, 'info.txt'), 'w') as fic:
+            fic.write("Debut d'enregistrement: "+time.strftime("%Y%m%d%H%M%S", time.localtime())+'\n')
+            fic.write(buff)
+            os.remove(os.path.join(self.path, 'info.txt'))
+
+        # avec plusieurs telemetres, chacun a son sous-dossier (lms1, lms2...)
+        recorded = []
+        for i, (host, load, lms) in enumerate(zip(self.hosts, self.loads, self.devices)):
+            name = 'lms'+str(i+1)
+            path = os.path.join(self.path, name) if len(self.devices) > 1 else self.path
+            os.makedirs(path, exist_ok=True)
+            logging.info('%s : telemetre %s, config %s, dossier %s', name, host, load, path)
+            # copie le fichier de config dans le dossier destination
+            with open(os.path.join(self.configpath, load), 'r') as config:
+                with open(os.path.join(path, 'config.ini'), 'w') as dstconfig:
+                    dstconfig.write(config.read())
+            filt = loadFilter(os.path.join(self.configpath, load))
+            if filt is not None:
+                logging.info('%s : trames reduites par %s', name, filt)
+            recorded.append(Device(name, lms, path, host, filt))
+
+        # enregistre le codec utilise a cote du fichier de config
+        codec = configparser.ConfigParser()
+        codec['DEFAULT'] = {'codec': self.codec,\
+            'level': CODECS[self.codec][1] if self.level is None else self.level,\
+            'format': 'delta' if self.delta else 'frames'}
+        for dev in recorded:
+            with open(os.path.join(dev.path, 'codec.ini'), 'w') as codecfile:
+                codec.write(codecfile)
+
+        # les trames sont lues par un thread dans un tampon partage avec les
+        # processus de compression, crees une seule fois pour toute l'acquisition
+        self.ring = SharedRing(self.ringSize << 20, self.workers)
+        self.pool = CompressionPool(self.workers, self.queue, self.ring, self.prealloc << 20)
+        self.receiver = Receiver(self.devices, self.ring)
+        ext = ('.bin' if self.binary else '.txt')+(DELTA if self.delta else '')+\
+            CODECS[self.codec][0]
+        self.recorder = Recorder(recorded, self.pool, self.size, ext, self.codec, self.level,\
+            self.period, (self.budget or 0) << 20, self.delta)
+        stages = STAGES if self.degrade else [x for x in STAGES if x[1] == STOP]
+        self.watcher = StorageWatcher(self.path, self.reserve, stages)
+
+        for lms in self.devices:
+            lms.scanContinous(1) # demarre l'acquisition de donnees continue
+        self.receiver.start()
+        self.start = time.monotonic()
+        return self.path
+
+    def step(self, timeout=0.1):
+        """
+            Transmet la prochaine trame recue au processus de compression de son bloc
+            @param timeout: temps d'attente max d'une trame
+        """
+        now = time.monotonic()
+        if self.watcher.due(now):
+            self.checkStorage(now)
+        if now >= self.nextCheck:
+            self.checkReceiver(now)
+        desc = self.receiver.get(timeout) # descripteur de la trame suivante
+        # a chaque pas : un telemetre silencieux ne recoit pas de trame qui
+        # terminerait son bloc, meme si les autres telemetres envoient des trames
+        self.recorder.tick()
+        if desc is None:
+            return
+        preview = self.preview
+        if preview is not None and preview.active and preview.due(desc[0]):
+            # copie avant put() : le tampon peut etre libere des la compression
+            preview.offer(desc[0], bytes(self.ring.read(desc[1], desc[2])))
+        self.recorder.put(desc)
+
+    def checkReceiver(self, now):
+        """
+            Verifie que le thread de reception tourne et que chaque telemetre envoie
+            des trames, une alerte est ecrite au debut de chaque silence
+        """
+        self.nextCheck = now + CHECK_PERIOD
+        if not self.receiver.is_alive():
+            logging.critical("Thread de reception arrete : arret de l'enregistrement")
+            self.failed = True
+            return
+        for dev, silence in zip(self.recorder.devices, self.receiver.silence(now)):
+            if silence > SILENCE and dev.name not in self.silent:
+                self.silent.add(dev.name)
+                logging.critical('%s : aucune trame recue depuis %d s', dev.name, silence)
+            elif silence <= SILENCE and dev.name in self.silent:
+                self.silent.discard(dev.name)
+                logging.warning('%s : reception des trames reprise', dev.name)
+
+    def checkStorage(self, now=None):
+        """
+            Lis la place libre et applique les etapes du mode degrade franchies
+        """
+        try:
+            actions = self.watcher.update(self.pool.written(), now)
+        except OSError as exc: # support demonte
+            logging.critical('Lecture de la place libre impossible : %s', exc)
+            return
+        for action in actions:
+            state = self.watcher.stats()
+            if action == LEVEL:
+                level = self.recorder.level
+                if level is None:
+                    level = CODECS[self.codec][1]
+                if HIGH_LEVELS[self.codec] > level:
+                    self.recorder.level = HIGH_LEVELS[self.codec]
+                    self.recorder.rotate()
+                logging.warning('Place libre faible (%s) : compression %s niveau %s', state,\
+                    self.codec, self.recorder.level)
+            elif action == DECIMATE:
+                for dev in self.recorder.devices:
+                    dev.filter = (dev.filter or FrameFilter()).degraded()
+                    logging.warning('Place libre faible (%s) : %s : trames reduites par %s',\
+                        state, dev.name, dev.filter)
+                self.recorder.rotate()
+            elif action == STOP:
+                self.full = True
+                logging.critical('Support presque plein (%s) : arret de l\'enregistrement', state)
+
+    def run(self, stop):
+        """
+            Enregistre jusqu'a ce que stop() retourne True, que le support soit
+            presque plein ou que le thread de reception soit arrete
+        """
+        while not stop() and not self.full and not self.failed:
+            self.step()
+
+    def close(self):
+        """
+            Arrete l'acquisition sans perte de donnees et attend la fin de la compression
+            @return: statistiques de l'enregistrement
+            @rtype: dict
+        """
+        # les trames deja recues sont ajoutees aux derniers blocs
+        for desc in self.receiver.stop():
+            self.recorder.put(desc)
+        self.recorder.close()
+
+        for lms in self.devices:
+            lms.scanContinous(0) # arrete l'acquisition continue de donnees
+            lms.stopMeas()
+        stats = self.stats()
+        for dev in stats['devices']:
+            logging.info('Statistiques de %s : %s', dev['name'], dev)
+        logging.info('Statistiques de reception : %s, tampon : %s', stats['receiver'],\
+            stats['ring'])
+        # attend que les processus de compression aient termine
+        self.pool.close()
+        self.ring.close()
+
+        # statistiques de l'acquisition (lues par bench/benchmark.py)
+        stats = self.stats()
+        with open(os.path.join(self.path, 'stats.json'), 'w') as fic:
+            json.dump(stats, fic)
+
+        logging.info('Enregistrement termine')
+
+        # copie les logs dans le dossier contenant les mesures
+        with open(os.path.join(self.configpath, 'log.txt'), 'r') as logs:
+            with open(os.path.join(self.path, 'log.txt'), 'w') as dstlog:
+                dstlog.write(logs.read())
+
+        # ajoute l'heure de fin au fichier info
+        with open(os.path.join(self.path, 'info.txt'), 'a') as fic:
+            fic.write("Fin d'enregistrement: "+time.strftime("%Y%m%d%H%M%S", time.localtime())+'\n')
+        return stats
+
+    def abort(self):
+        """
+            Arrete l'acquisition immediatement, seuls les morceaux complets des
+            blocs en cours sont gardes (recover.py)
+        """
+        self.receiver.stop()
+        for p in self.pool.procs:
+            p.kill()
+        for p in self.pool.procs:
+            p.join()
+        for lms in self.devices:
+            lms.scanContinous(0)
+        self.ring.close()
+        for dev in self.recorder.devices:
+            recoverDir(dev.path)
+        logging.warning('Enregistrement %s interrompu', self.path)
+
+    def stats(self):
+        """
+            Retourne les statistiques de l'enregistrement en cours
+            @rtype: dict
+        """
+        return {'duration': round(time.monotonic() - self.start, 3),\
+            'devices': self.recorder.stats(), 'compression': self.pool.stats(),\
+            'receiver': self.receiver.stats(), 'ring': self.ring.stats(),\
+            'storage': self.watcher.stats()}
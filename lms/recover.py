@@ -0,0 +1,139 @@
+"""
+    Recuperation des blocs interrompus (crash, coupure de courant)
+    Un bloc en cours d'ecriture porte l'extension PART et se compose de morceaux
+    independants (voir compression.BlockWriter). Les morceaux complets sont gardes,
+    le morceau tronque et la place reservee non ecrite (zeros) a la fin sont
+    supprimes et le fichier prend son nom final
+    Usage : python3 recover.py <dossier ou fichier.part> ...
+"""
+
+import os
+import sys
+import lzma
+import zlib
+import logging
+import argparse
+from compression import PART, zstandard, lz4
+
+# taille des lectures dans le fichier tronque
+READ_SIZE = 1024*1024
+
+def makeDecompressor(path):
+    """
+        Retourne un decompresseur d'un morceau (attributs eof et unused_data),
+        le codec est deduit de l'extension du bloc (sans PART)
+    """
+    if path.endswith('.gz'):
+        return zlib.decompressobj(31)
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError('Le module zstandard est necessaire pour lire '+path)
+        return zstandard.ZstdDecompressor().decompressobj()
+    if path.endswith('.lz4'):
+        if lz4 is None:
+            raise RuntimeError('Le module lz4 est necessaire pour lire '+path)
+        return lz4.frame.LZ4FrameDecompressor()
+    return lzma.LZMADecompressor(lzma.FORMAT_XZ)
+
+def completeLength(path):
+    """
+        Cherche la fin du dernier morceau complet d'un bloc tronque
+        Chaque morceau est decompresse pour etre verifie, la memoire utilisee
+        reste celle d'une lecture et d'un morceau decompresse
+        @param path: chemin du fichier tronque
+        @return: (taille des morceaux complets en octets, nombre de morceaux complets)
+    """
+    base = path[:-len(PART)] if path.endswith(PART) else path
+    dec = makeDecompressor(base)
+    offset = 0 # octets donnes au decompresseur
+    good = 0 # fin du dernier morceau complet
+    chunks = 0
+    with open(path, 'rb') as fic:
+        data = fic.read(READ_SIZE)
+        while data:
+            offset += len(data)
+            if good == offset - len(data) and not data.strip(b'\0'):
+                break # place reservee par posix_fallocate, jamais ecrite
+            try:
+                dec.decompress(data)
+            except Exception as exc: # LZMAError, zlib.error ou erreur de zstandard/lz4
+                logging.warning('%s : donnees invalides apres %s octets (%s)', path, good, exc)
+                break
+            if dec.eof: # fin d'un morceau, la suite commence un nouveau morceau
+                data = dec.unused_data
+                good = offset - len(data)
+                chunks += 1
+                dec = makeDecompressor(base)
+                if data:
+                    offset -= len(data)
+                    continue
+            data = fic.read(READ_SIZE)
+    return good, chunks
+
+def dataEnd(path):
+    """
+        Retourne la position de la fin des donnees ecrites (dernier octet non nul)
+    """
+    with open(path, 'rb') as fic:
+        pos = fic.seek(0, os.SEEK_END)
+        while pos > 0:
+            size = min(READ_SIZE, pos)
+            fic.seek(pos - size)
+            data = fic.read(size).rstrip(b'\0')
+            if data:
+                return pos - size + len(data)
+            pos -= size
+    return 0
+
+def salvage(path):
+    """
+        Garde les morceaux complets d'un bloc tronque et lui donne son nom final
+        Le fichier est tronque sur place, sans copie
+        @param path: chemin du fichier (extension PART)
+        @return: (nom final ou None si rien n'est recuperable, morceaux, octets perdus)
+    """
+    size = dataEnd(path)
+    good, chunks = completeLength(path)
+    if not chunks:
+        logging.warning('%s : aucun morceau complet', path)
+        return None, 0, size
+    final = path[:-len(PART)] if path.endswith(PART) else path
+    os.truncate(path, good)
+    if final != path:
+        os.rename(path, final)
+    lost = max(size - good, 0)
+    logging.info('%s : %s morceaux recuperes, %s octets perdus', final, chunks, lost)
+    return final, chunks, lost
+
+def recoverDir(path):
+    """
+        Recupere tous les blocs interrompus d'un dossier
+        @return: liste des resultats de salvage()
+    """
+    res = []
+    for fil in sorted(os.listdir(path)):
+        if fil.endswith(PART):
+            res.append(salvage(os.path.join(path, fil)))
+    return res
+
+def main():
+    parser = argparse.ArgumentParser(description="Recuperation des blocs interrompus")
+    parser.add_argument('paths', nargs='+', help='Dossiers ou fichiers '+PART+' a recuperer')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(levelname)s - %(message)s', level=logging.INFO)
+
+    status = 0
+    for path in args.paths:
+        if os.path.isdir(path):
+            results = recoverDir(path)
+        else:
+            results = [salvage(path)]
+        for final, chunks, lost in results:
+            if final is None:
+                status = 1
+            else:
+                print(final, chunks, 'morceaux,', lost, 'octets perdus')
+    sys.exit(status)
+
+if __name__ == '__main__':
+    main()
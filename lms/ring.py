@@ -0,0 +1,106 @@
+"""
+    Tampon circulaire en memoire partagee (multiprocessing.shared_memory)
+    Les trames sont copiees une seule fois dans le tampon par le thread de reception,
+    les processus de compression les lisent directement dans la memoire partagee
+    (memoryview, sans copie ni pickle) a partir d'un descripteur (position, taille, fin)
+    La place d'une trame est liberee quand le processus qui l'a recue l'a compressee
+"""
+
+import multiprocessing
+from multiprocessing import shared_memory
+
+class SharedRing:
+    """
+        Tampon circulaire d'octets partage entre un producteur et des consommateurs
+        Les positions absolues (octets ecrits depuis le debut) ne reviennent jamais
+        a zero, la position dans le tampon est la position absolue modulo la taille.
+        Une trame n'est jamais coupee : si elle ne tient pas avant la fin du tampon,
+        elle est ecrite au debut et la fin du tampon est sautee
+    """
+    def __init__(self, size=1 << 25, consumers=1):
+        """
+            @param size: taille du tampon en octets
+            @param consumers: nombre de consommateurs (processus de compression)
+        """
+        self.size = size
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.view = self.shm.buf
+        # fin de la derniere trame liberee par chaque consommateur (ecrit par les consommateurs)
+        self.consumed = multiprocessing.Array('Q', consumers, lock=False)
+        self.assigned = [0]*consumers # fin de la derniere trame confiee a chaque consommateur
+        self.given = 0 # fin de la derniere trame confiee a un consommateur
+        self.head = 0 # position absolue d'ecriture
+        self.writes = 0 # trames ecrites
+        self.overflows = 0 # trames jetees faute de place
+        self.wraps = 0 # retours au debut du tampon
+        self.highWater = 0 # occupation max du tampon (octets)
+
+    def used(self):
+        """
+            Retourne le nombre d'octets occupes (trames non liberees)
+        """
+        tail = self.given # tout ce qui a ete confie puis libere
+        for i, end in enumerate(self.assigned):
+            consumed = self.consumed[i]
+            if end > consumed: # ce consommateur a des trames en attente
+                tail = min(tail, consumed)
+        return self.head - tail
+
+    def write(self, data):
+        """
+            Copie une trame dans le tampon (producteur)
+            @param data: trame (bytes ou memoryview)
+            @return: descripteur (position, taille, fin) ou None si le tampon est plein
+        """
+        n = len(data)
+        pos = self.head % self.size
+        pad = self.size - pos if pos + n > self.size else 0
+        if self.used() + pad + n > self.size:
+            self.overflows += 1
+            return None
+        if pad:
+            self.wraps += 1
+            self.head += pad
+            pos = 0
+        self.view[pos:pos + n] = data
+        self.head += n
+        self.writes += 1
+        self.highWater = max(self.highWater, self.used())
+        return (pos, n, self.head)
+
+    def assign(self, consumer, end):
+        """
+            Indique que la trame finissant a la position absolue end est confiee
+            au consommateur consumer (les trames sont confiees dans l'ordre)
+        """
+        self.assigned[consumer] = end
+        self.given = end
+
+    def read(self, pos, n):
+        """
+            Retourne une vue sur une trame du tampon (consommateur)
+            @rtype: memoryview
+        """
+        return self.view[pos:pos + n]
+
+    def release(self, consumer, end):
+        """
+            Libere les trames du consommateur consumer jusqu'a la position absolue end
+        """
+        self.consumed[consumer] = end
+
+    def stats(self):
+        """
+            Retourne les statistiques du tampon
+            @rtype: dict
+        """
+        return {'size': self.size, 'writes': self.writes, 'overflows': self.overflows,\
+            'wraps': self.wraps, 'highWater': self.highWater, 'used': self.used()}
+
+    def close(self):
+        """
+            Libere la memoire partagee (producteur, apres l'arret des consommateurs)
+        """
+        self.view.release()
+        self.shm.close()
+        self.shm.unlink()
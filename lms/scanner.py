@@ -1,17 +1,13 @@
 import argparse
 import logging
-import time
 import configparser
-import lzma
-import gzip
 import os
 import signal
-import multiprocessing
 from logging.handlers import RotatingFileHandler
-from shutil import move
-from collections import deque
 from LMS5xx import LMS5xx
 from structs import scanCfg, scanDataCfg
+from compression import CODECS
+from recorder import Session
 
 # global running flag
 STOP = False
@@ -19,8 +15,8 @@ STOP = False
 # chemin d'enregistrement des donnees
 PATH = '/media/usb/'
 
-# chemin du fichier de config
-CONFIGPATH = '/home/pi/scanner/lms'
+# chemin du fichier de config (dossier de ce script)
+CONFIGPATH = os.path.dirname(os.path.abspath(__file__))
 
 def loadConfig(filename):
     """
@@ -74,56 +70,53 @@ def saveConfig(lms, cfg, datacfg, echo):
 
     return (retscan, retscandata)
 
-def saveTxt(q):
+def addOptions(parser):
     """
-        Enregistre le contenu de q en texte brut non compresse
-        @param q: iterable contenant des bytes a enregistrer
+        Ajoute a parser les options de connexion aux telemetres et d'enregistrement
+        (communes a scanner.py et au daemon d'acquisition)
+        @param parser: argparse.ArgumentParser
     """
-    path = PATH+time.strftime('%d%b%Y%H%M%S', time.localtime())+'.txt'
-    with open(path, 'wb') as raw:
-        raw.write(b''.join(q))
-        raw.close()
-
-def saveGz(q):
-    """
-        Enregistre le contenu de q en texte compresse (gzip)
-        @param q: iterable contenant des bytes a enregistrer
-    """
-    path = PATH+time.strftime('%d%b%Y%H%M%S', time.localtime())+'.txt.gz'
-    with gzip.open(path, 'wb') as gz:
-        gz.write(b''.join(q))
-        gz.close()
-
-def makeLZMA(q):
-    """
-        Compresse les elements dans q jusqu'a rencontrer None puis enregistre le resultat
-        Le nom du fichier correspond a la date de debut du processus
-        Cette fonction est faite pour etre executee dans un processus separe
-        (des elements peuvent arriver dans q au fil du temps)
-        Ce processus s'arrete si son processus pere s'arrete
-        @param q: iterable contenant les trames a compresser
-    """
-    path = PATH+time.strftime('%Y%m%d%H%M%S', time.localtime())+'.txt.xz'
-    lzc = lzma.LZMACompressor()
-    res = deque() # file contenant les objects compresses
-    item = q.get() # objet courant lu dans q
-    parent = os.getppid()
-    while item is not None: # None signifie qu'aucune autre donnee arrive
-        res.append(lzc.compress(item))
-        item = q.get()
-        if os.getppid() != parent: # si ce processus est orphelin (crash du process pere)
-            logging.debug('Arret du processus orphelin avec le PID %s', os.getpid())
-            os._exit(0) # arret direct du processus
-    res.append(lzc.flush()) # fini la compression des donnees
-
-    # enregistrement dans le fichier
-    with lzma.open(path, 'wb') as f:
-        try:
-            f.write(b''.join(res))
-        except OSError:
-            logging.critical("Support de stockage plein!")
-    logging.info('Fin du processus avec le PID %s', os.getpid())
-    return
+    parser.add_argument('-i', '--ip', action='append',\
+        help='Adresse IP du telemetre (adresse ou adresse:port), a repeter pour '\
+        'enregistrer plusieurs telemetres (192.168.1.12 par defaut)')
+    parser.add_argument('-p', '--port', default=None, type=int,\
+        help='Port du telemetre (2111 en ASCII, 2112 en binaire)')
+    parser.add_argument('-b', '--binary', action='store_true',\
+        help='Utilise le protocole binaire CoLa-B')
+    parser.add_argument('-s', '--size', default='500000', type=int,\
+        help='Nombre de trames par bloc (par telemetre), 0 pour ne pas limiter')
+    parser.add_argument('--period', default='0', type=int,\
+        help="Duree d'un bloc en secondes, alignee sur l'horloge (0 pour ne pas limiter)")
+    parser.add_argument('--budget', default='0', type=int,\
+        help="Taille compressee approximative d'un bloc en Mo (0 pour ne pas limiter)")
+    parser.add_argument('--prealloc', default='16', type=int,\
+        help='Pas de reservation de la place des blocs sur le disque en Mo (0 pour ne pas reserver),'\
+            ' ignore si le systeme de fichiers ne gere pas la reservation (exFAT)')
+    parser.add_argument('--reserve', default='64', type=int,\
+        help="Place gardee libre sur le support en Mo, l'enregistrement s'arrete avant")
+    parser.add_argument('--nodegrade', action='store_true',\
+        help="Pas de mode degrade (compression plus forte puis decimation) quand la "\
+        "place libre devient faible, seulement l'arret")
+    parser.add_argument('-w', '--workers', default='2', type=int,\
+        help='Nombre de processus de compression')
+    parser.add_argument('-q', '--queue', default='2000', type=int,\
+        help="Nombre max de trames en attente de compression par processus")
+    parser.add_argument('-r', '--ring', default='32', type=int,\
+        help='Taille du tampon partage de reception (en Mo)')
+    parser.add_argument('--rcvbuf', default=str(1 << 22), type=int,\
+        help='Taille du buffer de reception du socket (SO_RCVBUF, en octets)')
+    parser.add_argument('-z', '--codec', default='xz', choices=list(CODECS),\
+        help='Codec de compression des blocs (zstd et lz4 si les modules sont installes)')
+    parser.add_argument('--level', default=None, type=int,\
+        help='Niveau de compression (par defaut celui du codec)')
+    parser.add_argument('--delta', action='store_true',\
+        help='Blocs au format delta : mesures en colonnes et differences entre scans avant '\
+        'la compression (plus petits, relus par decompress.py, necessite numpy)')
+    parser.add_argument('-d', '--dest', default=PATH,\
+        help="Dossier d'enregistrement des mesures")
+    parser.add_argument('-l', '--load', action='append',\
+        help='Fichier de config, a repeter pour donner un fichier par telemetre '\
+        '(defaults.ini par defaut)')
 
 def signalHandler(a, b):
     """
@@ -148,15 +141,17 @@ def main():
     
     # --- PARSING DES ARGUMENTS ---
     parser = argparse.ArgumentParser(description='LMS5xx CLI tool')
-    parser.add_argument('-i', '--ip', default='192.168.1.12', help='Adresse IP du telemetre')
-    parser.add_argument('-p', '--port', default='2111', type=int, help='Port du telemetre')
-    parser.add_argument('-s', '--size', default='500000', type=int, help='Nombre de trames par bloc')
-    parser.add_argument('-l', '--load', default='defaults.ini',\
-        help='Charge les reglages depuis un fichier', )
+    addOptions(parser)
     parser.add_argument('commande', choices=['test', 'start', 'stop', 'save', 'status', 'crash'],\
         help='Commande effectuee par le telemetre')
 
     args = parser.parse_args() # parse les arguments
+    if args.port is None:
+        args.port = 2112 if args.binary else 2111
+    if args.ip is None:
+        args.ip = ['192.168.1.12']
+    if args.load is None:
+        args.load = ['defaults.ini']
     logging.info('Commande : %s', args.commande)
     signal.signal(signal.SIGUSR1, signalHandler) # attache SIGUSR1 a signalHandler()
 
@@ -201,44 +196,56 @@ def main():
 
         return
 
-    # toutes les autres commandes necessitent de se connecter au telemetre
-    lms = LMS5xx()
-    logging.debug('Connexion au LMS 5xx')
-    lms.connect(args.ip, args.port)
-    if not lms.isConnected():
-        print('Impossible de se connecter au telemetre')
-        logging.critical('Abandon ...')
-        # quitte directement le programme si on ne peut pas se connecter au telemetre
+    # toutes les autres commandes necessitent de se connecter aux telemetres
+    if len(args.load) not in (1, len(args.ip)):
+        print('Donner un fichier de config pour tous les telemetres ou un par telemetre')
         return
+    loads = args.load * len(args.ip) if len(args.load) == 1 else args.load
+    devices = []
+    for host in args.ip:
+        host, _, port = host.partition(':') # adresse[:port]
+        lms = LMS5xx(args.binary)
+        logging.debug('Connexion au LMS 5xx %s', host)
+        lms.connect(host, int(port or args.port), args.rcvbuf)
+        if not lms.isConnected():
+            print('Impossible de se connecter au telemetre', host)
+            logging.critical('Abandon ...')
+            # quitte directement le programme si on ne peut pas se connecter a un telemetre
+            for lms in devices:
+                lms.disconnect()
+            return
+        devices.append(lms)
 
-    # chargement des config depuis le fichier
-    cfg, datacfg, echo = loadConfig(args.load)
+    # chargement des config depuis les fichiers
+    configs = [loadConfig(load) for load in loads]
 
     # --- TEST ---
     if args.commande == 'test':
         """
             Test de connexion
         """
-        lms.disconnect()
+        for lms in devices:
+            lms.disconnect()
         print('OK')
         return
 
     # --- STATUS ---
     if args.commande == 'status':
         """
-            Affiche le code d'etat du telemetre
+            Affiche le code d'etat de chaque telemetre
         """
-        status = lms.queryStatus()
-        print(status)
+        for lms in devices:
+            print(lms.queryStatus())
         return
 
     # --- SAVE ---
     if args.commande == 'save':
         """
-            Enregistre la config dans la memoire du telemetre, elle sera accessible
+            Enregistre la config dans la memoire des telemetres, elle sera accessible
             apres redemarrage
         """
-        saveConfig(lms, cfg, datacfg, echo)
+        for lms, (cfg, datacfg, echo) in zip(devices, configs):
+            saveConfig(lms, cfg, datacfg, echo)
         return
 
     # --- START ---
@@ -247,8 +254,9 @@ def main():
             Demarre l'acquisiton de donnees avec compression en temps reel
             Le processus s'arrete proprement en recevant un signal SIGUSR1
         """
-        # charge la config dans le telemetre
-        saveConfig(lms, cfg, datacfg, echo)
+        # charge la config dans les telemetres
+        for lms, (cfg, datacfg, echo) in zip(devices, configs):
+            saveConfig(lms, cfg, datacfg, echo)
 
         # Enregistre le pid de ce processus dans un fichier pour l'arreter plus tard
         # avec les commandes start et stop
@@ -256,72 +264,20 @@ def main():
             fic.write(str(os.getpid()))
             fic.close()
 
-        # attend que le telemetre soit pret a mesurer
-        while lms.queryStatus() < 7:
-            time.sleep(0.5)
-
-        # lecture fichier info
-        try:
-            with open(os.path.join(CONFIGPATH, '../info.txt'), 'r') as fic:
-                buff = fic.read()
-        except FileNotFoundError:
-            buff = ''
-
-        # les mesures sont enregistrees dans un dossier separe
-        global PATH
-        PATH = PATH + time.strftime('%Y%m%d%H%M%S', time.localtime())+'/' # chemin du dossier des mesures
-        os.mkdir(PATH)
-
-        # ecriture debut fichier info
-        with open(os.path.join(PATH, 'info.txt'), 'w') as fic:
-            fic.write("Debut d'enregistrement: "+time.strftime("%Y%m%d%H%M%S", time.localtime())+'\n')
-            fic.write(buff)
-            os.remove(os.path.join(PATH, 'info.txt'))
-
-        # copie le fichier de config dans le dossier destination
-        with open(os.path.join(os.path.dirname(__file__), args.load), 'r') as config:
-            with open(os.path.join(PATH, 'config.ini'), 'w') as dstconfig:
-                dstconfig.write(config.read())
-
-        lms.scanContinous(1) # demarre l'acquisition de donnees continue
-        while not STOP: # le flag STOP permet d'arreter proprement l'acquisition
-            q = multiprocessing.Queue() # dans q seront ajoutees les trames recues
-            p = multiprocessing.Process(target=makeLZMA, args=(q,)) # processus de compression
-            p.start()
-            logging.debug("Demarrage d'un nouveau processus avec le PID %s", p.pid)
-            for _ in range(args.size): # le processus de compression recevra size elements
-                dat = lms.getScanData(0.1) # lis une trame
-                if dat is not None:
-                    q.put(dat) # ajoute la trame dans la file partagee avec le processus de compression
-                if STOP:
-                    q.put(None)
-                    break
-            q.put(None) # indique au processus de compression qu'aucune donnee supplementaire n'arrivera
-            q.close() # ferme le tube de communication
-            multiprocessing.active_children() # force l'arret des processus fils termines
-
-        # indique au dernier processus de s'arreter
-        try:
-            q.put(None)
-        except:
-            pass
-        lms.scanContinous(0) # arrete l'acquisition continue de donnees
-        lms.stopMeas()
-        # attend que les processus fils aient termine
-        while len(multiprocessing.active_children()) > 0:
-            pass
-
-        logging.info('Processus principal termine')
-        logging.info('Fin du log')
-
-        # deplace les logs dans le dossier contenant les mesures
-        with open(os.path.join(os.path.dirname(__file__), 'log.txt'), 'r') as logs:
-            with open(os.path.join(PATH, 'log.txt'), 'w') as dstlog:
-                dstlog.write(logs.read())
+        # attend que les telemetres soient prets a mesurer
+        if not all([lms.waitReady() for lms in devices]):
+            logging.critical('Abandon ...')
+            os.remove(os.path.join(os.path.dirname(__file__), 'pid'))
+            return
 
-        # ajoute l'heure de fin au fichier info
-        with open(os.path.join(PATH, 'info.txt'), 'a') as fic:
-            fic.write("Fin d'enregistrement: "+time.strftime("%Y%m%d%H%M%S", time.localtime())+'\n')
+        # enregistrement jusqu'a la reception du signal d'arret
+        session = Session(devices, args.ip, loads, args.dest, CONFIGPATH, args.binary,\
+            args.size, args.workers, args.queue, args.ring, args.codec, args.level,\
+            period=args.period, budget=args.budget, prealloc=args.prealloc,\
+            reserve=args.reserve, degrade=not args.nodegrade, delta=args.delta)
+        session.open()
+        session.run(lambda: STOP) # le flag STOP permet d'arreter proprement l'acquisition
+        session.close()
 
         # on signale la fin du programme en supprimant le fichier pid
         os.remove(os.path.join(os.path.dirname(__file__), 'pid'))
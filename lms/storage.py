@@ -0,0 +1,109 @@
+"""
+    Surveillance de la place libre sur le support d'enregistrement
+    La place libre est lue avec statvfs, le temps d'enregistrement restant est
+    estime a partir du debit compresse des dernieres minutes (octets produits par
+    le pool de compression). Quand le temps restant passe sous un seuil, le mode
+    degrade passe a l'etape suivante (les etapes ne reviennent jamais en arriere) :
+        level    : niveau de compression plus eleve (compression.HIGH_LEVELS)
+        decimate : une mesure sur deux et premier echo seulement (module filters)
+        stop     : arret propre de l'enregistrement, avant que le support soit plein
+    L'arret est aussi demande des que la place libre passe sous la reserve
+"""
+
+import os
+import time
+from collections import deque
+
+# actions du mode degrade
+LEVEL = 'level'
+DECIMATE = 'decimate'
+STOP = 'stop'
+# etapes du mode degrade : (temps restant estime en s, action), dans l'ordre
+STAGES = ((4*3600, LEVEL), (3600, DECIMATE), (600, STOP))
+# place gardee libre sur le support (Mo)
+RESERVE = 64
+# duree sur laquelle le debit compresse est estime (s)
+WINDOW = 300
+# duree de mesure minimale avant d'estimer le debit (s)
+WARMUP = 30
+
+def freeSpace(path):
+    """
+        Retourne la place disponible (octets) sur le systeme de fichiers contenant path
+        (place reservee a root exclue, comme df)
+    """
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+class StorageWatcher:
+    """
+        Estimation du temps d'enregistrement restant et etapes du mode degrade
+    """
+    def __init__(self, path, reserve=RESERVE, stages=STAGES, interval=5, window=WINDOW):
+        """
+            @param path: dossier d'enregistrement
+            @param reserve: place gardee libre (Mo)
+            @param stages: etapes du mode degrade ((temps restant en s, action), ...)
+            @param interval: periode de lecture de la place libre (s)
+            @param window: duree sur laquelle le debit est estime (s)
+        """
+        self.path = path
+        self.reserve = reserve << 20
+        self.stages = stages
+        self.interval = interval
+        self.window = window
+        self.samples = deque() # (date, octets compresses produits)
+        self.next = 0.0 # date de la prochaine lecture
+        self.stage = -1 # derniere etape atteinte (indice dans stages)
+        self.free = None # place disponible (octets)
+        self.rate = None # debit compresse estime (octets/s)
+        self.remaining = None # temps restant estime (s)
+
+    def due(self, now):
+        """
+            Retourne True s'il faut lire la place libre
+        """
+        return now >= self.next
+
+    def update(self, written, now=None):
+        """
+            Lis la place libre et met a jour l'estimation du temps restant
+            @param written: octets compresses produits depuis le debut de l'enregistrement
+            @param now: date (time.monotonic()), None pour maintenant
+            @return: actions des etapes franchies depuis le dernier appel (liste)
+        """
+        if now is None:
+            now = time.monotonic()
+        self.next = now + self.interval
+        self.free = freeSpace(self.path)
+        self.samples.append((now, written))
+        while now - self.samples[0][0] > self.window:
+            self.samples.popleft()
+        span = now - self.samples[0][0]
+        if span >= WARMUP:
+            self.rate = (written - self.samples[0][1]) / span
+        available = max(self.free - self.reserve, 0)
+        if self.rate:
+            self.remaining = available / self.rate
+        else:
+            self.remaining = None
+
+        stage = self.stage
+        for i, (limit, action) in enumerate(self.stages):
+            if i <= self.stage:
+                continue
+            if (self.remaining is not None and self.remaining < limit) or\
+                (action == STOP and available == 0):
+                stage = i
+        actions = [action for _, action in self.stages[self.stage+1:stage+1]]
+        self.stage = stage
+        return actions
+
+    def stats(self):
+        """
+            Retourne l'etat du support
+            @rtype: dict
+        """
+        return {'free': self.free, 'rate': None if self.rate is None else round(self.rate),\
+            'remaining': None if self.remaining is None else round(self.remaining),\
+            'stage': self.stages[self.stage][1] if self.stage >= 0 else None}
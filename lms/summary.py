@@ -0,0 +1,374 @@
+"""
+    Index des blocs d'un enregistrement (fichier blocks.jsonl dans le dossier des blocs)
+    Chaque processus de compression resume les trames d'un bloc pendant qu'il les
+    compresse et ajoute une ligne JSON a l'index a la fin du bloc : dates et compteurs
+    de la premiere et de la derniere trame, nombre de trames, trames perdues et
+    distances min/moyenne/max par secteur angulaire, et l'index des morceaux du bloc
+    (position et taille dans le fichier, trames, compteurs de scans et dates de chaque
+    morceau, voir compression.BlockWriter)
+    Les distances sont calculees sur une trame sur sample pour rester leger sur le
+    Raspberry Pi. decompress.py et extract.py choisissent les blocs a lire avec l'index,
+    decompress.py ne lit que les morceaux utiles avec --seek/--range
+"""
+
+import os
+import json
+import time
+import struct
+import numpy as np
+from decoder import decodeFrame, timestamps
+from gaps import GapTracker, frameCounters, MODULO, MAX_GAP
+
+# nom de l'index dans le dossier des blocs
+INDEX = 'blocks.jsonl'
+# une trame sur SAMPLE est decodee pour les statistiques des distances
+SAMPLE = 10
+# largeur des secteurs angulaires (degres)
+SECTOR = 10
+
+def isoDate(date):
+    """
+        Convertit les champs de date d'une trame en date ISO 8601, None si invalide
+    """
+    if date is None:
+        return None
+    stamp = timestamps(np.array([date], dtype=np.int64))[0]
+    if np.isnat(stamp):
+        return None
+    return str(stamp)
+
+class BlockSummary:
+    """
+        Statistiques d'un bloc, mises a jour trame par trame
+    """
+    def __init__(self, sample=SAMPLE, sector=SECTOR):
+        """
+            @param sample: decode une trame sur sample pour les distances
+            @param sector: largeur des secteurs angulaires (degres)
+        """
+        self.sample = sample
+        self.sector = sector
+        self.frames = 0 # trames du bloc
+        self.bytes = 0 # octets avant compression
+        self.gaps = GapTracker() # trames perdues dans le bloc
+        self.first = None # compteurs (telegramme, scan) de la premiere trame
+        self.last = None # compteurs de la derniere trame
+        self.start = None # date de la premiere trame decodee
+        self.end = None # date de la derniere trame decodee
+        self.lastFrame = None # copie de la derniere trame non decodee (date de fin)
+        self.hostStart = time.time() # dates de l'hote (secondes depuis 1970)
+        self.hostEnd = self.hostStart
+        self.decoded = 0 # trames decodees
+        self.invalid = 0 # trames non decodables
+        self.geometry = None # (angle de depart, pas, nb mesures) des secteurs calcules
+        self.sectors = None # angle de depart de chaque secteur (degres)
+        self.inverse = None # numero de secteur de chaque mesure
+        self.min = self.max = self.sum = self.count = None
+        self.chunks = [] # resume de chaque morceau termine (dict)
+        self.chunk = None # trames, premier et dernier compteurs de scans du morceau en cours
+        self.chunkStart = None # date de la premiere trame du morceau en cours
+
+    def update(self, frame):
+        """
+            Prend en compte une trame
+            @param frame: trame CoLa-A ou CoLa-B (bytes ou memoryview)
+        """
+        self.frames += 1
+        self.bytes += len(frame)
+        counters = frameCounters(frame)
+        self.gaps.updateCounters(counters)
+        if counters is not None:
+            if self.first is None:
+                self.first = counters
+            self.last = counters
+        scan = None if counters is None else counters[1]
+        first = self.chunk is None # premiere trame du morceau, toujours decodee
+        if first:
+            self.chunk = [0, scan, scan]
+        self.chunk[0] += 1
+        if scan is not None:
+            if self.chunk[1] is None:
+                self.chunk[1] = scan
+            self.chunk[2] = scan
+        # seules les trames gardees sont copiees, le tampon partage est libere apres l'appel
+        if first or (self.frames - 1) % self.sample == 0:
+            self.__decode(bytes(frame))
+            self.lastFrame = None
+        else:
+            self.lastFrame = bytes(frame)
+
+    def __decode(self, frame):
+        """
+            Decode une trame : date et distances du premier echo par secteur
+        """
+        try:
+            date, channels = decodeFrame(frame)
+        except (ValueError, IndexError, KeyError, struct.error):
+            self.invalid += 1
+            return
+        self.decoded += 1
+        if date is not None:
+            if self.start is None:
+                self.start = date
+            if self.chunkStart is None:
+                self.chunkStart = date
+            self.end = date
+        if 'DIST1' not in channels:
+            return
+        scale, offset, start, step, values = channels['DIST1']
+        if self.geometry != (start, step, len(values)):
+            self.__sectors(start, step, len(values))
+        dist = values * scale + offset
+        echo = values > 0 # 0 : pas d'echo
+        n = len(self.sectors)
+        self.sum += np.bincount(self.inverse, weights=np.where(echo, dist, 0), minlength=n)
+        self.count += np.bincount(self.inverse, weights=echo, minlength=n)
+        np.minimum.at(self.min, self.inverse, np.where(echo, dist, np.inf))
+        np.maximum.at(self.max, self.inverse, np.where(echo, dist, -np.inf))
+
+    def __sectors(self, start, step, amount):
+        """
+            Calcule le secteur de chaque mesure (la geometrie d'un bloc ne change pas,
+            sinon les statistiques precedentes sont remplacees)
+        """
+        deg = (start + step * np.arange(amount, dtype=np.int64)) / 10000
+        ids = np.floor(deg / self.sector).astype(np.int64)
+        self.sectors, self.inverse = np.unique(ids, return_inverse=True)
+        self.sectors = self.sectors * self.sector
+        n = len(self.sectors)
+        self.sum = np.zeros(n)
+        self.count = np.zeros(n)
+        self.min = np.full(n, np.inf)
+        self.max = np.full(n, -np.inf)
+        self.geometry = (start, step, amount)
+
+    def __endDate(self):
+        """
+            Decode la date de la derniere trame si elle n'a pas ete decodee
+        """
+        if self.lastFrame is not None:
+            try:
+                date = decodeFrame(self.lastFrame)[0]
+                if date is not None:
+                    self.end = date
+            except (ValueError, IndexError, KeyError, struct.error):
+                pass
+            self.lastFrame = None
+
+    def endChunk(self):
+        """
+            Termine le morceau en cours (les trames suivantes sont dans le morceau suivant)
+        """
+        if self.chunk is None:
+            return
+        self.__endDate()
+        frames, first, last = self.chunk
+        self.chunks.append({'frames': frames,\
+            'scan': None if first is None else [first, last],\
+            'start': isoDate(self.chunkStart), 'end': isoDate(self.end)})
+        self.chunk = None
+        self.chunkStart = None
+
+    def result(self, filename, size=None, index=None):
+        """
+            Termine le resume et retourne la ligne de l'index
+            @param filename: nom du fichier du bloc
+            @param size: taille du fichier compresse (octets)
+            @param index: (position, taille) de chaque morceau du fichier
+                (BlockWriter.index), None si inconnu
+            @rtype: dict
+        """
+        self.hostEnd = time.time()
+        self.endChunk()
+        self.__endDate()
+        sectors = []
+        if self.sectors is not None:
+            for i, angle in enumerate(self.sectors):
+                if self.count[i]:
+                    sectors.append([int(angle), round(float(self.min[i]), 1),\
+                        round(float(self.sum[i] / self.count[i]), 1), round(float(self.max[i]), 1)])
+                else:
+                    sectors.append([int(angle), None, None, None])
+        gaps = self.gaps.stats()
+        return {'file': filename, 'size': size, 'frames': self.frames, 'bytes': self.bytes,\
+            'lost': gaps['lost'], 'gaps': gaps['gaps'], 'invalid': gaps['invalid'] + self.invalid,\
+            'telegram': [self.first[0], self.last[0]] if self.first else None,\
+            'scan': [self.first[1], self.last[1]] if self.first else None,\
+            'start': isoDate(self.start), 'end': isoDate(self.end),\
+            'hostStart': round(self.hostStart, 3), 'hostEnd': round(self.hostEnd, 3),\
+            'decoded': self.decoded, 'sectorWidth': self.sector, 'sectors': sectors,\
+            'chunks': None if index is None or len(index) != len(self.chunks) else\
+                [dict(chunk, offset=pos, size=length)\
+                for (pos, length), chunk in zip(index, self.chunks)]}
+
+def appendIndex(path, entry):
+    """
+        Ajoute la ligne d'un bloc a l'index du dossier path
+        Une seule ecriture en mode ajout : les lignes de plusieurs processus ne se melangent pas
+    """
+    line = (json.dumps(entry) + '\n').encode()
+    fd = os.open(os.path.join(path, INDEX), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+def writeIndex(path, entries):
+    """
+        Remplace l'index du dossier path (fichier temporaire puis renommage atomique)
+        @param entries: lignes de l'index (dict), dans l'ordre
+    """
+    tmp = os.path.join(path, INDEX+'.tmp')
+    with open(tmp, 'w') as fic:
+        for entry in entries:
+            fic.write(json.dumps(entry) + '\n')
+        fic.flush()
+        os.fsync(fic.fileno())
+    os.replace(tmp, os.path.join(path, INDEX))
+
+def loadIndex(path):
+    """
+        Lis l'index du dossier path
+        @return: dict nom de fichier -> ligne de l'index (vide s'il n'y a pas d'index)
+        @rtype: dict
+    """
+    res = {}
+    try:
+        with open(os.path.join(path, INDEX), 'r') as fic:
+            for line in fic:
+                try:
+                    entry = json.loads(line)
+                except ValueError: # ligne tronquee (coupure de courant)
+                    continue
+                res[entry['file']] = entry
+    except FileNotFoundError:
+        pass
+    return res
+
+def selectBlocks(files, index, start=None, end=None):
+    """
+        Retourne les fichiers dont les mesures peuvent etre dans l'intervalle [start, end]
+        Les blocs absents de l'index ou sans date sont gardes
+        @param files: noms des fichiers des blocs
+        @param index: index retourne par loadIndex()
+        @param start: debut de l'intervalle (numpy.datetime64 ou None)
+        @param end: fin de l'intervalle (numpy.datetime64 ou None)
+    """
+    res = []
+    for fil in files:
+        entry = index.get(fil)
+        if entry is None or entry['start'] is None or entry['end'] is None:
+            res.append(fil)
+            continue
+        if start is not None and np.datetime64(entry['end']) < start:
+            continue
+        if end is not None and np.datetime64(entry['start']) > end:
+            continue
+        res.append(fil)
+    return res
+
+def selectChunks(entry, start=None, end=None):
+    """
+        Retourne les morceaux d'un bloc dont les mesures peuvent etre dans l'intervalle
+        [start, end] (morceaux sans date gardes)
+        @param entry: ligne de l'index du bloc (loadIndex()), None si absente
+        @param start: debut de l'intervalle (numpy.datetime64 ou None)
+        @param end: fin de l'intervalle (numpy.datetime64 ou None)
+        @return: (position, taille) des morceaux, None si le bloc n'a pas d'index des morceaux
+    """
+    if entry is None or not entry.get('chunks'):
+        return None
+    res = []
+    for chunk in entry['chunks']:
+        if chunk['start'] is not None and chunk['end'] is not None:
+            if start is not None and np.datetime64(chunk['end']) < start:
+                continue
+            if end is not None and np.datetime64(chunk['start']) > end:
+                continue
+        res.append((chunk['offset'], chunk['size']))
+    return res
+
+def covers(scan, low, high):
+    """
+        Retourne True si le compteur de scans scan est entre low et high (compteurs
+        sur 16 bits, high peut etre apres un retour a zero)
+    """
+    return (scan - low) % MODULO <= (high - low) % MODULO
+
+class ScanRange:
+    """
+        Selection des trames par compteur de scans, de first a last (premiere
+        occurrence dans les blocs lus dans l'ordre)
+        Le compteur de scans revient a zero tous les 65536 scans (22 minutes a 50 Hz),
+        les blocs a lire peuvent etre limites par date (selectBlocks()) pour choisir
+        une autre occurrence
+        Les morceaux des blocs sont choisis avec l'index des morceaux (chunks()), les
+        trames des morceaux lus sont ensuite filtrees une par une (keep())
+    """
+    def __init__(self, first, last=None):
+        """
+            @param first: compteur de scans de la premiere trame
+            @param last: compteur de scans de la derniere trame, None pour aller
+                jusqu'a la fin de l'enregistrement
+        """
+        self.first = first % MODULO
+        self.last = None if last is None else last % MODULO
+        # ecart max au premier compteur des trames gardees
+        self.span = MAX_GAP if last is None else (self.last - self.first) % MODULO
+        self.reached = False # morceau contenant first choisi
+        self.closed = False # morceau contenant last choisi, pas d'autre morceau a lire
+        self.started = False # trame first (ou suivante) trouvee
+        self.finished = False # trame last depassee, plus rien a lire
+        self.prev = None # dernier compteur de scans du morceau precedent
+
+    def chunks(self, entry):
+        """
+            Choisit les morceaux a lire d'un bloc
+            @param entry: ligne de l'index du bloc (loadIndex()), None si absente
+            @return: (position, taille) des morceaux a lire (liste vide pour sauter le
+                bloc), None pour lire tout le bloc (pas d'index des morceaux)
+        """
+        if self.closed or self.finished:
+            return []
+        if entry is None or not entry.get('chunks'):
+            if entry is not None and entry.get('scan'):
+                self.prev = entry['scan'][1]
+            return None
+        self.reached |= self.started
+        res = []
+        for chunk in entry['chunks']:
+            scan = chunk['scan']
+            if scan is None: # trames sans compteurs
+                if self.reached:
+                    res.append((chunk['offset'], chunk['size']))
+                continue
+            # trames entre la fin du morceau precedent et la fin de ce morceau
+            low = scan[0] if self.prev is None else (self.prev + 1) % MODULO
+            self.prev = scan[1]
+            if not self.reached:
+                if not covers(self.first, low, scan[1]):
+                    continue
+                self.reached = True
+                low = self.first
+            res.append((chunk['offset'], chunk['size']))
+            if self.last is not None and covers(self.last, low, scan[1]):
+                self.closed = True
+                break
+        return res
+
+    def keep(self, counters):
+        """
+            Retourne True si une trame lue est dans la selection
+            @param counters: compteurs de la trame (gaps.frameCounters())
+        """
+        if counters is None:
+            return self.started
+        offset = (counters[1] - self.first) % MODULO
+        if not self.started:
+            if offset > self.span:
+                return False
+            self.started = True
+        elif self.last is not None and offset > self.span:
+            self.finished = True
+            return False
+        return True